@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+"""
+Fetching of wsor and basin payloads from API_SERVER.
+
+A published snapshot of the month is used first, then fixture replay, the
+in-process and shared payload caches and a requests_cache session in that
+order. Expired payloads are revalidated with a conditional request, when
+the api answers 304 or sends the same body again the decoded object already
+cached is kept, so the station records and summaries derived from it stay
+cached too. Requests go through the upstream scheduler, when it gives up on
+a request the stale cached payload is used. Wsor payloads are decoded
+lazily, one basin at a time, see lazy_json. Does not import pandas, the
+table builders live in utils.
+"""
+
+import hashlib
+from time import perf_counter
+from functools import partial
+from os import path, makedirs
+from urllib.parse import urlencode
+
+import lazy_json
+from constants import API_DOMAIN, CACHE_ARGS
+from shared_cache import payload_cache
+from payloads import memory_cache
+from fixtures import fixture_store, FixtureMiss
+from snapshots import snapshot_store
+from cache_budget import disk_budget
+from upstream import upstream, UpstreamError
+from search import station_index
+from metrics import timed, count_cache, count_revalidation
+
+
+def cached_session(cache_args=CACHE_ARGS):
+    # requests_cache is slow to import and not needed when replaying
+    from requests_cache import CachedSession
+
+    makedirs(path.dirname(cache_args["cache_name"]) or ".", exist_ok=True)
+    return CachedSession(**cache_args)
+
+
+def trim_http_cache(expired=True, cache_args=CACHE_ARGS):
+    with cached_session(cache_args) as sesh:
+        if expired:
+            sesh.cache.delete(expired=True)
+        else:
+            sesh.cache.clear()
+
+
+def http_get(url, cache_args, headers, force_refresh, timeout):
+    with cached_session(cache_args) as sesh:
+        return sesh.get(
+            url, headers=headers, force_refresh=force_refresh, timeout=timeout
+        )
+
+
+def content_digest(content):
+    return hashlib.blake2b(content, digest_size=16).hexdigest()
+
+
+def response_validators(req):
+    return dict(
+        etag=req.headers.get("ETag"),
+        last_modified=req.headers.get("Last-Modified"),
+        digest=content_digest(req.content),
+        size=len(req.content),
+    )
+
+
+def conditional_headers(validators):
+    headers = {}
+    if validators and validators["etag"]:
+        headers["If-None-Match"] = validators["etag"]
+    if validators and validators["last_modified"]:
+        headers["If-Modified-Since"] = validators["last_modified"]
+    return headers
+
+
+def revalidate(url, req, validators, labels, lazy=False):
+    # the payload we already hold if req says it has not changed, else None
+    if validators is None or not req.ok:
+        return None
+    # a response served from the http cache never reached the api and is
+    # not counted as a revalidation
+    local = getattr(req, "from_cache", False)
+    if req.status_code == 304 or getattr(req, "revalidated", False):
+        result, bytes_saved = "not_modified", validators["size"]
+    elif content_digest(req.content) == validators["digest"]:
+        result, bytes_saved = None if local else "unchanged", 0
+    else:
+        if not local:
+            count_revalidation("changed", **labels)
+        return None
+    payload = stale_payload(url, lazy)
+    if payload is not None and result is not None:
+        count_revalidation(result, bytes_saved, **labels)
+    return payload
+
+
+def stale_payload(url, lazy=False):
+    payload = memory_cache.get(url, stale=True)
+    if payload is None:
+        payload = payload_cache.get(url, stale=True, lazy=lazy)
+    return payload
+
+
+def fetch_json(
+    endpoint,
+    params,
+    domain=API_DOMAIN,
+    cache_args=CACHE_ARGS,
+    force_refresh=False,
+    empty=None,
+    labels=None,
+    lazy=False,
+):
+    labels = labels or {}
+    url = f"{domain}{endpoint}?{urlencode(params)}"
+    print(url)
+    if fixture_store.replaying:
+        try:
+            return fixture_store.load(endpoint, params)
+        except FixtureMiss as fixture_path:
+            print(f"No recorded response for {url} - {fixture_path}")
+            return empty
+    # seconds to get the payload again if a cache drops it
+    start = perf_counter()
+    if not force_refresh:
+        payload = memory_cache.get(url)
+        count_cache("memory", payload is not None, **labels)
+        if payload is not None:
+            return payload
+        with timed("shared_cache_get", **labels):
+            payload = payload_cache.get(url, lazy=lazy)
+        count_cache("shared", payload is not None, **labels)
+        if payload is not None:
+            memory_cache.set(url, payload, cost=perf_counter() - start)
+            if fixture_store.recording:
+                fixture_store.save(endpoint, params, payload)
+            return payload
+    validators = payload_cache.validators(url)
+    name = endpoint.rsplit("/", 1)[-1]
+    send = partial(http_get, url, cache_args, conditional_headers(validators))
+    try:
+        with timed("fetch", **labels):
+            req = upstream.request(url, partial(send, force_refresh), name)
+        count_cache("http", getattr(req, "from_cache", False), **labels)
+        payload = revalidate(url, req, validators, labels, lazy)
+        if payload is None and req.status_code == 304:
+            # the stale copy was purged in the meantime
+            send = partial(http_get, url, cache_args, {}, True)
+            with timed("fetch", **labels):
+                req = upstream.request(url, send, name)
+    except UpstreamError as error:
+        print(f"{error}, using cached data")
+        payload = stale_payload(url, lazy)
+        count_cache("stale", payload is not None, **labels)
+        return empty if payload is None else payload
+    if payload is not None:
+        payload_cache.touch(url)
+        memory_cache.set(url, payload, cost=perf_counter() - start)
+        if fixture_store.recording:
+            fixture_store.save(endpoint, params, payload)
+    elif req.ok:
+        with timed("json_decode", **labels):
+            payload = lazy_json.loads(req.content) if lazy else req.json()
+        cost = perf_counter() - start
+        with timed("shared_cache_set", **labels):
+            payload_cache.set(
+                url, payload, validators=response_validators(req), cost=cost
+            )
+            disk_budget.maybe_enforce()
+        memory_cache.set(url, payload, cost=cost)
+        if fixture_store.recording:
+            fixture_store.save(endpoint, params, payload)
+    else:
+        print("An error occurred while attempting to retrieve data from the API.")
+        payload = empty
+
+    return payload
+
+
+def get_wsor_data(
+    endpoint,
+    state,
+    year,
+    month,
+    basin_type,
+    domain=API_DOMAIN,
+    cache_args=CACHE_ARGS,
+    force_refresh=False,
+):
+
+    labels = dict(endpoint=endpoint, state=state, basin_type=basin_type)
+    params = dict(state=state, pubMonth=month, pubYear=year, basinType=basin_type)
+    return fetch_json(
+        f"/wsor/{endpoint}",
+        params,
+        domain=domain,
+        cache_args=cache_args,
+        force_refresh=force_refresh,
+        empty={},
+        labels=labels,
+        lazy=True,
+    )
+
+
+def get_hierarchy(
+    state,
+    domain=API_DOMAIN,
+    cache_args=CACHE_ARGS,
+    force_refresh=False,
+    snapshot=True,
+):
+
+    if snapshot and not force_refresh:
+        hierarchy = snapshot_store.hierarchy(state)
+        if hierarchy is not None:
+            return hierarchy
+    return fetch_json(
+        "/basin/getParents",
+        dict(state=state, format="json"),
+        domain=domain,
+        cache_args=cache_args,
+        force_refresh=force_refresh,
+        empty={},
+        labels=dict(endpoint="getParents", state=state),
+    )
+
+
+def get_report_data(state, year, month, basin_type, force_refresh=False, snapshot=True):
+    if snapshot and not force_refresh:
+        report_data = snapshot_store.report_data(state, year, month, basin_type)
+        if report_data is not None:
+            station_index.update_later(state, basin_type, year, month, report_data)
+            return report_data
+    endpoints = dict(
+        fcst="getFcstData",
+        snow="getSnowData",
+        prec="getPrecData",
+        res="getResData",
+    )
+    report_data = {
+        table: get_wsor_data(
+            endpoint=endpoint,
+            state=state,
+            year=year,
+            month=month,
+            basin_type=basin_type,
+            force_refresh=force_refresh,
+        )
+        for table, endpoint in endpoints.items()
+    }
+    with timed("search_index", state=state, basin_type=basin_type):
+        station_index.update_later(state, basin_type, year, month, report_data)
+    return report_data
+
+
+disk_budget.payload_cache(payload_cache)
+disk_budget.http_cache(CACHE_ARGS["cache_name"], trim_http_cache)
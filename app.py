@@ -5,23 +5,68 @@ Created on Wed Apr  6 11:38:41 2022
 @author: Nick.Steele & beau.uriona
 """
 
+import gzip
+import tempfile
+from os import getenv, getcwd, path
+from random import random
+from functools import wraps
+from itertools import chain
+from time import perf_counter
+from hashlib import sha1
 from pytz import timezone
 from datetime import datetime as dt
-from flask import Flask, render_template, redirect, url_for, session, request
+from flask import (
+    Flask,
+    render_template,
+    redirect,
+    url_for,
+    session,
+    request,
+    jsonify,
+    abort,
+    send_file,
+    stream_with_context,
+    g,
+    send_from_directory,
+)
 from flask_session import Session
 from flask_wtf import FlaskForm
 from wtforms import SelectField, SubmitField, BooleanField
+import lazy_json
+from executor import cpu_executor, ExecutorBusy
+from upstream import upstream, set_lane, budget
+from snapshots import snapshot_store
+from cache_budget import disk_budget, stats as cache_stats
+from profiling import request_profiler, PROFILE_SAMPLE_RATE
+from metrics import (
+    registry,
+    stage_seconds,
+    timed,
+    set_labels,
+    clear_labels,
+    current_labels,
+)
+from constants import BASIN_STATES, BASIN_TYPES
+from api_client import get_report_data, get_hierarchy
 from utils import (
-    get_wsor_data,
-    get_hierarchy,
-    forecasts,
-    precipitation,
-    snowpack_sites,
-    reservoirs,
-    add_fcst_footer,
-    add_snow_footer,
-    add_prec_footer,
-    add_res_footer,
+    basin_report_tables,
+    basin_delta_tables,
+    cached_state_summary,
+    summary_deltas,
+    summary_rows,
+    prior_month,
+)
+from serializers import dumps, basin_tables, state_tables, TABLE_BUILDERS
+from search import station_index
+from exports import (
+    month_range,
+    month_count,
+    parse_month,
+    report_tables,
+    csv_header,
+    csv_text,
+    write_tables,
+    ParquetSink,
 )
 
 
@@ -31,11 +76,24 @@ app = Flask(
 
 app.secret_key = "super secret key"
 app.config["SESSION_TYPE"] = "filesystem"
+app.config["SESSION_FILE_DIR"] = getenv(
+    "SESSION_FILE_DIR", path.join(getcwd(), "flask_session")
+)
+app.config["PROFILING"] = getenv("PROFILING", "false").lower() in ("1", "true")
+app.config["PROFILE_SAMPLE_RATE"] = PROFILE_SAMPLE_RATE
+app.config["EXPORT_MAX_MONTHS"] = int(getenv("EXPORT_MAX_MONTHS", 36))
 # app.config["SESSION_PERMANENT"] = False
 Session(app)
+disk_budget.track_dir("sessions", app.config["SESSION_FILE_DIR"])
+_save_session = app.session_interface.save_session
+
+
+def save_session(*args, **kwargs):
+    with timed("session_write"):
+        return _save_session(*args, **kwargs)
 
-BASIN_STATES = ("AK", "AZ", "CA", "CO", "ID", "MT", "NM", "NV", "OR", "UT", "WA", "WY")
-BASIN_TYPES = ("major", "minor", "misc")
+
+app.session_interface.save_session = save_session
 
 
 class BasinForm(FlaskForm):
@@ -74,6 +132,25 @@ class BasinForm(FlaskForm):
     submit = SubmitField("Submit")
 
 
+def should_profile():
+    if not app.config["PROFILING"]:
+        return False
+    if request.headers.get("X-Profile") or request.args.get("profile"):
+        return True
+    return random() < app.config["PROFILE_SAMPLE_RATE"]
+
+
+def profiled(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not should_profile():
+            return view(*args, **kwargs)
+        with request_profiler.profile(f"{request.method} {request.full_path}"):
+            return view(*args, **kwargs)
+
+    return wrapper
+
+
 @app.errorhandler(500)
 def page_not_found(e):
     return render_template("500.html"), 500
@@ -84,7 +161,41 @@ def server_error(e):
     return render_template("404.html"), 404
 
 
+@app.before_request
+def start_request_timer():
+    clear_labels()
+    g.request_start = perf_counter()
+    # automated submits and static exports queue behind interactive users
+    batch = request.headers.get("X-Upstream-Lane") == "batch"
+    set_lane("batch" if batch or request.args.get("automate") else "interactive")
+
+
+@app.context_processor
+def export_flags():
+    # exported pages have no app behind them to follow the ?delta links
+    return dict(static_export=request.headers.get("X-Static-Export") == "1")
+
+
+@app.after_request
+def record_request_time(response):
+    stage_seconds.observe(
+        perf_counter() - g.request_start,
+        **{**current_labels(), "stage": "request", "route": str(request.endpoint)},
+    )
+    return response
+
+
+def session_payload(key):
+    # payloads sit in the session as their json body, msgpack can not encode
+    # a lazy payload and the body is far smaller than the decoded dicts
+    value = session.get(key)
+    if isinstance(value, bytes):
+        return lazy_json.loads(value)
+    return value
+
+
 @app.route("/", methods=("POST", "GET"))
+@profiled
 def pull_data():
     args = request.args
     scrape_request = False
@@ -100,44 +211,26 @@ def pull_data():
         year = form.year.data
         basin_type = form.btype.data
         refresh = form.refresh.data
+        set_labels(state=state, basin_type=basin_type)
         basin_hierarchy = {}
-        if basin_type == "minor":
-            basin_hierarchy = get_hierarchy(state=state, force_refresh=refresh)
-            basin_hierarchy = {
-                k.lower(): [i.lower() for i in v] for k, v in basin_hierarchy.items()
-            }
-        fcst_json = get_wsor_data(
-            endpoint="getFcstData",
-            state=state,
-            year=year,
-            month=month_digit,
-            basin_type=basin_type,
-            force_refresh=refresh,
-        )
-        snow_json = get_wsor_data(
-            endpoint="getSnowData",
-            state=state,
-            year=year,
-            month=month_digit,
-            basin_type=basin_type,
-            force_refresh=refresh,
-        )
-        prec_json = get_wsor_data(
-            endpoint="getPrecData",
-            state=state,
-            year=year,
-            month=month_digit,
-            basin_type=basin_type,
-            force_refresh=refresh,
-        )
-        res_json = get_wsor_data(
-            endpoint="getResData",
-            state=state,
-            year=year,
-            month=month_digit,
-            basin_type=basin_type,
-            force_refresh=refresh,
-        )
+        # upstream calls fall back to cached data once the budget is spent
+        with budget():
+            if basin_type == "minor":
+                basin_hierarchy = get_hierarchy(state=state, force_refresh=refresh)
+            report_data = get_report_data(
+                state=state,
+                year=year,
+                month=month_digit,
+                basin_type=basin_type,
+                force_refresh=refresh,
+            )
+        basin_hierarchy = {
+            k.lower(): [i.lower() for i in v] for k, v in basin_hierarchy.items()
+        }
+        fcst_json = report_data["fcst"]
+        snow_json = report_data["snow"]
+        prec_json = report_data["prec"]
+        res_json = report_data["res"]
 
         session["updated"] = f'{dt.now(tz=timezone("US/Pacific")):%x %X %Z}'
         session["state"] = state
@@ -146,98 +239,338 @@ def pull_data():
         session["basin_type"] = basin_type
         session["basins"] = [i.lower() for i in fcst_json.keys()]
         session["hierarchy"] = basin_hierarchy
-        session["fcst_json"] = fcst_json
-        session["snow_json"] = snow_json
-        session["prec_json"] = prec_json
-        session["res_json"] = res_json
+        session["fcst_json"] = lazy_json.dumps(fcst_json)
+        session["snow_json"] = lazy_json.dumps(snow_json)
+        session["prec_json"] = lazy_json.dumps(prec_json)
+        session["res_json"] = lazy_json.dumps(res_json)
+        # the rendered tables of a published snapshot match only its payloads
+        session["snapshot"] = snapshot_store.version_of(report_data)
 
         return redirect(url_for("wsor"))
     return render_template("index.html", form=form)
 
 
+@app.route("/metrics", methods=("GET",))
+def prometheus_metrics():
+    return app.response_class(registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/admin/profiles", methods=("GET",))
+def profile_list():
+    if not app.config["PROFILING"]:
+        abort(404)
+    return jsonify(request_profiler.slowest(request.args.get("n", 20, type=int)))
+
+
+@app.route("/admin/profiles/<filename>", methods=("GET",))
+def profile_download(filename):
+    if not app.config["PROFILING"]:
+        abort(404)
+    return send_from_directory(
+        request_profiler.profile_dir, filename, as_attachment=True
+    )
+
+
+@app.route("/stats/executor", methods=("GET",))
+def executor_stats():
+    return jsonify(cpu_executor.stats())
+
+
+@app.route("/stats/upstream", methods=("GET",))
+def upstream_stats():
+    return jsonify(upstream.stats())
+
+
+@app.route("/stats/cache", methods=("GET",))
+def cache_usage():
+    return jsonify(cache_stats(limit=request.args.get("limit", 20, type=int)))
+
+
+@app.route("/stats/snapshot", methods=("GET",))
+def snapshot_stats():
+    return jsonify(snapshot_store.stats())
+
+
+def json_response(payload):
+    body = dumps(payload)
+    response = app.response_class(body, mimetype="application/json")
+    response.vary.add("Accept-Encoding")
+    if "gzip" in request.accept_encodings and len(body) > 1024:
+        response.set_data(gzip.compress(body, mtime=0))
+        response.content_encoding = "gzip"
+    response.set_etag(sha1(response.get_data()).hexdigest())
+    return response.make_conditional(request)
+
+
+def api_report_data(state, basin_type):
+    state = state.upper()
+    basin_type = basin_type.lower()
+    if state not in BASIN_STATES or basin_type not in BASIN_TYPES:
+        abort(404)
+    today = dt.now()
+    year = request.args.get("year", today.year, type=int)
+    month = request.args.get("month", today.month, type=int)
+    with budget():
+        report_data = get_report_data(
+            state=state, year=year, month=month, basin_type=basin_type
+        )
+    meta = dict(state=state, basin_type=basin_type, year=year, month=month)
+    set_labels(state=state, basin_type=basin_type)
+    return meta, report_data
+
+
+@app.route("/api/<state>/<basin_type>", methods=("GET",))
+def api_state(state, basin_type):
+    meta, report_data = api_report_data(state, basin_type)
+    try:
+        basins = cpu_executor.run(state_tables, report_data)
+    except ExecutorBusy:
+        abort(503)
+    return json_response(dict(**meta, basins=basins))
+
+
+@app.route("/api/<state>/<basin_type>/<basin>", methods=("GET",))
+def api_basin(state, basin_type, basin):
+    meta, report_data = api_report_data(state, basin_type)
+    basin_keys = {i.lower(): i for i in report_data["fcst"].keys()}
+    if basin.lower() not in basin_keys:
+        abort(404)
+    basin = basin_keys[basin.lower()]
+    try:
+        tables = cpu_executor.run(basin_tables, basin, report_data)
+    except ExecutorBusy:
+        abort(503)
+    return json_response(dict(**meta, basin=basin, **tables))
+
+
+@app.route("/api/search", methods=("GET",))
+def api_search():
+    query = request.args.get("q", "")
+    limit = min(request.args.get("limit", 20, type=int), 200)
+    with timed("search"):
+        results = station_index.search(query, limit=limit)
+    return json_response(dict(query=query, results=results))
+
+
+def export_report_data(state, months, basin_types):
+    # fetched in the request, each month and basin type under its own budget
+    for year, month in months:
+        for basin_type in basin_types:
+            with budget():
+                report_data = get_report_data(
+                    state=state, year=year, month=month, basin_type=basin_type
+                )
+            yield year, month, basin_type, report_data
+
+
+def export_csv(state, months, basin_types, table):
+    header = csv_header(table)
+    for year, month, basin_type, report_data in export_report_data(
+        state, months, basin_types
+    ):
+        frames = report_tables(state, year, month, basin_type, report_data, [table])
+        yield header + cpu_executor.run(csv_text, frames)
+        header = ""
+
+
+@app.route("/export/<state>/<table>.<fmt>", methods=("GET",))
+def export_state_tables(state, table, fmt):
+    state = state.upper()
+    if state not in BASIN_STATES or table not in TABLE_BUILDERS:
+        abort(404)
+    today = dt.now()
+    this_month = f"{today.year}-{today.month}"
+    try:
+        start = parse_month(request.args.get("start", this_month))
+        end = parse_month(
+            request.args.get("end", request.args.get("start", this_month))
+        )
+    except ValueError:
+        abort(400, "start and end must be months as YYYY-MM")
+    max_months = app.config["EXPORT_MAX_MONTHS"]
+    if not 0 < month_count(start, end) <= max_months:
+        abort(400, f"exports cover 1 to {max_months} months, start to end")
+    months = list(month_range(start, end))
+    basin_types = request.args.getlist("btype") or list(BASIN_TYPES)
+    if any(i not in BASIN_TYPES for i in basin_types):
+        abort(404)
+    period = f"{start[0]}-{start[1]:02d}_{end[0]}-{end[1]:02d}"
+    filename = f"{state.lower()}_{table}_{period}"
+    if fmt == "csv":
+        chunks = export_csv(state, months, basin_types, table)
+        try:
+            # the first month is built here so a busy executor is still a 503
+            first = next(chunks, "")
+        except ExecutorBusy:
+            abort(503)
+        return app.response_class(
+            stream_with_context(chain([first], chunks)),
+            mimetype="text/csv",
+            headers={"Content-Disposition": f"attachment; filename={filename}.csv"},
+        )
+    if fmt == "parquet":
+        parquet_file = tempfile.TemporaryFile()
+        sink = ParquetSink(parquet_file, table)
+        try:
+            for year, month, basin_type, report_data in export_report_data(
+                state, months, basin_types
+            ):
+                frames = report_tables(
+                    state, year, month, basin_type, report_data, [table]
+                )
+                cpu_executor.run(write_tables, sink, frames)
+        except ExecutorBusy:
+            parquet_file.close()
+            abort(503)
+        sink.close()
+        if sink.writer is None:
+            parquet_file.close()
+            abort(404)
+        parquet_file.seek(0)
+        return send_file(
+            parquet_file,
+            mimetype="application/vnd.apache.parquet",
+            as_attachment=True,
+            download_name=f"{filename}.parquet",
+        )
+    abort(404)
+
+
 @app.route("/basins", methods=("POST", "GET"))
 def wsor():
     return render_template("basins.html")
 
 
+@app.route("/summary", methods=("GET",))
+def basin_summary():
+    state = session.get("state")
+    if state is None:
+        return redirect(url_for("pull_data"))
+    year = int(session["year"])
+    month = int(session["month_digit"])
+    basin_type = session["basin_type"]
+    set_labels(state=state, basin_type=basin_type)
+    delta = bool(request.args.get("delta"))
+    # one budget for the page, the prior month included
+    with budget():
+        report_data = get_report_data(
+            state=state, year=year, month=month, basin_type=basin_type
+        )
+        try:
+            summary = cpu_executor.run(
+                cached_state_summary, state, year, month, basin_type, report_data
+            )
+            if delta and not summary.empty:
+                prior_year, prior_month_digit = prior_month(year, month)
+                prior_data = get_report_data(
+                    state=state,
+                    year=prior_year,
+                    month=prior_month_digit,
+                    basin_type=basin_type,
+                )
+                prior_summary = cpu_executor.run(
+                    cached_state_summary,
+                    state,
+                    prior_year,
+                    prior_month_digit,
+                    basin_type,
+                    prior_data,
+                )
+                summary = summary_deltas(summary, prior_summary)
+        except ExecutorBusy:
+            return render_template("500.html"), 503
+    if summary.empty:
+        return render_template("404.html")
+    sort = request.args.get("sort", "Basin")
+    if sort in summary.columns:
+        summary = summary.sort_values(
+            sort,
+            ascending=request.args.get("order", "asc") != "desc",
+            na_position="last",
+            kind="stable",
+        )
+    with timed("render"):
+        return render_template(
+            "summary.html",
+            state=state,
+            basin_type=basin_type,
+            title=f"{dt(year, month, 1):%B, %Y}",
+            delta=delta,
+            columns=list(summary.columns),
+            rows=summary_rows(summary),
+        )
+
+
+@app.route("/search", methods=("GET",))
+def station_search():
+    query = request.args.get("q", "")
+    with timed("search"):
+        results = station_index.search(query, limit=50)
+    return render_template("search.html", query=query, results=results)
+
+
 @app.route("/<basin>", methods=("POST", "GET"))
+@profiled
 def basin_reports(basin):
 
-    fcst_json = session.get("fcst_json")
-    if not basin.lower() in [i.lower() for i in fcst_json.keys()]:
+    set_labels(state=session.get("state"), basin_type=session.get("basin_type"))
+    fcst_json = session_payload("fcst_json")
+    basin_keys = {i.lower(): i for i in fcst_json.keys()}
+    if not basin.lower() in basin_keys:
         return render_template("404.html")
-    snow_json = session.get("snow_json")
-    prec_json = session.get("prec_json")
-    res_json = session.get("res_json")
-    fcst = forecasts(basin, fcst_json)
-    snow = snowpack_sites(basin, snow_json)
-    prec = precipitation(basin, prec_json)
-    res = reservoirs(basin, res_json)
-
-    rendered = render_template(
-        "wsor.html",
-        basin_name=basin.lower(),
-        title=f"{dt(int(session['year']), int(session['month_digit']), 1):%B, %Y}",
-        fcst_df=[
-            None
-            if fcst.empty
-            else add_fcst_footer(
-                fcst.to_html(
-                    table_id="fcst",
-                    classes="table table-sm table-hover",
-                    justify="match-parent",
-                    na_rep="-",
-                    border=0,
-                    bold_rows=False,
+    basin = basin_keys[basin.lower()]
+    snow_json = session_payload("snow_json")
+    prec_json = session_payload("prec_json")
+    res_json = session_payload("res_json")
+    year = int(session["year"])
+    month = int(session["month_digit"])
+    title = f"{dt(year, month, 1):%B, %Y}"
+    delta = bool(request.args.get("delta"))
+    try:
+        if delta:
+            prior_year, prior_month_digit = prior_month(year, month)
+            # the prior month usually comes straight from the payload caches
+            with budget():
+                prior_data = get_report_data(
+                    state=session["state"],
+                    year=prior_year,
+                    month=prior_month_digit,
+                    basin_type=session["basin_type"],
                 )
+            current_data = dict(
+                fcst=fcst_json, snow=snow_json, prec=prec_json, res=res_json
             )
-        ],
-        res_df=[
-            None
-            if res.empty
-            else add_res_footer(
-                res_json[basin].get("basin_index", None),
-                res.to_html(
-                    table_id="res",
-                    classes="table table-sm table-hover",
-                    justify="match-parent",
-                    index=False,
-                    na_rep="-",
-                    border=0,
-                ),
-            )
-        ],
-        snow_df=[
-            None
-            if snow.empty
-            else add_snow_footer(
-                snow_json[basin].get("basin_index", None),
-                snow.to_html(
-                    table_id="snow",
-                    classes="table table-sm table-hover",
-                    justify="match-parent",
-                    index=False,
-                    na_rep="-",
-                    border=0,
-                ),
+            tables = cpu_executor.run(
+                basin_delta_tables, basin, current_data, prior_data
             )
-        ],
-        prec_df=[
-            None
-            if prec.empty
-            else add_prec_footer(
-                prec_json[basin].get("basin_index", None),
-                prec.to_html(
-                    table_id="prec",
-                    classes="table table-sm table-hover",
-                    justify="match-parent",
-                    index=False,
-                    na_rep="-",
-                    border=0,
-                ),
+            title = f"{title}, changes since {dt(prior_year, prior_month_digit, 1):%B}"
+        else:
+            tables = snapshot_store.basin_tables(
+                session.get("snapshot"), session["state"], session["basin_type"], basin
             )
-        ],
-    )
+            if tables is None:
+                tables = cpu_executor.run(
+                    basin_report_tables,
+                    basin,
+                    fcst_json,
+                    snow_json,
+                    prec_json,
+                    res_json,
+                )
+    except ExecutorBusy:
+        return render_template("500.html"), 503
+
+    with timed("render"):
+        rendered = render_template(
+            "wsor.html",
+            basin_name=basin.lower(),
+            title=title,
+            delta=delta,
+            fcst_df=[tables["fcst"]],
+            res_df=[tables["res"]],
+            snow_df=[tables["snow"]],
+            prec_df=[tables["prec"]],
+        )
 
     # =============================================================================
     #     options = {'page-size': 'Letter'}
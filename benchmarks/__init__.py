@@ -0,0 +1,4 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks, synthetic payloads and load testing tools for the wsor app.
+"""
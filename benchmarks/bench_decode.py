@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+"""
+Decode time and peak memory of wsor payloads, whole vs lazy per basin.
+
+A large synthetic state is serialized once and decoded the way the client
+used to, ``json.loads`` of the whole body, and with lazy_json, for one
+basin and for every basin. Peak memory is measured with tracemalloc in a
+separate pass so it does not slow the timings. Run from the repo root with
+``python -m benchmarks.bench_decode``.
+"""
+
+import gc
+import json
+import tracemalloc
+from unittest import mock
+
+import lazy_json
+from benchmarks.bench_tables import bench
+from benchmarks.synthetic import report_payloads
+
+
+def read_all(payload):
+    for basin in payload:
+        payload[basin]
+
+
+def decode_cases(body, basin):
+    def full_one():
+        return json.loads(body)[basin]
+
+    def full_all():
+        payload = json.loads(body)
+        read_all(payload)
+        return payload
+
+    def lazy_one():
+        return lazy_json.loads(body)[basin]
+
+    def lazy_all():
+        payload = lazy_json.loads(body)
+        read_all(payload)
+        return payload
+
+    def lazy_index():
+        return lazy_json.loads(body)
+
+    cases = dict(
+        full_one=full_one,
+        full_all=full_all,
+        lazy_index=lazy_index,
+        lazy_one=lazy_one,
+        lazy_all=lazy_all,
+    )
+    if lazy_json.HAVE_MSGSPEC:
+        # the stdlib scanner used when msgspec is not installed
+        for name in ("lazy_index", "lazy_one"):
+            cases[f"{name}_stdlib"] = lambda func=cases[name]: fallback(func)
+    return cases
+
+
+def fallback(func):
+    with mock.patch.object(lazy_json, "HAVE_MSGSPEC", False):
+        return func()
+
+
+def peak_memory(func):
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = func()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return current, peak
+
+
+def run(n_basins, n_sites, n_periods, repeat, tables):
+    payloads = report_payloads(n_basins=n_basins, n_sites=n_sites, n_periods=n_periods)
+    results = {}
+    for table in tables:
+        body = json.dumps(payloads[table], separators=(",", ":")).encode("utf-8")
+        basin = next(iter(payloads[table]))
+        print(f"{table}: {len(body) / 1e6:.2f} MB, {len(payloads[table])} basins")
+        print(f"  {'case':<20}{'time (ms)':>12}{'kept (MB)':>12}{'peak (MB)':>12}")
+        for name, func in decode_cases(body, basin).items():
+            seconds = bench(func, repeat=repeat)
+            kept, peak = peak_memory(func)
+            results[f"{table}_{name}"] = dict(seconds=seconds, kept=kept, peak=peak)
+            print(
+                f"  {name:<20}{1000 * seconds:>12.2f}"
+                f"{kept / 1e6:>12.2f}{peak / 1e6:>12.2f}"
+            )
+    return results
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    cli_desc = """
+    Benchmark decode time and peak memory of whole and lazy per basin
+    decoding of a large wsor payload
+    """
+    parser = argparse.ArgumentParser(description=cli_desc)
+    parser.add_argument("-b", "--basins", help="basins per state", default=80, type=int)
+    parser.add_argument("-s", "--sites", help="sites per basin", default=40, type=int)
+    parser.add_argument(
+        "-f", "--periods", help="forecast periods per site", default=4, type=int
+    )
+    parser.add_argument("-r", "--repeat", help="runs per case", default=10, type=int)
+    parser.add_argument(
+        "--tables",
+        help="payloads to decode",
+        nargs="+",
+        default=["fcst", "snow"],
+        choices=["fcst", "snow", "prec", "res"],
+    )
+    args = parser.parse_args()
+
+    print(
+        f"Benchmarking with basins={args.basins}, sites={args.sites}, "
+        f"periods={args.periods}..."
+    )
+    run(args.basins, args.sites, args.periods, args.repeat, args.tables)
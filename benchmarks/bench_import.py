@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+Import time benchmark for the cli tools and the modules workers load.
+
+Each module is imported in a fresh interpreter with ``python -X importtime``.
+The run fails when a module pulls in one of its forbidden heavy packages,
+i.e. pandas for the html export, or is slower than its baseline in
+benchmarks/import_baseline.json by more than the tolerance. Run from the
+repo root with ``python -m benchmarks.bench_import``.
+"""
+
+import sys
+import json
+import subprocess
+from os import path
+from statistics import median
+
+from benchmarks.bench_tables import compare
+
+THIS_DIR = path.dirname(path.realpath(__file__))
+ROOT_DIR = path.dirname(THIS_DIR)
+BASELINE_PATH = path.join(THIS_DIR, "import_baseline.json")
+
+HEAVY = ("pandas", "numpy", "flask", "flask_session", "flask_wtf", "wtforms")
+CASES = dict(
+    constants=HEAVY + ("requests", "requests_cache"),
+    api_client=HEAVY + ("requests_cache",),
+    generate_static=HEAVY + ("requests_cache",),
+    exports=("flask", "flask_session", "flask_wtf", "wtforms"),
+    app=(),
+)
+
+
+def import_time(module):
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT_DIR,
+        capture_output=True,
+        text=True,
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(f"importing {module} failed:\n{proc.stderr}")
+    imported, cumulative = set(), None
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, total, name = line.split("|")
+        name = name.strip()
+        imported.add(name)
+        if name == module:
+            cumulative = int(total) / 1e6
+    return cumulative, imported
+
+
+def run(repeat):
+    results, violations = {}, {}
+    for module, forbidden in CASES.items():
+        times = []
+        for _ in range(repeat):
+            seconds, imported = import_time(module)
+            times.append(seconds)
+        top_level = {name.split(".")[0] for name in imported}
+        pulled_in = sorted(set(forbidden) & top_level)
+        if pulled_in:
+            violations[module] = pulled_in
+        results[module] = median(times)
+        print(f"  {module:<24}{1000 * results[module]:>10.1f} ms")
+    return results, violations
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    cli_desc = """
+    Benchmark module import times and check the cli tools stay free of the
+    flask app and pandas
+    """
+    parser = argparse.ArgumentParser(description=cli_desc)
+    parser.add_argument(
+        "-r", "--repeat", help="imports per module", default=5, type=int
+    )
+    parser.add_argument(
+        "-t",
+        "--tolerance",
+        help="allowed slowdown vs the baseline, 0.5 is 50%% slower",
+        default=0.5,
+        type=float,
+    )
+    parser.add_argument("--baseline", help="baseline file", default=BASELINE_PATH)
+    parser.add_argument(
+        "--save", help="save results as the new baseline", action="store_true"
+    )
+    args = parser.parse_args()
+
+    print("Timing imports...")
+    results, violations = run(args.repeat)
+    for module, pulled_in in violations.items():
+        print(f"HEAVY IMPORT {module}: imports {', '.join(pulled_in)}")
+    if violations:
+        sys.exit(1)
+
+    if args.save:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(dict(results=results), baseline_file, indent=2)
+            baseline_file.write("\n")
+        print(f"Saved baseline to {args.baseline}")
+        sys.exit(0)
+
+    if not path.isfile(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save to create one")
+        sys.exit(0)
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    regressions = compare(results, baseline["results"], args.tolerance)
+    for name, before, after, ratio in regressions:
+        print(
+            f"REGRESSION {name}: {1000 * before:.1f} ms -> {1000 * after:.1f} ms "
+            f"({ratio:.2f}x)"
+        )
+    if regressions:
+        sys.exit(1)
+    print("No regressions against the baseline")
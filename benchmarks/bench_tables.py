@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""
+Timing benchmarks for the table builders, footers, stylers and page render.
+
+Run from the repo root with ``python -m benchmarks.bench_tables``. Results
+are compared to benchmarks/baseline.json and the run fails when a case is
+slower than its baseline by more than the tolerance, ``--save`` writes the
+current results as the new baseline.
+"""
+
+import sys
+import json
+import tempfile
+from os import path, chdir
+from statistics import median
+from time import perf_counter
+
+from benchmarks.synthetic import report_payloads, styler_inputs
+
+THIS_DIR = path.dirname(path.realpath(__file__))
+BASELINE_PATH = path.join(THIS_DIR, "baseline.json")
+
+
+def bench(func, setup=None, repeat=20, number=1):
+    times = []
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        start = perf_counter()
+        for _ in range(number):
+            func(*args)
+        times.append((perf_counter() - start) / number)
+    return median(times)
+
+
+def table_cases(payloads, basin):
+    import utils
+
+    builders = dict(
+        forecasts=("fcst", utils.forecasts),
+        snowpack_sites=("snow", utils.snowpack_sites),
+        precipitation=("prec", utils.precipitation),
+        reservoirs=("res", utils.reservoirs),
+    )
+    cases = {}
+    for name, (table, builder) in builders.items():
+        cases[name] = (
+            lambda builder=builder, table=table: builder(basin, payloads[table]),
+            None,
+        )
+
+    html = {}
+    for table, builder in (
+        ("fcst", utils.forecasts),
+        ("snow", utils.snowpack_sites),
+        ("prec", utils.precipitation),
+        ("res", utils.reservoirs),
+    ):
+        html[table] = utils.table_html(builder(basin, payloads[table]), table)
+    index = {t: payloads[t][basin].get("basin_index") for t in ("snow", "prec", "res")}
+    cases["add_fcst_footer"] = (lambda: utils.add_fcst_footer(html["fcst"]), None)
+    cases["add_snow_footer"] = (
+        lambda: utils.add_snow_footer(index["snow"], html["snow"]),
+        None,
+    )
+    cases["add_prec_footer"] = (
+        lambda: utils.add_prec_footer(index["prec"], html["prec"]),
+        None,
+    )
+    cases["add_res_footer"] = (
+        lambda: utils.add_res_footer(index["res"], html["res"]),
+        None,
+    )
+    cases["basin_report_tables"] = (
+        lambda: utils.basin_report_tables(
+            basin, *(payloads[t] for t in ("fcst", "snow", "prec", "res"))
+        ),
+        None,
+    )
+    return cases
+
+
+def styler_cases(n_sites, n_periods):
+    import style_functions
+
+    basin = "Major Basin 00"
+    bfcst, bres, bsnow, snowpack = styler_inputs(basin, n_sites, n_periods)
+    return dict(
+        style_fcst=(lambda: style_functions.style_fcst(bfcst, basin).to_html(), None),
+        style_res=(lambda: style_functions.style_res(bres, basin).to_html(), None),
+        style_snow=(lambda: style_functions.style_snow(bsnow, basin).to_html(), None),
+        style_snowpack=(
+            lambda: style_functions.style_snowpack(snowpack).to_html(),
+            None,
+        ),
+    )
+
+
+def render_case(payloads, basin):
+    # flask-session writes its files to the working directory
+    chdir(tempfile.mkdtemp(prefix="wsor_bench_"))
+    import lazy_json
+    from app import app
+
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess.update(
+            updated="",
+            state="OR",
+            month_digit=4,
+            year=2022,
+            basin_type="major",
+            basins=[i.lower() for i in payloads["fcst"].keys()],
+            hierarchy={},
+            **{f"{t}_json": lazy_json.dumps(payloads[t]) for t in payloads},
+        )
+
+    def render():
+        response = client.get(f"/{basin}")
+        assert response.status_code == 200, response.status_code
+
+    return dict(basin_reports=(render, None))
+
+
+def run(n_basins, n_sites, n_periods, repeat):
+    payloads = report_payloads(n_basins=n_basins, n_sites=n_sites, n_periods=n_periods)
+    basin = next(iter(payloads["fcst"]))
+    cases = {}
+    cases.update(table_cases(payloads, basin))
+    cases.update(styler_cases(n_sites, n_periods))
+    cases.update(render_case(payloads, basin))
+    results = {}
+    for name, (func, setup) in cases.items():
+        results[name] = bench(func, setup, repeat=repeat)
+        print(f"  {name:<24}{1000 * results[name]:>10.2f} ms")
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, seconds in results.items():
+        if name not in baseline:
+            continue
+        ratio = seconds / baseline[name]
+        if ratio > 1 + tolerance:
+            regressions.append((name, baseline[name], seconds, ratio))
+    return regressions
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    cli_desc = """
+    Benchmark the wsor table builders, stylers and page render against a
+    stored baseline
+    """
+    parser = argparse.ArgumentParser(description=cli_desc)
+    parser.add_argument("-b", "--basins", help="basins per state", default=10, type=int)
+    parser.add_argument("-s", "--sites", help="sites per basin", default=12, type=int)
+    parser.add_argument(
+        "-f", "--periods", help="forecast periods per site", default=3, type=int
+    )
+    parser.add_argument("-r", "--repeat", help="runs per case", default=20, type=int)
+    parser.add_argument(
+        "-t",
+        "--tolerance",
+        help="allowed slowdown vs the baseline, 0.5 is 50%% slower",
+        default=0.5,
+        type=float,
+    )
+    parser.add_argument("--baseline", help="baseline file", default=BASELINE_PATH)
+    parser.add_argument(
+        "--save", help="save results as the new baseline", action="store_true"
+    )
+    args = parser.parse_args()
+
+    params = dict(basins=args.basins, sites=args.sites, periods=args.periods)
+    print(f"Benchmarking with {params}...")
+    results = run(args.basins, args.sites, args.periods, args.repeat)
+
+    if args.save:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(dict(params=params, results=results), baseline_file, indent=2)
+            baseline_file.write("\n")
+        print(f"Saved baseline to {args.baseline}")
+        sys.exit(0)
+
+    if not path.isfile(args.baseline):
+        print(f"No baseline at {args.baseline}, run with --save to create one")
+        sys.exit(0)
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    if baseline["params"] != params:
+        print(f"Baseline was recorded with {baseline['params']}, not comparing")
+        sys.exit(0)
+    regressions = compare(results, baseline["results"], args.tolerance)
+    for name, before, after, ratio in regressions:
+        print(
+            f"REGRESSION {name}: {1000 * before:.2f} ms -> {1000 * after:.2f} ms "
+            f"({ratio:.2f}x)"
+        )
+    if regressions:
+        sys.exit(1)
+    print("No regressions against the baseline")
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the /wsor/* and /basin/* endpoints of API_SERVER.
+
+Serves synthetic payloads, or payloads recorded with FIXTURE_MODE=record
+when a fixture directory is given, with optional latency and error
+injection. Responses carry an ETag and Last-Modified and answer conditional
+requests with 304 unless FAKE_VALIDATORS=0, which leaves the client to
+compare bodies. Run it directly for the flask dev server or under gunicorn, i.e.
+``gunicorn -k gevent "benchmarks.fake_api:app"``, with the settings below
+taken from the environment.
+"""
+
+import random
+from time import sleep, time
+from os import getenv
+from functools import lru_cache
+
+from flask import Flask, request, jsonify, abort
+
+from fixtures import FixtureStore, FixtureMiss
+from benchmarks.synthetic import report_payloads, hierarchy_payload, basins_payload
+
+WSOR_TABLES = dict(
+    getFcstData="fcst",
+    getSnowData="snow",
+    getPrecData="prec",
+    getResData="res",
+)
+
+app = Flask(__name__)
+app.config.update(
+    LATENCY=float(getenv("FAKE_LATENCY", 0)),
+    JITTER=float(getenv("FAKE_JITTER", 0)),
+    ERROR_RATE=float(getenv("FAKE_ERROR_RATE", 0)),
+    RECORDINGS=getenv("FAKE_RECORDINGS", None),
+    BASINS=int(getenv("FAKE_BASINS", 10)),
+    SITES=int(getenv("FAKE_SITES", 12)),
+    PERIODS=int(getenv("FAKE_PERIODS", 3)),
+    VALIDATORS=getenv("FAKE_VALIDATORS", "1") != "0",
+)
+STARTED = time()
+
+
+def recorded():
+    recordings = app.config["RECORDINGS"]
+    if not recordings:
+        return None
+    try:
+        return FixtureStore(recordings, "replay").load(
+            request.path, request.args.to_dict()
+        )
+    except FixtureMiss:
+        return None
+
+
+@lru_cache(maxsize=256)
+def synthetic(state, basin_type, year, month):
+    return report_payloads(
+        state=state,
+        basin_type=basin_type,
+        n_basins=app.config["BASINS"],
+        n_sites=app.config["SITES"],
+        n_periods=app.config["PERIODS"],
+        year=year,
+        month=month,
+    )
+
+
+@app.before_request
+def inject_faults():
+    latency = app.config["LATENCY"] + random.uniform(0, app.config["JITTER"])
+    if latency > 0:
+        sleep(latency)
+    if random.random() < app.config["ERROR_RATE"]:
+        abort(500)
+
+
+def payload_response(payload):
+    response = jsonify(payload)
+    if not app.config["VALIDATORS"]:
+        return response
+    response.add_etag()
+    response.last_modified = STARTED
+    return response.make_conditional(request)
+
+
+@app.route("/wsor/<endpoint>")
+def wsor_data(endpoint):
+    if endpoint not in WSOR_TABLES:
+        abort(404)
+    payload = recorded()
+    if payload is None:
+        state = request.args.get("state", "OR")
+        basin_type = request.args.get("basinType", "major")
+        year = request.args.get("pubYear", 2022, type=int)
+        month = request.args.get("pubMonth", 1, type=int)
+        payload = synthetic(state, basin_type, year, month)[WSOR_TABLES[endpoint]]
+    return payload_response(payload)
+
+
+@app.route("/basin/getParents")
+def basin_parents():
+    payload = recorded()
+    if payload is None:
+        payload = hierarchy_payload(n_majors=app.config["BASINS"])
+    return payload_response(payload)
+
+
+@app.route("/basin/getBasins")
+def basin_list():
+    payload = recorded()
+    if payload is None:
+        btype = request.args.get("type", "")
+        basin_type = "misc" if btype.endswith("3") else "major"
+        payload = basins_payload(app.config["BASINS"], basin_type)
+    return payload_response(payload)
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    cli_desc = """
+    Serve a local stand-in for the snowdata wsor api
+    """
+    parser = argparse.ArgumentParser(description=cli_desc)
+    parser.add_argument("-p", "--port", help="port", default=8041, type=int)
+    parser.add_argument("-l", "--latency", help="added latency (s)", type=float)
+    parser.add_argument("-j", "--jitter", help="random extra latency (s)", type=float)
+    parser.add_argument("-e", "--error-rate", help="share of 500s", type=float)
+    parser.add_argument("-r", "--recordings", help="recorded fixture directory")
+    parser.add_argument(
+        "--no-validators",
+        help="send no ETag or Last-Modified and ignore conditional headers",
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    for key, value in dict(
+        LATENCY=args.latency,
+        JITTER=args.jitter,
+        ERROR_RATE=args.error_rate,
+        RECORDINGS=args.recordings,
+        VALIDATORS=False if args.no_validators else None,
+    ).items():
+        if value is not None:
+            app.config[key] = value
+
+    app.run(host="0.0.0.0", port=args.port, threaded=True)
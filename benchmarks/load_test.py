@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+End to end load test of the wsor app against the local stand-in api.
+
+Starts benchmarks.fake_api and the app under gunicorn with gevent workers,
+then drives the form submit and basin page flows with concurrent virtual
+users and reports throughput and p50/p95/p99 latency for each flow. Run
+from the repo root with ``python -m benchmarks.load_test``.
+"""
+
+import sys
+import socket
+import tempfile
+import subprocess
+from os import environ, path
+from time import perf_counter, sleep
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ROOT_DIR = path.dirname(path.dirname(path.realpath(__file__)))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=30):
+    deadline = perf_counter() + timeout
+    while perf_counter() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            sleep(0.1)
+    raise TimeoutError(f"nothing listening on port {port} after {timeout}s")
+
+
+def gunicorn(app_path, port, workers, env, cwd):
+    cmd = [
+        sys.executable,
+        "-m",
+        "gunicorn",
+        "-w",
+        str(workers),
+        "-k",
+        "gevent",
+        "--timeout",
+        "120",
+        "-b",
+        f"127.0.0.1:{port}",
+        "--pythonpath",
+        ROOT_DIR,
+        "--log-level",
+        "warning",
+        app_path,
+    ]
+    return subprocess.Popen(cmd, env={**environ, **env}, cwd=cwd)
+
+
+def percentile(values, pct):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, round(pct / 100 * len(values)) - 1))
+    return values[index]
+
+
+def virtual_user(base_url, user_no, deadline, args, basins):
+    timings = dict(submit=[], basin_page=[])
+    errors = dict(submit=0, basin_page=0)
+    state = args.states[user_no % len(args.states)]
+    with requests.Session() as sesh:
+        while perf_counter() < deadline:
+            data = dict(
+                state=state,
+                month=args.month,
+                year=args.year,
+                btype="major",
+                refresh="y" if args.refresh else "",
+            )
+            start = perf_counter()
+            resp = sesh.post(
+                f"{base_url}/?automate=true", data=data, allow_redirects=False
+            )
+            timings["submit"].append(perf_counter() - start)
+            if resp.status_code != 302:
+                errors["submit"] += 1
+                continue
+            for page_no in range(args.pages):
+                basin = basins[(user_no + page_no) % len(basins)]
+                start = perf_counter()
+                resp = sesh.get(f"{base_url}/{basin.lower()}")
+                timings["basin_page"].append(perf_counter() - start)
+                if not resp.ok:
+                    errors["basin_page"] += 1
+    return timings, errors
+
+
+def run(args):
+    from benchmarks.synthetic import basin_names
+
+    tmp_dir = tempfile.mkdtemp(prefix="wsor_load_")
+    api_port, app_port = free_port(), free_port()
+    api_env = dict(
+        FAKE_LATENCY=str(args.latency),
+        FAKE_JITTER=str(args.jitter),
+        FAKE_ERROR_RATE=str(args.error_rate),
+        FAKE_BASINS=str(args.basins),
+        FAKE_SITES=str(args.sites),
+    )
+    app_env = dict(
+        API_SERVER=f"http://127.0.0.1:{api_port}",
+        SHARED_CACHE_PATH=path.join(tmp_dir, "shared_cache.db"),
+        CACHE_PATH=path.join(tmp_dir, "cache.db"),
+        # a run neither shares the rate limit and search index of a local app
+        # nor serves its published snapshots
+        UPSTREAM_DB_PATH=path.join(tmp_dir, "upstream.db"),
+        SEARCH_INDEX_PATH=path.join(tmp_dir, "station_index.json.gz"),
+        SNAPSHOT_DIR=path.join(tmp_dir, "snapshots"),
+        PROFILE_DIR=path.join(tmp_dir, "profiles"),
+    )
+    servers = [
+        gunicorn(
+            "benchmarks.fake_api:app", api_port, args.api_workers, api_env, ROOT_DIR
+        ),
+        gunicorn("app:app", app_port, args.workers, app_env, tmp_dir),
+    ]
+    try:
+        wait_for_port(api_port)
+        wait_for_port(app_port)
+        base_url = f"http://127.0.0.1:{app_port}"
+        basins = basin_names(args.basins, "major")
+        print(
+            f"Running {args.users} users for {args.duration}s against "
+            f"{args.workers} worker(s)..."
+        )
+        start = perf_counter()
+        deadline = start + args.duration
+        with ThreadPoolExecutor(max_workers=args.users) as pool:
+            futures = [
+                pool.submit(virtual_user, base_url, i, deadline, args, basins)
+                for i in range(args.users)
+            ]
+            results = [f.result() for f in futures]
+        elapsed = perf_counter() - start
+    finally:
+        for server in servers:
+            server.terminate()
+        for server in servers:
+            server.wait()
+
+    report = {}
+    for flow in ("submit", "basin_page"):
+        times = [t for timings, _ in results for t in timings[flow]]
+        errors = sum(e[flow] for _, e in results)
+        report[flow] = dict(
+            requests=len(times),
+            errors=errors,
+            throughput=len(times) / elapsed,
+            p50=percentile(times, 50),
+            p95=percentile(times, 95),
+            p99=percentile(times, 99),
+        )
+    return report
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    cli_desc = """
+    Load test the wsor app under gunicorn/gevent against the local stand-in api
+    """
+    parser = argparse.ArgumentParser(description=cli_desc)
+    parser.add_argument("-u", "--users", help="concurrent users", default=10, type=int)
+    parser.add_argument("-d", "--duration", help="seconds", default=30, type=float)
+    parser.add_argument("-w", "--workers", help="app workers", default=1, type=int)
+    parser.add_argument("--api-workers", help="fake api workers", default=2, type=int)
+    parser.add_argument("-p", "--pages", help="pages per submit", default=5, type=int)
+    parser.add_argument("-b", "--basins", help="basins per state", default=10, type=int)
+    parser.add_argument("-s", "--sites", help="sites per basin", default=12, type=int)
+    parser.add_argument(
+        "-l", "--latency", help="api latency (s)", default=0.2, type=float
+    )
+    parser.add_argument(
+        "-j", "--jitter", help="api jitter (s)", default=0.1, type=float
+    )
+    parser.add_argument("-e", "--error-rate", help="api 500s", default=0.0, type=float)
+    parser.add_argument("--states", help="states to submit", default="OR,ID,WA,MT")
+    parser.add_argument("--month", default=4, type=int)
+    parser.add_argument("--year", default=2022, type=int)
+    parser.add_argument(
+        "--refresh", help="force a data refresh on each submit", action="store_true"
+    )
+    args = parser.parse_args()
+    args.states = args.states.split(",")
+
+    report = run(args)
+    print(
+        f"\n{'flow':<12}{'requests':>10}{'errors':>8}{'req/s':>10}"
+        f"{'p50 (ms)':>10}{'p95 (ms)':>10}{'p99 (ms)':>10}"
+    )
+    for flow, stats in report.items():
+        print(
+            f"{flow:<12}{stats['requests']:>10}{stats['errors']:>8}"
+            f"{stats['throughput']:>10.1f}{1000 * stats['p50']:>10.0f}"
+            f"{1000 * stats['p95']:>10.0f}{1000 * stats['p99']:>10.0f}"
+        )
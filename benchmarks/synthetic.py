@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic WSOR payloads shaped like the /wsor/* and /basin/* API responses.
+
+Payloads are deterministic for a given seed so benchmark runs and the local
+stand-in API always see the same data.
+"""
+
+import random
+
+FCST_PERIODS = ["APR-JUL", "APR-SEP", "MAY-JUL", "JUN-JUL", "MAR-JUL", "JAN-JUL"]
+SNOW_NETWORKS = ["SNTL", "SNTL", "SNTL", "SNOW", "MSNT"]
+PREC_NETWORKS = ["SNTL", "COOP", "SNTL"]
+NAME_WORDS = [
+    "Bear",
+    "Cedar",
+    "Creek",
+    "Divide",
+    "Elk",
+    "Grouse",
+    "Lake",
+    "Meadow",
+    "Mill",
+    "Mountain",
+    "Pass",
+    "Peak",
+    "Ridge",
+    "Saddle",
+    "Summit",
+    "Trail",
+]
+
+
+def _maybe(rng, value, missing=0.05):
+    return None if rng.random() < missing else value
+
+
+def _site_meta(rng, state, basin_no, n_sites, networks, offset):
+    meta = {}
+    for site_no in range(n_sites):
+        station_id = 1000 + offset + basin_no * n_sites + site_no
+        network = rng.choice(networks)
+        triplet = f"{station_id}:{state}:{network}"
+        name = " ".join(rng.sample(NAME_WORDS, 2))
+        meta[triplet] = dict(
+            stationTriplet=triplet,
+            name=f"{name} {station_id}",
+            elevation=round(rng.uniform(1500, 11000)),
+            network=network,
+        )
+    return meta
+
+
+def basin_names(n_basins, basin_type="major"):
+    return [f"{basin_type.title()} Basin {i:02d}" for i in range(n_basins)]
+
+
+def fcst_payload(rng, state, basins, n_sites, n_periods, exceedances="5"):
+    low, high = ("5", "95") if exceedances == "5" else ("10", "90")
+    periods = FCST_PERIODS[:n_periods]
+    payload = {}
+    for basin_no, basin in enumerate(basins):
+        meta = _site_meta(rng, state, basin_no, n_sites, ["USGS"], 50000)
+        fcst_curr, fcst_med = {}, {}
+        for triplet in meta:
+            fcst_curr[triplet] = {}
+            fcst_med[triplet] = {}
+            for period in periods:
+                median = rng.uniform(5, 2000)
+                fifty = median * rng.uniform(0.4, 1.6)
+                fcst_curr[triplet][period] = {
+                    low: round(fifty * 0.55, 1),
+                    "30": round(fifty * 0.8, 1),
+                    "50": round(fifty, 1),
+                    "70": round(fifty * 1.2, 1),
+                    high: round(fifty * 1.5, 1),
+                }
+                fcst_med[triplet][period] = _maybe(rng, round(median, 1))
+        payload[basin] = dict(site_meta=meta, fcst_curr=fcst_curr, fcst_med=fcst_med)
+    return payload
+
+
+def _series(rng, triplets, low, high, missing=0.05):
+    return {t: _maybe(rng, round(rng.uniform(low, high), 1), missing) for t in triplets}
+
+
+def _per_med(rng):
+    return _maybe(rng, round(rng.uniform(40, 160)), 0.1)
+
+
+def snow_payload(rng, state, basins, n_sites):
+    payload = {}
+    for basin_no, basin in enumerate(basins):
+        meta = _site_meta(rng, state, basin_no, n_sites, SNOW_NETWORKS, 10000)
+        triplets = list(meta)
+        payload[basin] = dict(
+            site_meta=meta,
+            wteq_curr=_series(rng, triplets, 0, 60),
+            snwd_curr=_series(rng, triplets, 0, 150),
+            wteq_ly=_series(rng, triplets, 0, 60),
+            wteq_med=_series(rng, triplets, 0, 60),
+            basin_index=dict(
+                wteq_curr_per_med=_per_med(rng), wteq_ly_per_med=_per_med(rng)
+            ),
+        )
+    return payload
+
+
+def prec_payload(rng, state, basins, n_sites):
+    payload = {}
+    for basin_no, basin in enumerate(basins):
+        meta = _site_meta(rng, state, basin_no, n_sites, PREC_NETWORKS, 20000)
+        triplets = list(meta)
+        payload[basin] = dict(
+            site_meta=meta,
+            prec_mnth_curr=_series(rng, triplets, 0, 12),
+            prec_mnth_ly=_series(rng, triplets, 0, 12),
+            prec_mnth_med=_series(rng, triplets, 0, 12),
+            prec_ytd_curr=_series(rng, triplets, 5, 80),
+            prec_ytd_ly=_series(rng, triplets, 5, 80),
+            prec_ytd_med=_series(rng, triplets, 5, 80),
+            basin_index=dict(
+                prec_mnth_curr_per_med=_per_med(rng),
+                prec_mnth_ly_per_med=_per_med(rng),
+                prec_ytd_curr_per_med=_per_med(rng),
+                prec_ytd_ly_per_med=_per_med(rng),
+            ),
+        )
+    return payload
+
+
+def res_payload(rng, state, basins, n_sites):
+    payload = {}
+    for basin_no, basin in enumerate(basins):
+        meta = _site_meta(rng, state, basin_no, max(n_sites // 3, 1), ["BOR"], 30000)
+        triplets = list(meta)
+        capacity = {t: round(rng.uniform(10, 3000), 1) for t in triplets}
+        payload[basin] = dict(
+            site_meta=meta,
+            res_curr={
+                t: _maybe(rng, round(c * rng.uniform(0.1, 1), 1))
+                for t, c in capacity.items()
+            },
+            res_ly={
+                t: _maybe(rng, round(c * rng.uniform(0.1, 1), 1))
+                for t, c in capacity.items()
+            },
+            res_med={
+                t: _maybe(rng, round(c * rng.uniform(0.3, 0.9), 1))
+                for t, c in capacity.items()
+            },
+            res_cap=capacity,
+            basin_index=dict(
+                res_curr_per_cap=_per_med(rng),
+                res_ly_per_cap=_per_med(rng),
+                res_med_per_cap=_per_med(rng),
+                res_curr_per_med=_per_med(rng),
+                res_ly_per_med=_per_med(rng),
+            ),
+        )
+    return payload
+
+
+def report_payloads(
+    state="OR",
+    basin_type="major",
+    n_basins=10,
+    n_sites=12,
+    n_periods=3,
+    year=2022,
+    month=4,
+    seed=0,
+):
+    rng = random.Random(f"{seed}-{state}-{basin_type}-{year}-{month}")
+    basins = basin_names(n_basins, basin_type)
+    return dict(
+        fcst=fcst_payload(rng, state, basins, n_sites, n_periods),
+        snow=snow_payload(rng, state, basins, n_sites),
+        prec=prec_payload(rng, state, basins, n_sites),
+        res=res_payload(rng, state, basins, n_sites),
+    )
+
+
+def hierarchy_payload(n_majors=5, minors_per_major=3):
+    return {
+        major: [f"{major} Minor {i:02d}" for i in range(minors_per_major)]
+        for major in basin_names(n_majors, "major")
+    }
+
+
+def basins_payload(n_basins=10, basin_type="misc"):
+    return [dict(name=name) for name in basin_names(n_basins, basin_type)]
+
+
+def styler_inputs(basin="Major Basin 00", n_sites=12, n_periods=3, seed=0):
+    rng = random.Random(seed)
+    n_rows = n_sites * n_periods
+    bfcst = {
+        basin: {
+            i: [round(rng.uniform(1, 500), 1) for _ in range(n_rows)] for i in range(9)
+        }
+    }
+    bres = {
+        basin: {
+            basin: [f"Reservoir {i}" for i in range(n_sites + 3)],
+            "Current (KAF)": [rng.uniform(1, 900) for _ in range(n_sites + 3)],
+            "Last Year (KAF)": [rng.uniform(1, 900) for _ in range(n_sites + 3)],
+            "Median (KAF)": [rng.uniform(1, 900) for _ in range(n_sites + 3)],
+            "Current % Median": [
+                f"{rng.randint(20, 150)}%" for _ in range(n_sites + 3)
+            ],
+            "Capacity (KAF)": [rng.uniform(900, 2000) for _ in range(n_sites + 3)],
+        }
+    }
+    bsnow = {
+        basin: {
+            basin: [f"Site {i}" for i in range(n_sites + 3)],
+            "Network": [rng.choice(SNOW_NETWORKS) for _ in range(n_sites + 3)],
+            "Elevation (ft)": [rng.uniform(2000, 9000) for _ in range(n_sites + 3)],
+            "Depth (in)": [rng.uniform(0, 100) for _ in range(n_sites + 3)],
+            "SWE (in)": [rng.uniform(0, 40) for _ in range(n_sites + 3)],
+            "Median (in)": [rng.uniform(0, 40) for _ in range(n_sites + 3)],
+            "Last Year SWE (in)": [rng.uniform(0, 40) for _ in range(n_sites + 3)],
+            "% Median": [f"{rng.randint(20, 150)}%" for _ in range(n_sites + 3)],
+        }
+    }
+    snowpack = {
+        "basin": [f"Basin {i}" for i in range(n_sites)],
+        "sites": [rng.randint(1, 20) for _ in range(n_sites)],
+        "per_med": [f"{rng.randint(20, 150)}%" for _ in range(n_sites)],
+        "ly_per_med": [f"{rng.randint(20, 150)}%" for _ in range(n_sites)],
+    }
+    return bfcst, bres, bsnow, snowpack
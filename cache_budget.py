@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+"""
+Memory and disk budgets shared by the app's caches.
+
+Every in-process cache that registers with memory_budget keeps the
+approximate size and the recompute cost, in seconds, of each entry. When
+the total goes over MEMORY_BUDGET_MB the entries with the lowest cost per
+byte are evicted first, across all caches, with the GreedyDual-Size clock
+so entries that have not been used for a while lose their cost advantage.
+Each cache keeps its own count limit too.
+
+disk_budget measures the shared payload cache and the requests_cache store
+against DISK_BUDGET_MB. Over budget it purges expired rows first and then
+shrinks the shared payload cache by cost per byte, the requests_cache store
+only holds http bodies that are also kept in the payload cache and is
+emptied last. The session files and published snapshots are reported too
+but not counted against the budget, nothing here can evict them.
+"""
+
+import sys
+import sqlite3
+import threading
+from time import monotonic
+from os import getenv, path, scandir
+
+from metrics import registry
+from executor import native_lock
+
+MEMORY_BUDGET_MB = float(getenv("MEMORY_BUDGET_MB", 512))
+DISK_BUDGET_MB = float(getenv("DISK_BUDGET_MB", 2048))
+DISK_CHECK_INTERVAL = float(getenv("DISK_CHECK_INTERVAL", 60))
+# recompute cost of entries cached without a measured one
+DEFAULT_COST = 0.01
+
+cache_bytes = registry.gauge("wsor_cache_bytes", "Approximate bytes held by each cache")
+evictions = registry.counter(
+    "wsor_cache_evictions_total", "Cache entries evicted to stay within a budget"
+)
+
+
+def approx_size(value, _depth=0):
+    # python objects, not serialized size, good enough to rank entries
+    size = getattr(value, "approx_size", None)
+    if size is not None:
+        return size() if callable(size) else size
+    if hasattr(value, "memory_usage"):
+        # pandas objects, checked by attribute so pandas is not imported here
+        return int(value.memory_usage(deep=True).sum())
+    if hasattr(value, "nbytes"):
+        return int(value.nbytes)
+    size = sys.getsizeof(value)
+    if _depth > 32:
+        return size
+    if isinstance(value, dict):
+        return size + sum(
+            approx_size(k, _depth + 1) + approx_size(v, _depth + 1)
+            for k, v in value.items()
+        )
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return size + sum(approx_size(i, _depth + 1) for i in value)
+    return size
+
+
+def dir_size(dir_path):
+    total = 0
+    try:
+        entries = list(scandir(dir_path))
+    except OSError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                total += dir_size(entry.path)
+            else:
+                total += entry.stat(follow_symlinks=False).st_size
+        except OSError:
+            pass
+    return total
+
+
+def sqlite_size(db_path):
+    # pages in use including those still in the wal, freed pages are reused
+    # by later writes
+    if not path.isfile(db_path):
+        return 0
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, timeout=5)
+    try:
+        page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+        pages = conn.execute("PRAGMA page_count").fetchone()[0]
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    except sqlite3.Error:
+        return path.getsize(db_path)
+    finally:
+        conn.close()
+    return (pages - free) * page_size
+
+
+class MemoryBudget:
+    """
+    Byte budget over the registered caches.
+
+    A cache implements nbytes, budget_entries() yielding (key, size, cost,
+    priority) and evict(key), and calls enforce() after adding an entry.
+    """
+
+    def __init__(self, limit_mb=MEMORY_BUDGET_MB):
+        self.limit = int(limit_mb * 1024 * 1024)
+        self.clock = 0.0
+        self._caches = {}
+        self._lock = native_lock()
+
+    def register(self, name, cache):
+        self._caches[name] = cache
+        return self
+
+    def priority(self, cost, size):
+        if cost is None:
+            cost = DEFAULT_COST
+        return self.clock + cost / max(size, 1)
+
+    @property
+    def nbytes(self):
+        return sum(cache.nbytes for cache in self._caches.values())
+
+    def usage(self):
+        usage = {name: cache.nbytes for name, cache in self._caches.items()}
+        for name, nbytes in usage.items():
+            cache_bytes.set(nbytes, cache=name)
+        return usage
+
+    def entries(self):
+        for name, cache in list(self._caches.items()):
+            for key, size, cost, priority in cache.budget_entries():
+                yield dict(cache=name, key=key, size=size, cost=cost, priority=priority)
+
+    def enforce(self):
+        if self.limit <= 0 or self.nbytes <= self.limit:
+            return 0
+        evicted = 0
+        with self._lock:
+            over = self.nbytes - self.limit
+            for entry in sorted(self.entries(), key=lambda e: e["priority"]):
+                if over <= 0:
+                    break
+                if self._caches[entry["cache"]].evict(entry["key"]):
+                    over -= entry["size"]
+                    evicted += 1
+                    self.clock = max(self.clock, entry["priority"])
+                    evictions.inc(cache=entry["cache"], budget="memory")
+        self.usage()
+        return evicted
+
+    def largest(self, limit=20):
+        return sorted(self.entries(), key=lambda e: e["size"], reverse=True)[:limit]
+
+    def stats(self, limit=20):
+        usage = self.usage()
+        return dict(
+            limit=self.limit,
+            used=sum(usage.values()),
+            caches=usage,
+            largest=[dict(e, key=str(e["key"])) for e in self.largest(limit)],
+        )
+
+
+class DiskBudget:
+    def __init__(self, limit_mb=DISK_BUDGET_MB, interval=DISK_CHECK_INTERVAL):
+        self.limit = int(limit_mb * 1024 * 1024)
+        self.interval = interval
+        self._checked = None
+        self._sqlite = {}
+        self._dirs = {}
+        self._shrinkable = None
+        self._http_cache = None
+        self._lock = threading.Lock()
+
+    def track_sqlite(self, name, db_path):
+        self._sqlite[name] = db_path
+        return self
+
+    def track_dir(self, name, dir_path):
+        # reported only, the directory is not counted against the limit
+        self._dirs[name] = dir_path
+        return self
+
+    def payload_cache(self, cache):
+        # a SharedCache, shrunk by cost per byte when over budget
+        self._shrinkable = cache
+        return self.track_sqlite("shared_cache", cache.db_path)
+
+    def http_cache(self, db_path, trim):
+        # trim(expired=True) drops expired responses, expired=False all of them
+        self._http_cache = trim
+        return self.track_sqlite("http_cache", db_path)
+
+    def usage(self, dirs=True):
+        usage = {name: sqlite_size(p) for name, p in self._sqlite.items()}
+        if dirs:
+            usage.update((name, dir_size(p)) for name, p in self._dirs.items())
+        for name, nbytes in usage.items():
+            cache_bytes.set(nbytes, cache=name)
+        return usage
+
+    def maybe_enforce(self):
+        checked = self._checked
+        if checked is not None and monotonic() - checked < self.interval:
+            return 0
+        self._checked = monotonic()
+        return self.enforce()
+
+    def _over(self):
+        return sum(self.usage(dirs=False).values()) - self.limit
+
+    def enforce(self):
+        shared, http = self._shrinkable, self._http_cache
+        with self._lock:
+            if self.limit <= 0 or self._over() <= 0:
+                return 0
+            evicted = 0
+            if shared is not None:
+                evicted += shared.purge_expired()
+            if http is not None:
+                http(expired=True)
+            over = self._over()
+            if over > 0 and shared is not None:
+                # the stored payload bytes dropped free about as many pages
+                evicted += shared.shrink(over)
+                over = self._over()
+            if over > 0 and http is not None:
+                http(expired=False)
+            if evicted:
+                evictions.inc(evicted, cache="shared_cache", budget="disk")
+            return evicted
+
+    def stats(self, limit=20):
+        usage = self.usage()
+        largest = []
+        if self._shrinkable is not None:
+            largest = self._shrinkable.largest(limit)
+        return dict(
+            limit=self.limit,
+            used=sum(usage[name] for name in self._sqlite),
+            unbudgeted=sum(usage[name] for name in self._dirs),
+            caches=usage,
+            largest=largest,
+        )
+
+
+memory_budget = MemoryBudget()
+disk_budget = DiskBudget()
+
+
+def stats(limit=20):
+    return dict(
+        memory=memory_budget.stats(limit),
+        disk=disk_budget.stats(limit),
+    )
+
+
+if __name__ == "__main__":
+
+    print("This module keeps the app's caches within memory and disk budgets")
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+"""
+Settings shared by the app, the data layer and the cli tools.
+
+Kept free of heavy imports so short lived export processes can read them
+without building the flask app or loading pandas.
+"""
+
+from datetime import timedelta
+from os import getenv, path
+
+BASIN_STATES = ("AK", "AZ", "CA", "CO", "ID", "MT", "NM", "NV", "OR", "UT", "WA", "WY")
+BASIN_TYPES = ("major", "minor", "misc")
+
+API_DOMAIN = getenv("API_SERVER", "https://api.snowdata.info")
+THIS_DIR = path.dirname(path.realpath(__file__))
+DB_DIR = path.join(THIS_DIR, "dbs")
+CACHE_PATH = getenv("CACHE_PATH", path.join(DB_DIR, "cache.db"))
+CACHE_REFRESH = timedelta(hours=24)
+CACHE_ARGS = {
+    "cache_name": CACHE_PATH,
+    "backend": "sqlite",
+    "expire_after": CACHE_REFRESH,
+    "wal": True,
+}
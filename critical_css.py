@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+Trimmed stylesheet for a single exported page.
+
+Only the rules of static/css/bootstrap.css whose class selectors all appear
+on the page are kept, rules without classes (reboot, custom properties) are
+always kept, and @media blocks are trimmed the same way. The result is small
+enough to inline so an exported page renders without waiting for a
+stylesheet request. The full stylesheet is still loaded, deferred, for the
+classes scripts add later.
+"""
+
+import re
+from os import path
+from functools import lru_cache
+
+THIS_DIR = path.dirname(path.realpath(__file__))
+BOOTSTRAP_CSS = path.join(THIS_DIR, "static", "css", "bootstrap.css")
+# classes bootstrap's javascript adds for the navbar collapse and dropdowns
+SCRIPT_CLASSES = {"show", "collapsing", "collapsed", "active"}
+
+CLASS_ATTR = re.compile(r"""class\s*=\s*(["'])(.*?)\1""", re.S)
+SELECTOR_CLASS = re.compile(r"\.(-?[_a-zA-Z][\w-]*)")
+NOT_CLAUSE = re.compile(r":not\([^)]*\)")
+COMMENT = re.compile(r"/\*.*?\*/", re.S)
+WHITESPACE = re.compile(r"\s+")
+STYLESHEET_LINK = re.compile(
+    r"<link rel=\"stylesheet\" href=\"([^\"]*css/bootstrap\.css)\">"
+)
+DEFERRED_STYLESHEET = (
+    '<link rel="preload" href="{href}" as="style" '
+    "onload=\"this.onload=null;this.rel='stylesheet'\">"
+    '<noscript><link rel="stylesheet" href="{href}"></noscript>'
+)
+
+
+def page_classes(html_str):
+    classes = set(SCRIPT_CLASSES)
+    for _, value in CLASS_ATTR.findall(html_str):
+        classes.update(value.split())
+    return classes
+
+
+def _blocks(css):
+    # top level (prelude, body) pairs, bodies keep their nested blocks
+    pos, depth, start, prelude = 0, 0, 0, None
+    for match in re.finditer(r"[{};]", css):
+        char = match.group()
+        if char == ";" and depth == 0:
+            yield css[start : match.start()].strip(), None
+            start = match.end()
+        elif char == "{":
+            if depth == 0:
+                prelude = css[start : match.start()].strip()
+                pos = match.end()
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                yield prelude, css[pos : match.start()]
+                start = match.end()
+
+
+def _selector_used(selector, classes):
+    required = SELECTOR_CLASS.findall(NOT_CLAUSE.sub("", selector))
+    return all(name in classes for name in required)
+
+
+def _trim(css, classes):
+    rules = []
+    for prelude, body in _blocks(css):
+        if body is None:
+            # @charset and @import
+            continue
+        if prelude.startswith(("@media", "@supports")):
+            inner = _trim(body, classes)
+            if inner:
+                rules.append(f"{prelude}{{{inner}}}")
+        elif prelude.startswith("@"):
+            rules.append(f"{prelude}{{{WHITESPACE.sub(' ', body).strip()}}}")
+        else:
+            selectors = [s.strip() for s in prelude.split(",")]
+            kept = [s for s in selectors if _selector_used(s, classes)]
+            if kept:
+                declarations = WHITESPACE.sub(" ", body).strip()
+                rules.append(f"{','.join(kept)}{{{declarations}}}")
+    return "".join(rules)
+
+
+def _drop_unused_keyframes(css):
+    def keep(match):
+        name = match.group(1)
+        rest = css[: match.start()] + css[match.end() :]
+        return match.group(0) if re.search(rf"\b{re.escape(name)}\b", rest) else ""
+
+    return re.sub(r"@keyframes\s+([\w-]+)\{(?:[^{}]*\{[^{}]*\})*\}", keep, css)
+
+
+@lru_cache(maxsize=1)
+def _stylesheet(css_path):
+    with open(css_path, encoding="utf-8") as css_file:
+        return COMMENT.sub("", css_file.read())
+
+
+def critical_css(html_str, css_path=BOOTSTRAP_CSS):
+    return _drop_unused_keyframes(_trim(_stylesheet(css_path), page_classes(html_str)))
+
+
+def inline_critical_css(html_str, css_path=BOOTSTRAP_CSS):
+    css = critical_css(html_str, css_path=css_path)
+
+    def inline(match):
+        deferred = DEFERRED_STYLESHEET.format(href=match.group(1))
+        return f"<style>{css}</style>{deferred}"
+
+    return STYLESHEET_LINK.sub(inline, html_str, count=1)
+
+
+if __name__ == "__main__":
+
+    import sys
+
+    with open(sys.argv[1], encoding="utf-8") as html_file:
+        html = html_file.read()
+    css = critical_css(html)
+    full = len(_stylesheet(BOOTSTRAP_CSS))
+    print(f"{len(css):,} of {full:,} bytes of bootstrap.css used by {sys.argv[1]}")
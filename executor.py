@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+CPU executor for running pandas table builds off the gevent event loop.
+
+Under gunicorn's gevent worker the builders run on native threads from a
+gevent thread pool so other greenlets keep being served, otherwise a regular
+concurrent.futures thread pool is used (i.e. the flask dev server).
+"""
+
+from os import getenv
+from time import perf_counter
+from threading import BoundedSemaphore, Lock
+from contextvars import ContextVar, copy_context
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from gevent.monkey import get_original
+
+    _allocate_lock = get_original("_thread", "allocate_lock")
+except ImportError:
+    from _thread import allocate_lock as _allocate_lock
+
+CPU_WORKERS = int(getenv("CPU_WORKERS", 2))
+CPU_QUEUE_DEPTH = int(getenv("CPU_QUEUE_DEPTH", 8))
+CPU_QUEUE_TIMEOUT = float(getenv("CPU_QUEUE_TIMEOUT", 30))
+
+# set while profiling so the work shows up in the caller's profile
+run_inline = ContextVar("run_inline", default=False)
+
+
+class ExecutorBusy(Exception):
+    pass
+
+
+def native_lock():
+    # a lock of the os threads even under gevent, for state the pool's native
+    # threads share with the greenlets (caches, budgets and metrics)
+    return _allocate_lock()
+
+
+def gevent_active():
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched("threading")
+
+
+def _timed_call(submitted, func, args, kwargs):
+    started = perf_counter()
+    result = func(*args, **kwargs)
+    return started - submitted, perf_counter() - started, result
+
+
+class CpuExecutor:
+    def __init__(
+        self,
+        workers=CPU_WORKERS,
+        queue_depth=CPU_QUEUE_DEPTH,
+        queue_timeout=CPU_QUEUE_TIMEOUT,
+    ):
+        self.workers = workers
+        self.queue_depth = queue_depth
+        self.queue_timeout = queue_timeout
+        self._pool = None
+        self._slots = None
+        self._lock = None
+        self._stats = dict(
+            submitted=0,
+            completed=0,
+            failed=0,
+            rejected=0,
+            in_flight=0,
+            wait_total=0.0,
+            wait_max=0.0,
+            run_total=0.0,
+            run_max=0.0,
+        )
+
+    def _start(self):
+        # created lazily so gevent's monkey patching (done by the gunicorn
+        # worker after fork) is in place before any pool or semaphore exists
+        if self._pool is not None:
+            return
+        if gevent_active():
+            from gevent.threadpool import ThreadPoolExecutor as GeventExecutor
+
+            self._pool = GeventExecutor(max_workers=self.workers)
+        else:
+            self._pool = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="cpu"
+            )
+        self._slots = BoundedSemaphore(self.queue_depth)
+        self._lock = Lock()
+
+    def _record(self, **changes):
+        with self._lock:
+            for key, value in changes.items():
+                if key.endswith("_max"):
+                    self._stats[key] = max(self._stats[key], value)
+                else:
+                    self._stats[key] += value
+
+    def run(self, func, *args, **kwargs):
+        # metrics imports native_lock from here
+        from metrics import stage_seconds, current_labels
+
+        if run_inline.get():
+            return func(*args, **kwargs)
+        self._start()
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            self._record(rejected=1)
+            raise ExecutorBusy(
+                f"CPU queue full ({self.queue_depth}) for {self.queue_timeout}s"
+            )
+        self._record(submitted=1, in_flight=1)
+        try:
+            # copying the context carries the metric labels into the thread
+            future = self._pool.submit(
+                copy_context().run, _timed_call, perf_counter(), func, args, kwargs
+            )
+            wait, run, result = future.result()
+        except Exception:
+            self._record(failed=1)
+            raise
+        finally:
+            self._record(in_flight=-1)
+            self._slots.release()
+        self._record(
+            completed=1, wait_total=wait, wait_max=wait, run_total=run, run_max=run
+        )
+        stage_seconds.observe(wait, **{**current_labels(), "stage": "cpu_queue_wait"})
+        return result
+
+    def stats(self):
+        stats = dict(self._stats)
+        completed = stats["completed"] or 1
+        stats["wait_avg"] = stats["wait_total"] / completed
+        stats["run_avg"] = stats["run_total"] / completed
+        stats["workers"] = self.workers
+        stats["queue_depth"] = self.queue_depth
+        stats["gevent"] = gevent_active()
+        return stats
+
+
+cpu_executor = CpuExecutor()
+
+
+if __name__ == "__main__":
+
+    print("This module runs CPU bound work off the event loop")
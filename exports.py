@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk CSV and Parquet export of every basin's report tables.
+
+Tables are built one basin at a time and appended to their output as they
+are produced so memory stays flat no matter how many basins or months are
+exported. Files are partitioned as <format>/<state>/<YYYY-MM>/<table>/ and
+every row also carries its state, month, basin type and basin.
+"""
+
+import csv
+import io
+from os import path, makedirs
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+from api_client import get_report_data
+from serializers import TABLE_BUILDERS
+
+EXPORT_FORMATS = ("csv", "parquet")
+META_COLUMNS = ["state", "month", "basin_type", "basin"]
+# every export of a table has the same columns whichever basins and months it
+# covers, forecasts get the exceedance columns the builder labels 10% to 90%
+TABLE_COLUMNS = dict(
+    fcst=[
+        "Streamflow Forecasts",
+        "Forecast Period",
+        "10%",
+        "30%",
+        "50%",
+        "% Median",
+        "70%",
+        "90%",
+        "30 yr. Median",
+    ],
+    snow=[
+        "Snowpack (in.)",
+        "Elevation",
+        "Current SWE",
+        "Current SD",
+        "Last Year SWE",
+        "Median SWE",
+        "% Median",
+        "LY % Median",
+    ],
+    prec=[
+        "Precipitation (in.)",
+        "Elevation",
+        "Current Monthly ",
+        "Last Year Monthly",
+        "Monthly Median",
+        "Current YTD",
+        "Last Year YTD",
+        "YTD Median",
+        "Monthly % Median",
+        "LY Monthly % Median",
+        "YTD % Median",
+        "LY YTD % Median",
+    ],
+    res=[
+        "Reservoir Storage (kaf)",
+        "Current",
+        "Last Year",
+        "Median",
+        "Capacity",
+        "% Capacity",
+        "LY % Capacity",
+        "Median % Capacity",
+        "% Median",
+        "LY % Median",
+    ],
+)
+# written as float64 to parquet, the other columns are text
+NUMERIC_COLUMNS = dict(
+    fcst={"10%", "30%", "50%", "70%", "90%", "30 yr. Median"},
+    snow={"Current SWE", "Current SD", "Last Year SWE", "Median SWE"},
+    prec={
+        "Current Monthly ",
+        "Last Year Monthly",
+        "Monthly Median",
+        "Current YTD",
+        "Last Year YTD",
+        "YTD Median",
+    },
+    res={"Current", "Last Year", "Median", "Capacity"},
+)
+
+
+def month_range(start, end):
+    (year, month), (end_year, end_month) = start, end
+    while (year, month) <= (end_year, end_month):
+        yield year, month
+        month += 1
+        if month > 12:
+            year, month = year + 1, 1
+
+
+def parse_month(month_str):
+    year, month = month_str.split("-")
+    year, month = int(year), int(month)
+    if not 1 <= month <= 12:
+        raise ValueError(f"no month {month} in {month_str}")
+    return year, month
+
+
+def month_count(start, end):
+    return (end[0] - start[0]) * 12 + end[1] - start[1] + 1
+
+
+def export_columns(table):
+    return META_COLUMNS + TABLE_COLUMNS[table]
+
+
+def _flat_table(df):
+    if isinstance(df.index, pd.MultiIndex):
+        df = df.reset_index(names=["Streamflow Forecasts", "Forecast Period"])
+    return df.infer_objects()
+
+
+def iter_basin_tables(state, year, month, basin_type, tables=None):
+    report_data = get_report_data(
+        state=state, year=year, month=month, basin_type=basin_type
+    )
+    return report_tables(state, year, month, basin_type, report_data, tables)
+
+
+def report_tables(state, year, month, basin_type, report_data, tables=None):
+    if tables is None:
+        tables = list(TABLE_BUILDERS.keys())
+    for basin in report_data["fcst"].keys():
+        for table in tables:
+            wsor_json = report_data[table]
+            if basin not in wsor_json:
+                continue
+            df = TABLE_BUILDERS[table](basin, wsor_json)
+            if df.empty:
+                continue
+            df = _flat_table(df)
+            df.insert(0, "basin", basin)
+            df.insert(0, "basin_type", basin_type)
+            df.insert(0, "month", f"{year}-{month:02d}")
+            df.insert(0, "state", state)
+            yield table, _conform(table, df)
+
+
+def _conform(table, df):
+    columns = export_columns(table)
+    extra = [str(i) for i in df.columns if i not in columns]
+    if extra:
+        # i.e. an exceedance outside 10% to 90%, reported rather than lost
+        # without a trace
+        print(
+            f"Columns {', '.join(extra)} of the {table} table of "
+            f"{df['basin'].iat[0]} are not exported"
+        )
+    return df.reindex(columns=columns)
+
+
+def csv_header(table):
+    return csv_chunk(pd.DataFrame(columns=export_columns(table)), header=True)
+
+
+def csv_chunk(df, header=False):
+    buffer = io.StringIO()
+    df.to_csv(buffer, index=False, header=header, quoting=csv.QUOTE_NONNUMERIC)
+    return buffer.getvalue()
+
+
+def csv_text(frames):
+    # (table, df) pairs as one csv chunk without a header
+    return "".join(csv_chunk(df) for _, df in frames)
+
+
+def write_tables(sink, frames):
+    for _, df in frames:
+        sink.write(df)
+
+
+def iter_csv(state, months, basin_types, table):
+    yield csv_header(table)
+    for year, month in months:
+        for basin_type in basin_types:
+            frames = iter_basin_tables(state, year, month, basin_type, [table])
+            yield csv_text(frames)
+
+
+def _arrow_schema(table):
+    fields = []
+    for col in export_columns(table):
+        if col in NUMERIC_COLUMNS[table]:
+            fields.append(pa.field(col, pa.float64()))
+        else:
+            fields.append(pa.field(col, pa.string()))
+    return pa.schema(fields)
+
+
+def _arrow_table(df, schema):
+    df = df.reindex(columns=schema.names)
+    arrays = []
+    for field in schema:
+        series = df[field.name]
+        if pa.types.is_floating(field.type):
+            values = pd.to_numeric(series, errors="coerce").to_numpy(dtype=np.float64)
+            arrays.append(pa.array(values, type=field.type, from_pandas=True))
+        else:
+            values = [None if pd.isna(i) else str(i) for i in series.tolist()]
+            arrays.append(pa.array(values, type=field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+class ParquetSink:
+    def __init__(self, file_path, table):
+        if pq is None:
+            raise ImportError("pyarrow is required for parquet exports")
+        # file_path may also be an open binary file object
+        self.file_path = file_path
+        self.schema = _arrow_schema(table)
+        self.writer = None
+
+    def write(self, df):
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.file_path, self.schema)
+        self.writer.write_table(_arrow_table(df, self.schema))
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+class CsvSink:
+    def __init__(self, file_path, table):
+        self.file_path = file_path
+        self.file = open(file_path, "w", newline="")
+        self.file.write(csv_header(table))
+
+    def write(self, df):
+        self.file.write(csv_chunk(df))
+
+    def close(self):
+        self.file.close()
+
+
+SINKS = dict(csv=CsvSink, parquet=ParquetSink)
+
+
+def partition_dir(export_dir, fmt, state, year, month, table):
+    return path.join(export_dir, fmt, state.lower(), f"{year}-{month:02d}", table)
+
+
+def export_tables(export_dir, states, months, basin_types, formats=EXPORT_FORMATS):
+    written = []
+    for state in states:
+        for year, month in months:
+            for basin_type in basin_types:
+                print(
+                    f"  Exporting {basin_type} basin tables for {state} {month}/{year}..."
+                )
+                sinks = {}
+                try:
+                    for table, df in iter_basin_tables(state, year, month, basin_type):
+                        if table not in sinks:
+                            sinks[table] = []
+                            for fmt in formats:
+                                out_dir = partition_dir(
+                                    export_dir, fmt, state, year, month, table
+                                )
+                                makedirs(out_dir, exist_ok=True)
+                                out_path = path.join(out_dir, f"{basin_type}.{fmt}")
+                                sinks[table].append(SINKS[fmt](out_path, table))
+                        for sink in sinks[table]:
+                            sink.write(df)
+                finally:
+                    for table_sinks in sinks.values():
+                        for sink in table_sinks:
+                            sink.close()
+                            written.append(sink.file_path)
+    return written
+
+
+if __name__ == "__main__":
+
+    print("This module exports the basin tables as csv and parquet files")
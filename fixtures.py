@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+"""
+Record and replay of upstream API responses.
+
+In record mode every payload fetched from API_SERVER is also written to a
+gzipped json fixture keyed by endpoint and query parameters. In replay mode
+payloads are only ever read from those fixtures and the network is never
+touched, which makes exports and benchmarks deterministic and lets a whole
+month be regenerated from a captured snapshot.
+"""
+
+import gzip
+import json
+import re
+import tempfile
+from os import getenv, path, makedirs, replace
+
+import lazy_json
+
+THIS_DIR = path.dirname(path.realpath(__file__))
+FIXTURE_MODE = getenv("FIXTURE_MODE", "off").lower()
+FIXTURE_DIR = getenv("FIXTURE_DIR", path.join(THIS_DIR, "fixtures"))
+FIXTURE_MODES = ("off", "record", "replay")
+
+
+class FixtureMiss(KeyError):
+    pass
+
+
+class FixtureStore:
+    def __init__(self, fixture_dir=FIXTURE_DIR, mode=FIXTURE_MODE):
+        self.configure(mode, fixture_dir)
+
+    def configure(self, mode, fixture_dir=None):
+        if mode not in FIXTURE_MODES:
+            raise ValueError(f"fixture mode must be one of {FIXTURE_MODES}")
+        self.mode = mode
+        if fixture_dir is not None:
+            self.fixture_dir = fixture_dir
+
+    @property
+    def recording(self):
+        return self.mode == "record"
+
+    @property
+    def replaying(self):
+        return self.mode == "replay"
+
+    def fixture_path(self, endpoint, params):
+        name = "_".join(f"{k}-{v}" for k, v in sorted(params.items()))
+        name = re.sub(r"[^a-zA-Z0-9_.-]+", "-", name) or "all"
+        return path.join(
+            self.fixture_dir, *endpoint.strip("/").split("/"), f"{name}.json.gz"
+        )
+
+    def load(self, endpoint, params):
+        fixture_path = self.fixture_path(endpoint, params)
+        if not path.isfile(fixture_path):
+            raise FixtureMiss(fixture_path)
+        with gzip.open(fixture_path, "rt", encoding="utf-8") as fixture:
+            return json.load(fixture)
+
+    def save(self, endpoint, params, payload):
+        fixture_path = self.fixture_path(endpoint, params)
+        fixture_dir = path.dirname(fixture_path)
+        makedirs(fixture_dir, exist_ok=True)
+        # write then rename so readers never see a partial fixture
+        with tempfile.NamedTemporaryFile(dir=fixture_dir, delete=False) as tmp:
+            with gzip.open(tmp, "wb") as fixture:
+                fixture.write(lazy_json.dumps(payload))
+        replace(tmp.name, fixture_path)
+        return fixture_path
+
+
+fixture_store = FixtureStore()
+
+
+if __name__ == "__main__":
+
+    print("This module records and replays upstream api responses")
@@ -21,3 +21,8 @@ python generate_static.py --year 2022 --month 4
 
 python generate_static.py --year 2022 --month 5
 
+REM The same months as a resumable job queue, run "work" on as many hosts as
+REM share the queue directory and "status" for progress and eta:
+REM python generate_static.py --queue queue --jobs enqueue --year 2021 --month 10 --through 2022-5
+REM python generate_static.py --queue queue --jobs work
+REM python generate_static.py --queue queue --jobs status
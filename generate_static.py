@@ -6,12 +6,29 @@ Created on Thu Apr 28 07:44:45 2022
 """
 
 import re
-from os import path, makedirs
-from requests import Session
-from requests import get as r_get
+import gzip
+from time import sleep
+from socket import gethostname
+from os import path, makedirs, getpid
+from contextlib import ExitStack
+from requests import Session, RequestException
 
-from app import BASIN_STATES, BASIN_TYPES
-from utils import get_hierarchy, API_DOMAIN
+from constants import BASIN_STATES, BASIN_TYPES, API_DOMAIN
+from api_client import get_hierarchy, fetch_json
+from fixtures import fixture_store
+from metrics import timed, set_labels, summary
+from upstream import set_lane
+from profiling import request_profiler, top_stats
+from jobs import JobQueue, task_group, format_status, JOB_POLL_INTERVAL
+from critical_css import inline_critical_css
+
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
 
 STATIC_URL = "https://www.wcc.nrcs.usda.gov/ftpref/assets/"
 WSOR_DOMAIN = "http://nrcscix0147.edc.ds1.usda.gov:8090"
@@ -21,30 +38,190 @@ EXPORT_DIR = path.join(THIS_DIR, "export")
 makedirs(EXPORT_DIR, exist_ok=True)
 
 
-def get_basins(btype, sesh=None, domain=API_DOMAIN):
-    endpoint = "/basin/getBasins"
-    args = f"?type={btype}&format=json&orient=records"
-    url = f"{domain}{endpoint}{args}"
-    print(url)
-    if sesh:
-        req = sesh.get(url)
+class ExportError(Exception):
+    pass
+
+
+def get_basins(btype, domain=API_DOMAIN):
+    return fetch_json(
+        "/basin/getBasins",
+        dict(type=btype, format="json", orient="records"),
+        domain=domain,
+        empty=[],
+        labels=dict(endpoint="getBasins"),
+    )
+
+
+def print_profile(record):
+    profile_path = path.join(request_profiler.profile_dir, record["file"])
+    print(f"\nProfile saved to {profile_path}")
+    print(f"  {record['seconds']:.1f}s, peak traced memory {record['peak_mb']:.1f} MB")
+    print(top_stats(profile_path))
+
+
+# app routes and the basin links of the index page, relative to the app
+REF_PATTERN = re.compile(
+    r"/static/|href=\"/\"|<a href='/([^']*)'>|<a href='(?!\.|#|http)([^'/?]+)'>"
+)
+
+
+def make_refs_relative(html_str, home_link="#", static_url=STATIC_URL):
+    def relative(match):
+        ref = match.group()
+        if ref == "/static/":
+            return static_url
+        if ref == 'href="/"':
+            return f'href="{home_link}"'
+        return f"<a href='./{match.group(match.lastindex)}.html'>"
+
+    return REF_PATTERN.sub(relative, html_str)
+
+
+def export_html(html_str, home_link="#"):
+    return make_refs_relative(inline_critical_css(html_str), home_link=home_link)
+
+
+def write_page(page_path, html_str):
+    # precompressed siblings so the file server can skip compressing on the fly
+    data = html_str.encode("utf-8")
+    with open(page_path, "wb") as html:
+        html.write(data)
+    with open(f"{page_path}.gz", "wb") as gz_file:
+        gz_file.write(gzip.compress(data, compresslevel=9, mtime=0))
+    if brotli is not None:
+        with open(f"{page_path}.br", "wb") as br_file:
+            br_file.write(brotli.compress(data, quality=11))
+
+
+def basin_names(state):
+    hierarchy = get_hierarchy(state=state)
+    if not hierarchy:
+        majors = [i["name"] for i in get_basins(btype=f"{state.lower()}_8")]
+        minors = []
     else:
-        req = r_get(url)
-    if req.ok:
-        return req.json()
+        majors = list(hierarchy.keys())
+        minors = []
+        for major in majors:
+            minors.extend(hierarchy[major])
+    miscs = [i["name"] for i in get_basins(btype=f"{state.lower()}3")]
+    return dict(major=majors, minor=minors, misc=miscs)
+
+
+def page_dir(export_dir, year, month, state, basin_type):
+    btype_dir = path.join(
+        export_dir, f"{year}_{month}", state.lower(), basin_type.lower()
+    )
+    makedirs(btype_dir, exist_ok=True)
+    return btype_dir
+
+
+def batch_session():
+    sesh = Session()
+    sesh.headers["X-Upstream-Lane"] = "batch"
+    # the pages leave out the links only the live app can follow
+    sesh.headers["X-Static-Export"] = "1"
+    return sesh
+
+
+def submit(sesh, state, year, month, basin_type, refresh=True):
+    # loads the report into the app session that the page requests read
+    url = f"{WSOR_DOMAIN}?automate=true"
+    data = dict(state=state, month=month, year=year, btype=basin_type)
+    if refresh:
+        data["refresh"] = True
+    with timed("export_submit"):
+        post_req = sesh.post(url=url, data=data)
+    if not post_req.ok:
+        raise ExportError(f"Failed to produce WSOR data... - {post_req.status_code}")
+
+
+def export_index(sesh, btype_dir):
+    errors = []
+    with timed("export_index"):
+        basins_req = sesh.get(f"{WSOR_DOMAIN}/basins")
+    if basins_req.ok:
+        index_html = export_html(basins_req.text, home_link="#")
+        write_page(path.join(btype_dir, "index.html"), index_html)
     else:
-        print("An error occurred while attempting to retrieve data from the API.")
-        return []
+        errors.append(f"Could not create index page - {basins_req.status_code}")
+    with timed("export_summary"):
+        summary_req = sesh.get(f"{WSOR_DOMAIN}/summary")
+    if summary_req.ok:
+        summary_html = export_html(summary_req.text, home_link="../")
+        write_page(path.join(btype_dir, "summary.html"), summary_html)
+    else:
+        errors.append(f"Could not create summary page - {summary_req.status_code}")
+    if errors:
+        raise ExportError(", ".join(errors))
 
 
-def make_refs_relative(html_str, home_link="#", static_url=STATIC_URL):
-    html_str = html_str.replace("/static/", static_url)
-    html_str = html_str.replace('href="/"', 'href="{home_link}"')
-    html_str = html_str.replace("<a href='/", "<a href='./")
-    re_paths = re.findall(r"<a href='./(.*?)'>", html_str)
-    for re_path in re_paths:
-        html_str = html_str.replace(re_path, f"{re_path}.html")
-    return html_str
+def export_basin(sesh, btype_dir, bname):
+    with timed("export_page"):
+        wsor_req = sesh.get(f"{WSOR_DOMAIN}/{bname.lower()}")
+    if not wsor_req.ok:
+        raise ExportError(f"Failed to get WSOR - {wsor_req.status_code}")
+    html_str = export_html(wsor_req.text, home_link="../")
+    write_page(path.join(btype_dir, f"{bname.lower()}.html"), html_str)
+
+
+def enqueue_months(queue, months, states=BASIN_STATES, basin_types=BASIN_TYPES):
+    # one task for the index and summary of each page group, basin "", and
+    # one per basin page
+    tasks = []
+    for state in states:
+        print(f"  Listing basins for {state}...")
+        bname_dict = basin_names(state)
+        for year, month in months:
+            for basin_type in basin_types:
+                bnames = bname_dict.get(basin_type, None)
+                if not bnames:
+                    continue
+                tasks.append((year, month, state, basin_type, ""))
+                tasks.extend(
+                    (year, month, state, basin_type, i.lower()) for i in bnames
+                )
+    return queue.enqueue(tasks)
+
+
+def run_worker(queue, export_dir, poll=JOB_POLL_INTERVAL):
+    worker = f"{gethostname()}:{getpid()}"
+    group, sesh, done = None, None, 0
+    while True:
+        task = queue.claim(worker, prefer=group)
+        if task is None:
+            if not queue.remaining():
+                break
+            # the rest is leased to other workers, theirs come back if they die
+            sleep(poll)
+            continue
+        year, month, state, basin_type = task_group(task)
+        set_labels(state=state, basin_type=basin_type)
+        print(f"  {task['key']} (attempt {task['attempts']})...")
+        try:
+            if task_group(task) != group:
+                if sesh is not None:
+                    sesh.close()
+                sesh, group = batch_session(), None
+                submit(sesh, state, year, month, basin_type, refresh=not task["basin"])
+                group = task_group(task)
+            btype_dir = page_dir(export_dir, year, month, state, basin_type)
+            if task["basin"]:
+                export_basin(sesh, btype_dir, task["basin"])
+            else:
+                export_index(sesh, btype_dir)
+        except (ExportError, RequestException, OSError) as error:
+            # set the group up again, the app session may be gone
+            group = None
+            status = queue.fail(task, error)
+            print(f"    {error} - {status or 'lease lost'}")
+        else:
+            if queue.complete(task):
+                done += 1
+            else:
+                print("    lease lost, the task was handed to another worker")
+    if sesh is not None:
+        sesh.close()
+    return done
 
 
 if __name__ == "__main__":
@@ -77,6 +254,54 @@ if __name__ == "__main__":
         default=now.year,
         type=int,
     )
+    parser.add_argument(
+        "-t",
+        "--tables",
+        help="export basin tables instead of html pages, i.e. csv,parquet",
+        default=None,
+    )
+    parser.add_argument(
+        "--through",
+        help="with --tables or --jobs enqueue, every month through this one, "
+        "i.e. 2022-5",
+        default=None,
+    )
+    parser.add_argument(
+        "--queue",
+        help="job queue directory, can be shared by workers on several hosts",
+        default=None,
+    )
+    parser.add_argument(
+        "--jobs",
+        help="with --queue, add the html pages of the months to the queue, "
+        "export queued pages until none are left, show progress or retry "
+        "failed pages",
+        choices=["enqueue", "work", "status", "retry"],
+        default=None,
+    )
+    parser.add_argument(
+        "--publish",
+        help="publish a snapshot of every state and basin type for the app to "
+        "serve instead of exporting html pages",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--record",
+        help="record every upstream response to this fixture directory",
+        default=None,
+    )
+    parser.add_argument(
+        "--replay",
+        help="serve upstream responses only from this fixture directory, "
+        "the app at WSOR_DOMAIN needs FIXTURE_MODE=replay for html pages",
+        default=None,
+    )
+    parser.add_argument(
+        "-p",
+        "--profile",
+        help="profile the run with cProfile and tracemalloc",
+        action="store_true",
+    )
     args = parser.parse_args()
 
     if args.version:
@@ -90,61 +315,124 @@ if __name__ == "__main__":
     pub_month = args.month
     pub_year = args.year
 
+    if args.record and args.replay:
+        print("Use either --record or --replay, not both...")
+        sys.exit(1)
+    if args.record:
+        fixture_store.configure("record", args.record)
+    if args.replay:
+        fixture_store.configure("replay", args.replay)
+    # backfills yield to interactive users, here and in the app it drives
+    set_lane("batch")
+
+    profile_stack = ExitStack()
+    if args.profile:
+        profile_record = profile_stack.enter_context(
+            request_profiler.profile(f"generate_static {pub_year}-{pub_month}")
+        )
+
+    if args.jobs:
+        if not args.queue:
+            print("--jobs needs a --queue directory...")
+            sys.exit(1)
+        queue = JobQueue(args.queue)
+        if args.jobs == "enqueue":
+            from exports import month_range, parse_month
+
+            start = (pub_year, pub_month)
+            end = parse_month(args.through) if args.through else start
+            print(f"\nQueueing pages for {pub_month}/{pub_year} - {end[1]}/{end[0]}...")
+            added = enqueue_months(queue, list(month_range(start, end)))
+            print(f"  Added {added} tasks to {args.queue}")
+        elif args.jobs == "work":
+            print(f"\nExporting queued pages from {args.queue}...\n")
+            done = run_worker(queue, args.export)
+            print(f"\nExported {done} tasks")
+            print(f"\nStage timings:\n{summary()}")
+        elif args.jobs == "retry":
+            print(f"Queued {queue.retry_failed()} failed tasks again")
+        print(format_status(queue.status()))
+        for failure in queue.failures():
+            print(f"  failed {failure['key']}: {failure['error']}")
+        profile_stack.close()
+        if args.profile:
+            print_profile(profile_record)
+        sys.exit(0)
+
+    if args.publish:
+        from snapshots import publish, SNAPSHOT_DIR
+
+        print(f"\nPublishing snapshot for {pub_month}/{pub_year} to {SNAPSHOT_DIR}...")
+        snapshot_path = publish(pub_year, pub_month, BASIN_STATES, BASIN_TYPES)
+        print(f"  Wrote {snapshot_path}")
+        print(f"\nStage timings:\n{summary()}")
+        profile_stack.close()
+        if args.profile:
+            print_profile(profile_record)
+        sys.exit(0)
+
+    if args.tables:
+        from exports import export_tables, month_range, parse_month, EXPORT_FORMATS
+
+        formats = [i.strip().lower() for i in args.tables.split(",")]
+        if any(i not in EXPORT_FORMATS for i in formats):
+            print(f"Invalid table format - {args.tables} - try csv and/or parquet...")
+            sys.exit(1)
+        start = (pub_year, pub_month)
+        end = parse_month(args.through) if args.through else start
+        tables_dir = path.join(args.export, "tables")
+        print(
+            f"\nExporting basin tables for {pub_month}/{pub_year} - {end[1]}/{end[0]}..."
+        )
+        written = export_tables(
+            tables_dir,
+            states=BASIN_STATES,
+            months=list(month_range(start, end)),
+            basin_types=BASIN_TYPES,
+            formats=formats,
+        )
+        print(f"  Wrote {len(written)} files to {tables_dir}")
+        print(f"\nStage timings:\n{summary()}")
+        profile_stack.close()
+        if args.profile:
+            print_profile(profile_record)
+        sys.exit(0)
+
     print(f"\nWorking on {pub_month}/{pub_year}...\n")
-    pub_month_dir = path.join(EXPORT_DIR, f"{pub_year}_{pub_month}")
-    makedirs(pub_month_dir, exist_ok=True)
     for state in BASIN_STATES:
-        with Session() as sesh:
+        with batch_session() as sesh:
             print(f"Working on {state}...")
-            state_dir = path.join(pub_month_dir, state.lower())
-            makedirs(state_dir, exist_ok=True)
+            set_labels(state=state)
             print("  Getting hierarchy...")
-            hierarchy = get_hierarchy(state=state)
-            if not hierarchy:
-                majors = [i["name"] for i in get_basins(btype=f"{state.lower()}_8")]
-                minors = []
-            else:
-                majors = list(hierarchy.keys())
-                minors = []
-                for major in majors:
-                    minors.extend(hierarchy[major])
-            miscs = [i["name"] for i in get_basins(btype=f"{state.lower()}3")]
-            bname_dict = dict(major=majors, minor=minors, misc=miscs)
+            bname_dict = basin_names(state)
             for basin_type in BASIN_TYPES:
                 print(f"  Generating basin data for {basin_type} basins...")
-                btype_dir = path.join(state_dir, basin_type.lower())
-                makedirs(btype_dir, exist_ok=True)
+                set_labels(basin_type=basin_type)
+                btype_dir = page_dir(
+                    args.export, pub_year, pub_month, state, basin_type
+                )
                 bnames = bname_dict.get(basin_type, None)
                 if not bnames:
                     continue
-                url = f"{WSOR_DOMAIN}?automate=true"
-                data = dict(
-                    state=state,
-                    month=pub_month,
-                    year=pub_year,
-                    btype=basin_type,
-                    refresh=True,
-                )
-                post_req = sesh.post(url=url, data=data)
-                if not post_req.ok:
-                    print("    Failed to produce WSOR data... - {post_req.status_code}")
+                try:
+                    submit(sesh, state, pub_year, pub_month, basin_type)
+                except ExportError as error:
+                    print(f"    {error}")
                     continue
-                basins_req = sesh.get(f"{WSOR_DOMAIN}/basins")
-                if not basins_req.ok:
-                    print("    Could not create index page - {basins_req.status_code}")
-                index_html = make_refs_relative(basins_req.text, home_link="#")
-                index_export_path = path.join(btype_dir, "index.html")
-                with open(index_export_path, "w") as html:
-                    html.write(index_html)
+                try:
+                    export_index(sesh, btype_dir)
+                except ExportError as error:
+                    print(f"    {error}")
                 for bname in bnames:
                     print(f"    Getting WSOR for {bname}...")
-                    basin_filename = f"{bname.lower()}.html"
-                    html_export_path = path.join(btype_dir, basin_filename)
-                    wsor_req = sesh.get(f"{WSOR_DOMAIN}/{bname.lower()}")
-                    if not wsor_req.ok:
-                        print(f"      Failed to get WSOR - {wsor_req.status_code}")
+                    try:
+                        export_basin(sesh, btype_dir, bname)
+                    except ExportError as error:
+                        print(f"      {error}")
                         continue
-                    html_str = make_refs_relative(wsor_req.text, home_link="../")
-                    with open(html_export_path, "w") as html:
-                        html.write(html_str)
                     print("      Success!!")
+
+    print(f"\nStage timings for {pub_month}/{pub_year}:\n{summary()}")
+    profile_stack.close()
+    if args.profile:
+        print_profile(profile_record)
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+"""
+Resumable export job queue for backfills.
+
+A queue is a directory holding a sqlite database of tasks, one per page
+group (the index and summary pages of a state and basin type, basin "")
+and one per basin page. Tasks that are done stay done, so enqueueing the
+same months again after a crash only adds what is missing, and any number
+of worker processes, on this host or others sharing the directory, claim
+tasks one at a time.
+
+A claimed task is leased to its worker for JOB_LEASE seconds, a worker that
+dies loses its lease and the task is handed out again. A failed task is
+retried after JOB_RETRY_DELAY seconds, doubling each time, until it has
+been tried JOB_MAX_ATTEMPTS times. The database uses a rollback journal
+rather than WAL since WAL does not work over network file systems.
+"""
+
+import sqlite3
+import threading
+from time import time
+from os import getenv, getpid, path, makedirs
+
+JOB_LEASE = float(getenv("JOB_LEASE", 600))
+JOB_MAX_ATTEMPTS = int(getenv("JOB_MAX_ATTEMPTS", 3))
+JOB_RETRY_DELAY = float(getenv("JOB_RETRY_DELAY", 30))
+JOB_POLL_INTERVAL = float(getenv("JOB_POLL_INTERVAL", 10))
+JOB_TIMEOUT = 60
+QUEUE_DB = "queue.db"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY,
+    key TEXT UNIQUE NOT NULL,
+    year INTEGER NOT NULL,
+    month INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    basin_type TEXT NOT NULL,
+    basin TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_expires REAL,
+    not_before REAL NOT NULL DEFAULT 0,
+    error TEXT,
+    created REAL NOT NULL,
+    started REAL,
+    finished REAL
+)
+"""
+STATUS_INDEX = "CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, not_before)"
+COLUMNS = (
+    "id",
+    "key",
+    "year",
+    "month",
+    "state",
+    "basin_type",
+    "basin",
+    "status",
+    "attempts",
+    "worker",
+    "lease_expires",
+)
+
+
+def task_key(year, month, state, basin_type, basin=""):
+    return f"{year}-{month:02d}/{state}/{basin_type}/{basin}"
+
+
+def task_group(task):
+    return task["year"], task["month"], task["state"], task["basin_type"]
+
+
+class JobQueue:
+    def __init__(
+        self,
+        queue_dir,
+        lease=JOB_LEASE,
+        max_attempts=JOB_MAX_ATTEMPTS,
+        retry_delay=JOB_RETRY_DELAY,
+    ):
+        self.queue_dir = queue_dir
+        self.db_path = path.join(queue_dir, QUEUE_DB)
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._local = threading.local()
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == getpid():
+            return conn
+        makedirs(self.queue_dir, exist_ok=True)
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=JOB_TIMEOUT,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        conn.execute(f"PRAGMA busy_timeout={JOB_TIMEOUT * 1000}")
+        conn.execute("PRAGMA journal_mode=DELETE")
+        conn.execute(SCHEMA)
+        conn.execute(STATUS_INDEX)
+        self._local.conn = conn
+        self._local.pid = getpid()
+        return conn
+
+    def _transaction(self, func):
+        # one writer at a time across processes and hosts
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = func(conn)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return result
+
+    def enqueue(self, tasks):
+        # (year, month, state, basin_type, basin) tuples, known tasks are kept
+        now = time()
+        rows = [(task_key(*task), *task, now) for task in tasks]
+
+        def insert(conn):
+            before = conn.total_changes
+            conn.executemany(
+                "INSERT OR IGNORE INTO tasks "
+                "(key, year, month, state, basin_type, basin, created) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            return conn.total_changes - before
+
+        return self._transaction(insert)
+
+    def claim(self, worker, prefer=None):
+        # prefer a task of the worker's last page group, its session is set up
+        def take(conn):
+            now = time()
+            conn.execute(
+                "UPDATE tasks SET status = 'failed', error = 'lease expired' "
+                "WHERE status = 'leased' AND lease_expires <= ? AND attempts >= ?",
+                (now, self.max_attempts),
+            )
+            order = "year, month, state, basin_type, basin"
+            params = [now, now]
+            if prefer is not None:
+                order = (
+                    "(year = ? AND month = ? AND state = ? AND basin_type = ?) DESC, "
+                    + order
+                )
+                params.extend(prefer)
+            row = conn.execute(
+                "SELECT id FROM tasks WHERE (status = 'pending' AND not_before <= ?) "
+                f"OR (status = 'leased' AND lease_expires <= ?) ORDER BY {order} "
+                "LIMIT 1",
+                params,
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE tasks SET status = 'leased', worker = ?, lease_expires = ?, "
+                "attempts = attempts + 1, started = ? WHERE id = ?",
+                (worker, now + self.lease, now, row[0]),
+            )
+            task = conn.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM tasks WHERE id = ?", (row[0],)
+            ).fetchone()
+            return dict(zip(COLUMNS, task))
+
+        return self._transaction(take)
+
+    def complete(self, task):
+        # done even if the lease ran out meanwhile, unless another worker has
+        # claimed the task since, the page was written either way
+        def finish(conn):
+            return conn.execute(
+                "UPDATE tasks SET status = 'done', finished = ?, error = NULL, "
+                "lease_expires = NULL "
+                "WHERE id = ? AND worker = ? AND lease_expires = ?",
+                (time(), task["id"], task["worker"], task["lease_expires"]),
+            ).rowcount
+
+        return bool(self._transaction(finish))
+
+    def fail(self, task, error):
+        # None when the task is no longer leased to the worker that failed it
+        def retry(conn):
+            row = conn.execute(
+                "SELECT attempts FROM tasks WHERE id = ? AND status = 'leased' "
+                "AND worker = ? AND lease_expires = ?",
+                (task["id"], task["worker"], task["lease_expires"]),
+            ).fetchone()
+            if row is None:
+                return None
+            attempts = row[0]
+            if attempts >= self.max_attempts:
+                status, not_before = "failed", 0
+            else:
+                status = "pending"
+                not_before = time() + self.retry_delay * 2 ** (attempts - 1)
+            conn.execute(
+                "UPDATE tasks SET status = ?, not_before = ?, error = ?, "
+                "lease_expires = NULL WHERE id = ?",
+                (status, not_before, str(error)[:500], task["id"]),
+            )
+            return status
+
+        return self._transaction(retry)
+
+    def retry_failed(self):
+        def reset(conn):
+            return conn.execute(
+                "UPDATE tasks SET status = 'pending', attempts = 0, not_before = 0 "
+                "WHERE status = 'failed'"
+            ).rowcount
+
+        return self._transaction(reset)
+
+    def remaining(self):
+        # pending or leased, failed tasks wait for retry_failed
+        return (
+            self._connect()
+            .execute("SELECT count(*) FROM tasks WHERE status IN ('pending', 'leased')")
+            .fetchone()[0]
+        )
+
+    def failures(self, limit=20):
+        rows = (
+            self._connect()
+            .execute(
+                "SELECT key, attempts, error FROM tasks WHERE status = 'failed' "
+                "ORDER BY key LIMIT ?",
+                (limit,),
+            )
+            .fetchall()
+        )
+        return [dict(key=k, attempts=a, error=e) for k, a, e in rows]
+
+    def status(self, window=600):
+        conn = self._connect()
+        now = time()
+        counts = dict(
+            conn.execute("SELECT status, count(*) FROM tasks GROUP BY status")
+        )
+        first, last, done = conn.execute(
+            "SELECT min(started), max(finished), count(*) FROM tasks "
+            "WHERE status = 'done'"
+        ).fetchone()
+        recent, recent_start = conn.execute(
+            "SELECT count(*), min(started) FROM tasks "
+            "WHERE status = 'done' AND finished > ?",
+            (now - window,),
+        ).fetchone()
+        workers = dict(
+            conn.execute(
+                "SELECT worker, count(*) FROM tasks WHERE status = 'leased' "
+                "AND lease_expires > ? GROUP BY worker",
+                (now,),
+            )
+        )
+        # throughput over the last window, else the average of the whole run
+        if recent:
+            rate = recent / max(now - max(recent_start, now - window), 1)
+        elif done and last > first:
+            rate = done / (last - first)
+        else:
+            rate = 0.0
+        remaining = counts.get("pending", 0) + counts.get("leased", 0)
+        return dict(
+            total=sum(counts.values()),
+            counts=counts,
+            remaining=remaining,
+            workers=workers,
+            rate=rate,
+            eta=remaining / rate if rate else None,
+        )
+
+
+def format_status(status):
+    counts = status["counts"]
+    lines = [
+        f"{status['total']} tasks: "
+        + ", ".join(
+            f"{counts.get(i, 0)} {i}" for i in ("done", "leased", "pending", "failed")
+        ),
+        f"throughput {60 * status['rate']:.1f} tasks/min",
+    ]
+    remaining = status["remaining"]
+    if remaining and status["eta"] is not None:
+        hours, rest = divmod(int(status["eta"]), 3600)
+        lines.append(f"eta {hours}h {rest // 60:02d}m for {remaining} tasks")
+    elif remaining:
+        lines.append(f"eta unknown for {remaining} tasks")
+    for worker, leased in sorted(status["workers"].items()):
+        lines.append(f"  {worker}: {leased} leased")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+
+    print("This module queues export tasks for generate_static workers")
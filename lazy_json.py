@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+"""
+Lazy per basin decoding of wsor payloads.
+
+A wsor payload is a json object keyed by basin name. On ingest only its top
+level is scanned and each basin is kept as the undecoded slice of the body,
+a basin is decoded the first time it is looked up and memoized, so a page
+for one basin never holds the rest of the state as python objects. msgspec,
+which Flask-Session already depends on, does the scan without decoding the
+basins, the stdlib decoder is the fallback.
+"""
+
+import re
+import json
+from collections.abc import Mapping
+from importlib.util import find_spec
+
+# imported on first use, msgspec would double the import time of the client
+HAVE_MSGSPEC = find_spec("msgspec") is not None
+_msgspec = {}
+
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+# decoded basins take about this many times the bytes of their json
+DECODED_FACTOR = 4
+
+
+def _skip(text, pos):
+    return _WHITESPACE.match(text, pos).end()
+
+
+def _scan_object(text):
+    # top level keys and the text of their values, values are parsed once to
+    # find where they end and the result is dropped right away
+    decoder = json.JSONDecoder()
+    pos = _skip(text, 0)
+    if text[pos : pos + 1] != "{":
+        return None
+    values = {}
+    pos = _skip(text, pos + 1)
+    if text[pos : pos + 1] == "}":
+        return values
+    while True:
+        key, pos = decoder.raw_decode(text, pos)
+        pos = _skip(text, pos)
+        if text[pos : pos + 1] != ":":
+            raise json.JSONDecodeError("Expecting ':' delimiter", text, pos)
+        start = _skip(text, pos + 1)
+        _, pos = decoder.raw_decode(text, start)
+        values[key] = text[start:pos]
+        pos = _skip(text, pos)
+        if text[pos : pos + 1] == "}":
+            return values
+        if text[pos : pos + 1] != ",":
+            raise json.JSONDecodeError("Expecting ',' delimiter", text, pos)
+        pos = _skip(text, pos + 1)
+
+
+def _msgspec_decoders():
+    if not _msgspec:
+        import msgspec
+
+        _msgspec.update(
+            index=msgspec.json.Decoder(dict[str, msgspec.Raw]).decode,
+            decode=msgspec.json.decode,
+            error=msgspec.ValidationError,
+        )
+    return _msgspec
+
+
+def _index(raw):
+    if not HAVE_MSGSPEC:
+        return _scan_object(raw.decode("utf-8"))
+    decoders = _msgspec_decoders()
+    try:
+        return decoders["index"](raw)
+    except decoders["error"]:
+        # valid json that is not an object of basins
+        return None
+
+
+def _decode(value):
+    # str slices come from the stdlib scanner, msgspec.Raw from msgspec
+    if isinstance(value, str):
+        return json.loads(value)
+    return _msgspec_decoders()["decode"](value)
+
+
+class LazyPayload(Mapping):
+    __slots__ = ("raw", "_values", "_decoded", "__weakref__")
+
+    def __init__(self, raw, values):
+        self.raw = raw
+        self._values = values
+        self._decoded = {}
+
+    def __getitem__(self, key):
+        value = self._decoded.get(key)
+        if value is None:
+            # setdefault so racing threads end up sharing one object
+            value = self._decoded.setdefault(key, _decode(self._values[key]))
+        return value
+
+    def peek(self, key):
+        # decode without keeping the result, for one off passes over a state
+        value = self._decoded.get(key)
+        if value is None:
+            value = _decode(self._values[key])
+        return value
+
+    def raw_value(self, key):
+        # the undecoded json of one basin, bytes like
+        value = self._values[key]
+        return value.encode("utf-8") if isinstance(value, str) else value
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __reduce__(self):
+        return loads, (self.raw,)
+
+    def __repr__(self):
+        return (
+            f"{type(self).__name__}({len(self._values)} basins, "
+            f"{len(self._decoded)} decoded, {len(self.raw)} bytes)"
+        )
+
+    @property
+    def decoded(self):
+        return len(self._decoded)
+
+    def approx_size(self):
+        decoded = sum(len(self._values[key]) for key in list(self._decoded))
+        return len(self.raw) + DECODED_FACTOR * decoded
+
+
+def loads(raw):
+    if isinstance(raw, str):
+        raw = raw.encode("utf-8")
+    values = _index(raw)
+    if values is None:
+        return json.loads(raw)
+    return LazyPayload(raw, values)
+
+
+def dumps(payload):
+    if isinstance(payload, LazyPayload):
+        return payload.raw
+    return json.dumps(payload, separators=(",", ":")).encode("utf-8")
+
+
+def peek(payload, key):
+    if isinstance(payload, LazyPayload):
+        return payload.peek(key)
+    return payload[key]
+
+
+def raw_value(payload, key):
+    # None for payloads that were decoded in full
+    if isinstance(payload, LazyPayload):
+        return payload.raw_value(key)
+    return None
+
+
+if __name__ == "__main__":
+
+    print("This module decodes wsor payloads one basin at a time")
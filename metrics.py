@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+"""
+Stage timers and counters, reported in the Prometheus text format.
+
+Labels such as state and basin type are set once per request with
+set_labels and picked up by every timer that runs in that context, the CPU
+executor copies the context into its worker threads.
+"""
+
+from time import perf_counter
+from functools import wraps
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from executor import native_lock
+
+DEFAULT_BUCKETS = (
+    0.001,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+)
+
+_labels = ContextVar("metric_labels", default={})
+
+
+def set_labels(**labels):
+    labels = {k: str(v) for k, v in labels.items() if v is not None}
+    return _labels.set({**_labels.get(), **labels})
+
+
+def clear_labels():
+    return _labels.set({})
+
+
+def current_labels():
+    return dict(_labels.get())
+
+
+def _label_key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    escaped = [
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in pairs
+    ]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self._values = {}
+        self._lock = native_lock()
+
+    def inc(self, amount=1, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        return self._values.get(_label_key(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            yield f"{self.name}{_format_labels(key)} {value}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[_label_key(labels)] = value
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, description, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = native_lock()
+
+    def observe(self, value, **labels):
+        key = _label_key(labels)
+        with self._lock:
+            counts, total, count, peak = self._values.get(
+                key, ([0] * len(self.buckets), 0.0, 0, 0.0)
+            )
+            counts = list(counts)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value, count + 1, max(peak, value))
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    def samples(self):
+        for key, (counts, total, count, _) in sorted(self.snapshot().items()):
+            for bound, bucket_count in zip(self.buckets, counts):
+                labels = _format_labels(key, [("le", repr(float(bound)))])
+                yield f"{self.name}_bucket{labels} {bucket_count}"
+            yield f'{self.name}_bucket{_format_labels(key, [("le", "+Inf")])} {count}'
+            yield f"{self.name}_sum{_format_labels(key)} {total}"
+            yield f"{self.name}_count{_format_labels(key)} {count}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, description):
+        return self._metrics.get(name) or self.register(Counter(name, description))
+
+    def gauge(self, name, description):
+        return self._metrics.get(name) or self.register(Gauge(name, description))
+
+    def histogram(self, name, description, buckets=DEFAULT_BUCKETS):
+        return self._metrics.get(name) or self.register(
+            Histogram(name, description, buckets)
+        )
+
+    def render(self):
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.description}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+stage_seconds = registry.histogram(
+    "wsor_stage_seconds", "Time spent in each stage of building a report"
+)
+cache_requests = registry.counter(
+    "wsor_cache_requests_total", "Payload cache lookups by cache and result"
+)
+revalidations = registry.counter(
+    "wsor_revalidations_total", "Conditional refetches of cached payloads by result"
+)
+revalidated_bytes = registry.counter(
+    "wsor_revalidation_bytes_saved_total",
+    "Payload bytes not downloaded again because the api answered 304",
+)
+
+
+@contextmanager
+def timed(stage, **labels):
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(
+            perf_counter() - start, **{**current_labels(), **labels, "stage": stage}
+        )
+
+
+def timed_stage(stage):
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(stage):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count_cache(cache, hit, **labels):
+    result = "hit" if hit else "miss"
+    cache_requests.inc(
+        **{**current_labels(), **labels, "cache": cache, "result": result}
+    )
+
+
+def count_revalidation(result, bytes_saved=0, **labels):
+    labels = {**current_labels(), **labels}
+    revalidations.inc(**labels, result=result)
+    if bytes_saved:
+        revalidated_bytes.inc(bytes_saved, **labels)
+
+
+def summary(histogram=stage_seconds):
+    stages = {}
+    for key, (_, total, count, peak) in histogram.snapshot().items():
+        stage = dict(key).get("stage", "")
+        s_total, s_count, s_peak = stages.get(stage, (0.0, 0, 0.0))
+        stages[stage] = (s_total + total, s_count + count, max(s_peak, peak))
+    lines = [
+        f"{'stage':<24}{'count':>8}{'total (s)':>12}{'mean (ms)':>12}{'max (ms)':>12}"
+    ]
+    for stage, (total, count, peak) in sorted(
+        stages.items(), key=lambda kv: kv[1][0], reverse=True
+    ):
+        lines.append(
+            f"{stage:<24}{count:>8}{total:>12.2f}"
+            f"{1000 * total / count:>12.1f}{1000 * peak:>12.1f}"
+        )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+
+    print("This module collects stage timings and serves them to /metrics")
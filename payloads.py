@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Read only views over decoded wsor payloads and an in-process payload cache.
+
+The table builders only see payloads through PayloadView, nested dicts and
+lists are wrapped lazily on access so nothing is copied and a builder that
+tries to write to a payload fails instead of changing it for every other
+request. That lets the memory cache hand the same decoded object to many
+concurrent renders. The memory cache is bounded by entry count and by the
+shared memory budget, see cache_budget.
+"""
+
+from time import time
+from os import getenv
+from collections import OrderedDict
+from collections.abc import Mapping, Sequence
+
+from shared_cache import SHARED_CACHE_TTL
+from lazy_json import LazyPayload
+from executor import native_lock
+from cache_budget import memory_budget, approx_size
+
+MEMORY_CACHE_SIZE = int(getenv("MEMORY_CACHE_SIZE", 64))
+
+
+class PayloadView(Mapping):
+    __slots__ = ("_data",)
+
+    def __init__(self, data):
+        self._data = data
+
+    def __getitem__(self, key):
+        return readonly(self._data[key])
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self._data!r})"
+
+
+class SequenceView(Sequence):
+    __slots__ = ("_data",)
+
+    def __init__(self, data):
+        self._data = data
+
+    def __getitem__(self, index):
+        return readonly(self._data[index])
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self._data!r})"
+
+
+def readonly(value):
+    if isinstance(value, (dict, LazyPayload)):
+        return PayloadView(value)
+    if isinstance(value, list):
+        return SequenceView(value)
+    return value
+
+
+def unwrap(value):
+    # only for handing a payload to code that copies it, i.e. pandas
+    # constructors, which are much faster on plain dicts
+    if isinstance(value, (PayloadView, SequenceView)):
+        return value._data
+    return value
+
+
+class MemoryCache:
+    """
+    LRU of decoded payloads shared by every request in this process.
+
+    Entries are handed out as is, callers must treat them as read only and
+    go through readonly() when building tables. Each entry keeps its size
+    and the seconds it took to produce for the memory budget, lazy payloads
+    are measured again when used since they grow as basins are decoded.
+    """
+
+    def __init__(
+        self,
+        maxsize=MEMORY_CACHE_SIZE,
+        expire_after=SHARED_CACHE_TTL,
+        budget=memory_budget,
+        name="payloads",
+    ):
+        self.maxsize = maxsize
+        self.expire_after = expire_after
+        self.budget = budget
+        # key -> [expires, value, size, cost, priority, resize]
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        # cached_state_summary fills the cache from cpu_executor threads
+        self._lock = native_lock()
+        if budget is not None:
+            budget.register(name, self)
+
+    def _priority(self, cost, size):
+        return 0.0 if self.budget is None else self.budget.priority(cost, size)
+
+    def _touch(self, entry):
+        if entry[5]:
+            size = approx_size(entry[1])
+            self._nbytes += size - entry[2]
+            entry[2] = size
+        entry[4] = self._priority(entry[3], entry[2])
+
+    def get(self, key, stale=False):
+        # expired entries are left for the LRU to drop, a revalidated payload
+        # can be put back as the same object with stale=True
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time() and not stale:
+                return None
+            self._entries.move_to_end(key)
+            self._touch(entry)
+            return entry[1]
+
+    def set(self, key, value, expire_after=None, cost=None, size=None):
+        # size excludes objects the value only refers to, i.e. the payloads
+        # kept next to a summary
+        if self.maxsize <= 0:
+            return
+        if expire_after is None:
+            expire_after = self.expire_after
+        resize = size is None and hasattr(value, "approx_size")
+        if size is None:
+            size = approx_size(value)
+        entry = [time() + expire_after, value, size, cost, 0.0, resize]
+        entry[4] = self._priority(cost, size)
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._nbytes -= old[2]
+            self._entries[key] = entry
+            self._nbytes += size
+            while len(self._entries) > self.maxsize:
+                _, old = self._entries.popitem(last=False)
+                self._nbytes -= old[2]
+        if self.budget is not None:
+            self.budget.enforce()
+
+    def evict(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return False
+            self._nbytes -= entry[2]
+            return True
+
+    def delete(self, key):
+        self.evict(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def budget_entries(self):
+        with self._lock:
+            return [(k, e[2], e[3], e[4]) for k, e in self._entries.items()]
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        return len(self._entries)
+
+
+memory_cache = MemoryCache()
+
+
+if __name__ == "__main__":
+
+    print("This module provides read only payload views and a payload cache")
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in cProfile and tracemalloc profiling of single requests or export runs.
+
+Only one profile runs at a time per process, cProfile can't nest and
+tracemalloc is process wide, so a request that arrives while another is
+being profiled is simply served unprofiled. Peak memory is the process peak
+while the profile was running.
+"""
+
+import re
+import pstats
+import cProfile
+import tracemalloc
+from io import StringIO
+from time import perf_counter, time
+from datetime import datetime as dt
+from collections import deque
+from contextlib import contextmanager
+from os import getenv, path, makedirs
+
+from executor import run_inline, native_lock
+
+THIS_DIR = path.dirname(path.realpath(__file__))
+PROFILE_DIR = getenv("PROFILE_DIR", path.join(THIS_DIR, "dbs", "profiles"))
+PROFILE_SAMPLE_RATE = float(getenv("PROFILE_SAMPLE_RATE", 0))
+PROFILE_KEEP = int(getenv("PROFILE_KEEP", 200))
+
+
+class Profiler:
+    def __init__(self, profile_dir=PROFILE_DIR, keep=PROFILE_KEEP):
+        self.profile_dir = profile_dir
+        self.records = deque(maxlen=keep)
+        self._lock = native_lock()
+
+    @contextmanager
+    def profile(self, name):
+        if not self._lock.acquire(False):
+            yield None
+            return
+        started_tracing = not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+        profiler = cProfile.Profile()
+        record = dict(name=name, started=time())
+        token = run_inline.set(True)
+        start = perf_counter()
+        profiler.enable()
+        try:
+            yield record
+        finally:
+            profiler.disable()
+            record["seconds"] = perf_counter() - start
+            run_inline.reset(token)
+            record["peak_mb"] = tracemalloc.get_traced_memory()[1] / 2**20
+            if started_tracing:
+                tracemalloc.stop()
+            self._lock.release()
+            record["file"] = self._save(profiler, record)
+            self.records.append(record)
+
+    def _save(self, profiler, record):
+        makedirs(self.profile_dir, exist_ok=True)
+        slug = re.sub(r"[^a-zA-Z0-9]+", "_", record["name"]).strip("_")[:60]
+        filename = f"{dt.fromtimestamp(record['started']):%Y%m%d_%H%M%S_%f}_{slug}.prof"
+        profiler.dump_stats(path.join(self.profile_dir, filename))
+        return filename
+
+    def slowest(self, n=20):
+        return sorted(self.records, key=lambda r: r["seconds"], reverse=True)[:n]
+
+
+def top_stats(profile_path, limit=25, sort="cumulative"):
+    stream = StringIO()
+    stats = pstats.Stats(profile_path, stream=stream)
+    stats.sort_stats(sort).print_stats(limit)
+    return stream.getvalue()
+
+
+request_profiler = Profiler()
+
+
+if __name__ == "__main__":
+
+    print("This module profiles requests and export runs on demand")
@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+"""
+Station search across states and basin types.
+
+An inverted index from station triplet and name tokens to the basins whose
+reports list the station, built from the site_meta of fetched payloads. Each
+state and basin type is a source that is re-indexed on its own when its
+payloads change, the index is persisted as gzipped json so every process
+and restart starts from it, and lookups are prefix matches on a sorted token
+list. Report pages only queue their payloads, a background thread merges
+them into the index and saves it SEARCH_SAVE_DELAY seconds later.
+"""
+
+import re
+import gzip
+import json
+import tempfile
+import weakref
+import atexit
+import threading
+from time import sleep, monotonic
+from contextlib import contextmanager
+from heapq import nsmallest
+from itertools import count
+from bisect import bisect_left, insort
+from os import getenv, path, makedirs, replace, stat
+from urllib.parse import urlsplit, parse_qs
+
+from lazy_json import peek
+
+try:
+    import fcntl
+except ImportError:
+    # windows
+    fcntl = None
+    import msvcrt
+
+THIS_DIR = path.dirname(path.realpath(__file__))
+SEARCH_INDEX_PATH = getenv(
+    "SEARCH_INDEX_PATH", path.join(THIS_DIR, "dbs", "station_index.json.gz")
+)
+SEARCH_TABLES = dict(
+    fcst="getFcstData", snow="getSnowData", prec="getPrecData", res="getResData"
+)
+LOCK_TIMEOUT = 30
+# reports fetched meanwhile are merged into the index in one save
+SEARCH_SAVE_DELAY = float(getenv("SEARCH_SAVE_DELAY", 2))
+
+
+def tokenize(text):
+    return re.findall(r"[a-z0-9]+", str(text).lower())
+
+
+def _try_lock(lock_file):
+    try:
+        if fcntl is not None:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        else:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        return False
+    return True
+
+
+def _unlock(lock_file):
+    if fcntl is not None:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+    else:
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+@contextmanager
+def file_lock(lock_path, timeout=LOCK_TIMEOUT):
+    # polled rather than blocking so a gevent worker keeps serving meanwhile
+    makedirs(path.dirname(lock_path) or ".", exist_ok=True)
+    with open(lock_path, "a+b") as lock_file:
+        deadline = monotonic() + timeout
+        while not _try_lock(lock_file):
+            if monotonic() > deadline:
+                raise TimeoutError(f"could not lock {lock_path} in {timeout}s")
+            sleep(0.01)
+        try:
+            yield
+        finally:
+            _unlock(lock_file)
+
+
+def _ref(payload):
+    try:
+        return weakref.ref(payload)
+    except TypeError:
+        # plain dicts can not be weakly referenced and are held until the
+        # source is updated from other payloads, live payloads are lazy ones
+        return lambda: payload
+
+
+def payload_stations(report_data):
+    stations = {}
+    for table in SEARCH_TABLES:
+        payload = report_data.get(table) or {}
+        for basin in payload:
+            # peek so indexing does not leave every basin of a lazy payload
+            # decoded in the payload caches
+            basin_data = peek(payload, basin)
+            for triplet, meta in ((basin_data or {}).get("site_meta") or {}).items():
+                key = (basin, triplet)
+                if key not in stations:
+                    stations[key] = [triplet, (meta or {}).get("name") or "", basin, []]
+                stations[key][3].append(table)
+    return sorted(stations.values())
+
+
+class StationIndex:
+    def __init__(self, index_path=SEARCH_INDEX_PATH, delay=SEARCH_SAVE_DELAY):
+        self.index_path = index_path
+        self.delay = delay
+        self._mtime = None
+        self._loaded = False
+        self._lock = threading.RLock()
+        # weak refs to the payloads each source was last updated from, the
+        # same payloads are not scanned again on every request
+        self._seen = {}
+        # sources waiting for the background save, with their payload refs
+        self._pending = {}
+        self._saver = None
+        self._reset()
+
+    def _reset(self):
+        self._sources = {}
+        # stations get an int id, postings are sets of ids and _rank orders
+        # ids by name so the best results are picked without sorting dicts
+        self._ids = count()
+        self._stations = {}
+        self._source_ids = {}
+        self._postings = {}
+        self._tokens = []
+        self._rank = {}
+
+    def _add_source(self, source, entry):
+        state, basin_type = source.split("/")
+        self._sources[source] = entry
+        ids = self._source_ids[source] = []
+        for triplet, name, basin, tables in entry["stations"]:
+            station_id = next(self._ids)
+            ids.append(station_id)
+            tokens = tokenize(f"{triplet} {name}")
+            self._stations[station_id] = (
+                dict(
+                    triplet=triplet,
+                    name=name,
+                    state=state,
+                    basin_type=basin_type,
+                    basin=basin,
+                    tables=tables,
+                    year=entry["year"],
+                    month=entry["month"],
+                ),
+                tokens,
+            )
+            for token in tokens:
+                if token not in self._postings:
+                    self._postings[token] = set()
+                    insort(self._tokens, token)
+                self._postings[token].add(station_id)
+
+    def _remove_source(self, source):
+        if self._sources.pop(source, None) is None:
+            return
+        for station_id in self._source_ids.pop(source):
+            _, tokens = self._stations.pop(station_id)
+            for token in tokens:
+                ids = self._postings.get(token)
+                if ids is None:
+                    continue
+                ids.discard(station_id)
+                if not ids:
+                    del self._postings[token]
+                    del self._tokens[bisect_left(self._tokens, token)]
+
+    def _rerank(self):
+        def sort_key(station_id):
+            r = self._stations[station_id][0]
+            return (r["name"].lower(), r["state"], r["basin_type"], r["basin"])
+
+        ranked = sorted(self._stations, key=sort_key)
+        self._rank = {station_id: n for n, station_id in enumerate(ranked)}
+
+    def _file_mtime(self):
+        try:
+            return stat(self.index_path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _reload_if_changed(self):
+        mtime = self._file_mtime()
+        if self._loaded and mtime == self._mtime:
+            return
+        self._reset()
+        if mtime is not None:
+            with gzip.open(self.index_path, "rt", encoding="utf-8") as index_file:
+                sources = json.load(index_file)
+            for source, entry in sources.items():
+                self._add_source(source, entry)
+        self._rerank()
+        self._mtime = mtime
+        self._loaded = True
+
+    def _save(self):
+        index_dir = path.dirname(self.index_path) or "."
+        makedirs(index_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=index_dir, delete=False) as tmp:
+            with gzip.open(tmp, "wt", encoding="utf-8") as index_file:
+                json.dump(self._sources, index_file, separators=(",", ":"))
+        replace(tmp.name, self.index_path)
+        self._mtime = self._file_mtime()
+
+    def _seen_before(self, source, month, payloads):
+        for seen in (self._pending.get(source), self._seen.get(source)):
+            if seen is not None and seen[0] == month:
+                if all(ref() is p for ref, p in zip(seen[1], payloads)):
+                    return True
+        return False
+
+    def _prepare(self, state, basin_type, year, month, report_data):
+        source = f"{state}/{basin_type}"
+        month = (int(year), int(month))
+        payloads = [report_data.get(table) for table in SEARCH_TABLES]
+        with self._lock:
+            if self._seen_before(source, month, payloads):
+                return None
+        stations = payload_stations(report_data)
+        if not stations:
+            return None
+        return source, (month, [_ref(p) for p in payloads], stations)
+
+    def _merge(self, updates):
+        # other processes update the same file, the index is reloaded and
+        # saved under a lock so their sources are merged rather than lost
+        changed = []
+        with self._lock, file_lock(f"{self.index_path}.lock"):
+            self._reload_if_changed()
+            for source, (month, _, stations) in updates.items():
+                entry = self._sources.get(source)
+                if entry is not None:
+                    if (entry["year"], entry["month"]) > month:
+                        continue
+                    if entry["stations"] == stations:
+                        continue
+                self._remove_source(source)
+                self._add_source(
+                    source, dict(year=month[0], month=month[1], stations=stations)
+                )
+                changed.append(source)
+            if changed:
+                self._rerank()
+                self._save()
+        return changed
+
+    def _apply(self, updates):
+        # a busy lock or unwritable index never fails the report being indexed
+        try:
+            changed = self._merge(updates)
+        except (TimeoutError, OSError) as error:
+            print(f"Could not update the station index - {error}")
+            with self._lock:
+                # reloaded from the file, the unsaved sources are indexed again
+                # the next time their reports are fetched
+                self._loaded = False
+            return []
+        with self._lock:
+            for source, (month, refs, _) in updates.items():
+                self._seen[source] = (month, refs)
+        return changed
+
+    def update(self, state, basin_type, year, month, report_data):
+        prepared = self._prepare(state, basin_type, year, month, report_data)
+        if prepared is None:
+            return False
+        return bool(self._apply(dict([prepared])))
+
+    def update_later(self, state, basin_type, year, month, report_data):
+        # for the page path, saved by a background thread after delay seconds
+        prepared = self._prepare(state, basin_type, year, month, report_data)
+        if prepared is None:
+            return
+        source, update = prepared
+        with self._lock:
+            self._pending[source] = update
+            if self._saver is None:
+                self._saver = threading.Thread(
+                    target=self._save_later, name="station-index", daemon=True
+                )
+                self._saver.start()
+
+    def _save_later(self):
+        sleep(self.delay)
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            updates, self._pending = self._pending, {}
+            self._saver = None
+        return self._apply(updates) if updates else []
+
+    def search(self, query, limit=20):
+        terms = tokenize(query)
+        if not terms:
+            return []
+        with self._lock:
+            self._reload_if_changed()
+            matches = None
+            for term in terms:
+                ids = set()
+                i = bisect_left(self._tokens, term)
+                while i < len(self._tokens) and self._tokens[i].startswith(term):
+                    ids |= self._postings[self._tokens[i]]
+                    i += 1
+                matches = ids if matches is None else matches & ids
+                if not matches:
+                    return []
+            # stations matching a whole name or triplet token come first
+            exact = matches & set().union(*(self._postings.get(t, ()) for t in terms))
+            rank = self._rank.__getitem__
+            best = nsmallest(limit, exact, key=rank)
+            if len(best) < limit:
+                best += nsmallest(limit - len(best), matches - exact, key=rank)
+            return [dict(self._stations[station_id][0]) for station_id in best]
+
+    def __len__(self):
+        with self._lock:
+            self._reload_if_changed()
+            return len(self._stations)
+
+
+station_index = StationIndex()
+atexit.register(station_index.flush)
+
+
+def rebuild_from_cache(cache, index=station_index):
+    # one report per state and basin type, the latest month in the cache
+    latest = {}
+    for url, payload in cache.items(contains="/wsor/"):
+        parts = urlsplit(url)
+        params = {k: v[0] for k, v in parse_qs(parts.query).items()}
+        tables = {v: k for k, v in SEARCH_TABLES.items()}
+        table = tables.get(parts.path.rsplit("/", 1)[-1])
+        if table is None or "state" not in params or "basinType" not in params:
+            continue
+        source = (params["state"], params["basinType"])
+        month = (int(params.get("pubYear", 0)), int(params.get("pubMonth", 0)))
+        if source not in latest or latest[source][0] < month:
+            latest[source] = (month, {})
+        if latest[source][0] == month:
+            latest[source][1][table] = payload
+    updated = 0
+    for (state, basin_type), ((year, month), report_data) in latest.items():
+        updated += index.update(state, basin_type, year, month, report_data)
+    return updated
+
+
+if __name__ == "__main__":
+
+    import argparse
+    from time import perf_counter
+
+    cli_desc = """
+    Rebuild the station search index from the shared payload cache and run
+    a lookup against it
+    """
+    parser = argparse.ArgumentParser(description=cli_desc)
+    parser.add_argument("query", nargs="?", help="station name or triplet prefix")
+    parser.add_argument(
+        "--rebuild", help="re-index the shared payload cache", action="store_true"
+    )
+    args = parser.parse_args()
+
+    if args.rebuild:
+        from shared_cache import payload_cache
+
+        print(f"Re-indexed {rebuild_from_cache(payload_cache)} state/basin types")
+    print(f"{len(station_index)} stations in {station_index.index_path}")
+    if args.query:
+        start = perf_counter()
+        results = station_index.search(args.query)
+        elapsed = perf_counter() - start
+        for result in results:
+            print(
+                f"  {result['triplet']:<16}{result['name']:<32}{result['state']} "
+                f"{result['basin_type']:<6}{result['basin']}"
+            )
+        print(f"{len(results)} results in {1000 * elapsed:.3f} ms")
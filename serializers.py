@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+JSON serialization of the processed basin tables for the data API.
+
+Tables are sent column oriented, numeric columns go straight from their
+numpy arrays to orjson when it is installed, the stdlib json module is used
+as a fallback.
+"""
+
+import json
+from math import isnan
+
+import numpy as np
+import pandas as pd
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from utils import forecasts, snowpack_sites, precipitation, reservoirs
+
+TABLE_BUILDERS = {
+    "fcst": forecasts,
+    "snow": snowpack_sites,
+    "prec": precipitation,
+    "res": reservoirs,
+}
+
+
+def _clean(value):
+    if isinstance(value, float) and isnan(value):
+        return None
+    if isinstance(value, np.generic):
+        return _clean(value.item())
+    return value
+
+
+def _json_default(obj):
+    if isinstance(obj, np.ndarray):
+        return [_clean(i) for i in obj.tolist()]
+    if isinstance(obj, np.generic):
+        return _clean(obj.item())
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def dumps(obj):
+    if orjson is not None:
+        return orjson.dumps(
+            obj, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS
+        )
+    return json.dumps(obj, default=_json_default, separators=(",", ":")).encode(
+        "utf-8"
+    )
+
+
+def table_columns(df):
+    if df.empty:
+        return None
+    if isinstance(df.index, pd.MultiIndex):
+        df = df.reset_index(names=["Streamflow Forecasts", "Forecast Period"])
+    df = df.infer_objects()
+    columns = {}
+    for col in df.columns:
+        series = df[col]
+        if pd.api.types.is_numeric_dtype(series):
+            columns[str(col)] = series.to_numpy(dtype=np.float64)
+        else:
+            columns[str(col)] = [_clean(i) for i in series.tolist()]
+    return dict(columns=[str(i) for i in df.columns], data=columns)
+
+
+def basin_index(basin, payloads):
+    index = {}
+    for wsor_json in payloads.values():
+        index.update(wsor_json.get(basin, {}).get("basin_index", None) or {})
+    return index
+
+
+def basin_tables(basin, payloads):
+    tables = {}
+    for table, builder in TABLE_BUILDERS.items():
+        wsor_json = payloads[table]
+        if basin not in wsor_json:
+            tables[table] = None
+            continue
+        tables[table] = table_columns(builder(basin, wsor_json))
+    return dict(basin_index=basin_index(basin, payloads), tables=tables)
+
+
+def state_tables(payloads, basins=None):
+    if basins is None:
+        basins = list(payloads["fcst"].keys())
+    return {basin: basin_tables(basin, payloads) for basin in basins}
+
+
+if __name__ == "__main__":
+
+    print("This module serializes the basin tables for the data api")
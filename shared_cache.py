@@ -0,0 +1,335 @@
+# -*- coding: utf-8 -*-
+"""
+Cross-process payload cache shared by every gunicorn worker and export run.
+
+Entries live in a sqlite database in WAL mode so readers never block on a
+writer. Writers take the write lock up front (BEGIN IMMEDIATE) and hold it
+only for a single upsert, so there is at most one writer at a time and no
+lock upgrades that can deadlock between processes.
+
+Validators (ETag, Last-Modified and a digest of the body) are kept next to
+each payload so an expired entry can be revalidated with a conditional
+request instead of downloading it again, expired rows stay readable with
+stale=True until purge_expired removes them. The time it took to fetch each
+payload is kept too, shrink() drops the entries cheapest to fetch again per
+byte first when the disk budget runs out.
+"""
+
+import json
+import zlib
+import sqlite3
+import threading
+from time import time
+from os import getenv, getpid, path, makedirs
+
+import lazy_json
+
+THIS_DIR = path.dirname(path.realpath(__file__))
+SHARED_CACHE_PATH = getenv(
+    "SHARED_CACHE_PATH", path.join(THIS_DIR, "dbs", "shared_cache.db")
+)
+SHARED_CACHE_TTL = 24 * 60 * 60
+SHARED_CACHE_TIMEOUT = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS payloads (
+    key TEXT PRIMARY KEY,
+    value BLOB NOT NULL,
+    created REAL NOT NULL,
+    expires REAL NOT NULL
+)
+"""
+VALIDATORS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS validators (
+    key TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    digest TEXT NOT NULL,
+    size INTEGER NOT NULL
+)
+"""
+COSTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS costs (
+    key TEXT PRIMARY KEY,
+    seconds REAL NOT NULL
+)
+"""
+
+
+def encode_value(value):
+    return zlib.compress(lazy_json.dumps(value))
+
+
+def decode_value(blob, lazy=False):
+    if lazy:
+        return lazy_json.loads(zlib.decompress(blob))
+    return json.loads(zlib.decompress(blob))
+
+
+class SharedCache:
+    def __init__(
+        self,
+        db_path=SHARED_CACHE_PATH,
+        expire_after=SHARED_CACHE_TTL,
+        timeout=SHARED_CACHE_TIMEOUT,
+    ):
+        self.db_path = db_path
+        self.expire_after = expire_after
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connect(self):
+        # one connection per thread and per process, sqlite connections must
+        # not cross a fork or be shared between threads
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == getpid():
+            return conn
+        makedirs(path.dirname(self.db_path) or ".", exist_ok=True)
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.timeout,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        conn.execute(f"PRAGMA busy_timeout={int(self.timeout * 1000)}")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(SCHEMA)
+        conn.execute(VALIDATORS_SCHEMA)
+        conn.execute(COSTS_SCHEMA)
+        self._local.conn = conn
+        self._local.pid = getpid()
+        return conn
+
+    def _write(self, sql, params=(), *statements):
+        # extra (sql, params) statements run in the same transaction
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            cursor = conn.execute(sql, params)
+            rowcount = cursor.rowcount
+            for extra_sql, extra_params in statements:
+                conn.execute(extra_sql, extra_params)
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return rowcount
+
+    def get(self, key, default=None, stale=False, lazy=False):
+        sql = "SELECT value FROM payloads WHERE key = ?"
+        params = [key]
+        if not stale:
+            sql += " AND expires > ?"
+            params.append(time())
+        row = self._connect().execute(sql, params).fetchone()
+        if row is None:
+            return default
+        return decode_value(row[0], lazy)
+
+    def set(self, key, value, expire_after=None, validators=None, cost=None):
+        if expire_after is None:
+            expire_after = self.expire_after
+        now = time()
+        if validators is None:
+            validators_sql = ("DELETE FROM validators WHERE key = ?", (key,))
+        else:
+            validators_sql = (
+                "INSERT OR REPLACE INTO validators "
+                "(key, etag, last_modified, digest, size) VALUES (?, ?, ?, ?, ?)",
+                (
+                    key,
+                    validators.get("etag"),
+                    validators.get("last_modified"),
+                    validators["digest"],
+                    validators["size"],
+                ),
+            )
+        if cost is None:
+            cost_sql = ("DELETE FROM costs WHERE key = ?", (key,))
+        else:
+            cost_sql = (
+                "INSERT OR REPLACE INTO costs (key, seconds) VALUES (?, ?)",
+                (key, cost),
+            )
+        self._write(
+            "INSERT OR REPLACE INTO payloads (key, value, created, expires) "
+            "VALUES (?, ?, ?, ?)",
+            (key, encode_value(value), now, now + expire_after),
+            validators_sql,
+            cost_sql,
+        )
+
+    def touch(self, key, expire_after=None):
+        # a revalidated entry is fresh again without rewriting its value
+        if expire_after is None:
+            expire_after = self.expire_after
+        return self._write(
+            "UPDATE payloads SET expires = ? WHERE key = ?",
+            (time() + expire_after, key),
+        )
+
+    def validators(self, key):
+        row = (
+            self._connect()
+            .execute(
+                "SELECT v.etag, v.last_modified, v.digest, v.size "
+                "FROM validators v JOIN payloads p ON p.key = v.key WHERE v.key = ?",
+                (key,),
+            )
+            .fetchone()
+        )
+        if row is None:
+            return None
+        return dict(zip(("etag", "last_modified", "digest", "size"), row))
+
+    def delete(self, key):
+        return self._write(
+            "DELETE FROM payloads WHERE key = ?",
+            (key,),
+            ("DELETE FROM validators WHERE key = ?", (key,)),
+            ("DELETE FROM costs WHERE key = ?", (key,)),
+        )
+
+    def purge_expired(self):
+        return self._write(
+            "DELETE FROM payloads WHERE expires <= ?",
+            (time(),),
+            ("DELETE FROM validators WHERE key NOT IN (SELECT key FROM payloads)", ()),
+            ("DELETE FROM costs WHERE key NOT IN (SELECT key FROM payloads)", ()),
+        )
+
+    def clear(self):
+        return self._write(
+            "DELETE FROM payloads",
+            (),
+            ("DELETE FROM validators", ()),
+            ("DELETE FROM costs", ()),
+        )
+
+    def _entry_costs(self):
+        # (key, stored bytes, fetch seconds, expires), unknown costs count as 0
+        return (
+            self._connect()
+            .execute(
+                "SELECT p.key, length(p.value), coalesce(c.seconds, 0), p.expires "
+                "FROM payloads p LEFT JOIN costs c ON c.key = p.key"
+            )
+            .fetchall()
+        )
+
+    def shrink(self, nbytes):
+        # drops at least nbytes of stored payloads, expired entries first,
+        # then the lowest fetch seconds per byte
+        rows = self._entry_costs()
+        now = time()
+        rows.sort(key=lambda r: (r[3] > now, r[2] / max(r[1], 1), r[3]))
+        excess = nbytes
+        keys = []
+        for key, size, _, _ in rows:
+            if excess <= 0:
+                break
+            keys.append(key)
+            excess -= size
+        for key in keys:
+            self.delete(key)
+        if keys:
+            # hand the wal back to the file system too
+            self._connect().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        return len(keys)
+
+    def largest(self, limit=20):
+        rows = sorted(self._entry_costs(), key=lambda r: r[1], reverse=True)
+        return [
+            dict(key=key, size=size, cost=cost, expired=expires <= time())
+            for key, size, cost, expires in rows[:limit]
+        ]
+
+    def items(self, contains=None):
+        sql = "SELECT key, value FROM payloads WHERE expires > ?"
+        params = [time()]
+        if contains is not None:
+            sql += " AND instr(key, ?) > 0"
+            params.append(contains)
+        for key, value in self._connect().execute(sql, params).fetchall():
+            yield key, decode_value(value)
+
+    def __contains__(self, key):
+        row = (
+            self._connect()
+            .execute(
+                "SELECT 1 FROM payloads WHERE key = ? AND expires > ?",
+                (key, time()),
+            )
+            .fetchone()
+        )
+        return row is not None
+
+
+payload_cache = SharedCache()
+
+
+def _stress_worker(args):
+    import random
+
+    db_path, worker_id, n_ops, n_keys = args
+    cache = SharedCache(db_path=db_path)
+    rng = random.Random(worker_id)
+    stats = dict(reads=0, hits=0, writes=0, errors=0)
+    for op in range(n_ops):
+        key = f"key-{rng.randrange(n_keys)}"
+        if rng.random() < 0.2:
+            value = {"key": key, "writer": worker_id, "data": list(range(op % 500))}
+            cache.set(key, value)
+            stats["writes"] += 1
+        else:
+            value = cache.get(key)
+            stats["reads"] += 1
+            if value is None:
+                continue
+            stats["hits"] += 1
+            if value["key"] != key or value["data"] != list(range(len(value["data"]))):
+                stats["errors"] += 1
+    return stats
+
+
+if __name__ == "__main__":
+
+    import sys
+    import argparse
+    import tempfile
+    from multiprocessing import Pool
+
+    cli_desc = """
+    Stress test the shared payload cache with many concurrent processes
+    """
+    parser = argparse.ArgumentParser(description=cli_desc)
+    parser.add_argument(
+        "-p", "--processes", help="worker processes", default=16, type=int
+    )
+    parser.add_argument(
+        "-n", "--ops", help="operations per process", default=2000, type=int
+    )
+    parser.add_argument("-k", "--keys", help="distinct keys", default=50, type=int)
+    parser.add_argument("--db", help="cache db path, defaults to a temp file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_path = args.db or path.join(tmp_dir, "stress.db")
+        jobs = [(db_path, i, args.ops, args.keys) for i in range(args.processes)]
+        start = time()
+        with Pool(args.processes) as pool:
+            results = pool.map(_stress_worker, jobs)
+        elapsed = time() - start
+
+    totals = {k: sum(r[k] for r in results) for k in results[0]}
+    n_ops = totals["reads"] + totals["writes"]
+    print(
+        f"{args.processes} processes, {n_ops} ops in {elapsed:.2f}s "
+        f"({n_ops / elapsed:,.0f} ops/s)"
+    )
+    print(
+        f"  reads: {totals['reads']}, hits: {totals['hits']}, "
+        f"writes: {totals['writes']}, corrupt reads: {totals['errors']}"
+    )
+    sys.exit(1 if totals["errors"] else 0)
@@ -0,0 +1,300 @@
+# -*- coding: utf-8 -*-
+"""
+Prebuilt publication snapshots.
+
+publish() fetches every state and basin type for a publication month once
+and writes one versioned snapshot file holding the raw wsor payloads, the
+basin hierarchies and the rendered report tables of every basin. A small
+CURRENT file in SNAPSHOT_DIR names the snapshot to serve, it is replaced
+atomically so a new snapshot goes live without restarting the app.
+
+Each worker memory maps the current snapshot at startup and checks CURRENT
+at most every SNAPSHOT_CHECK_INTERVAL seconds, requests already holding
+the old snapshot finish with it. Files are never rewritten in place, only
+new versions are added, which keeps the swap safe on windows too.
+
+File layout: MAGIC, the byte length of the index, the json index mapping
+entry keys to (offset, length) and the entry blobs.
+"""
+
+import json
+import struct
+import tempfile
+import threading
+from mmap import mmap, ACCESS_READ
+from time import monotonic
+from datetime import datetime
+from os import getenv, path, makedirs, replace, listdir, remove
+
+import lazy_json
+from metrics import count_cache
+from cache_budget import disk_budget
+
+THIS_DIR = path.dirname(path.realpath(__file__))
+SNAPSHOT_DIR = getenv("SNAPSHOT_DIR", path.join(THIS_DIR, "snapshots"))
+SNAPSHOT_CHECK_INTERVAL = float(getenv("SNAPSHOT_CHECK_INTERVAL", 5))
+SNAPSHOT_KEEP = int(getenv("SNAPSHOT_KEEP", 3))
+CURRENT_FILE = "CURRENT"
+MAGIC = b"WSORSNAP1\n"
+HEADER = struct.Struct("<Q")
+TABLES = ("fcst", "snow", "prec", "res")
+
+
+def payload_key(state, basin_type, table):
+    return f"payload/{state}/{basin_type}/{table}"
+
+
+def hierarchy_key(state):
+    return f"hierarchy/{state}"
+
+
+def tables_key(state, basin_type, basin):
+    return f"tables/{state}/{basin_type}/{basin.lower()}"
+
+
+class Snapshot:
+    def __init__(self, snapshot_path):
+        self.path = snapshot_path
+        with open(snapshot_path, "rb") as snapshot_file:
+            # the mapping stays valid after the file is closed
+            self._map = mmap(snapshot_file.fileno(), 0, access=ACCESS_READ)
+        if self._map[: len(MAGIC)] != MAGIC:
+            raise ValueError(f"{snapshot_path} is not a wsor snapshot")
+        start = len(MAGIC) + HEADER.size
+        (index_size,) = HEADER.unpack_from(self._map, len(MAGIC))
+        index = json.loads(self._map[start : start + index_size])
+        self._data_start = start + index_size
+        self._entries = index.pop("entries")
+        self.meta = index
+        self.version = index["version"]
+        self.year = index["year"]
+        self.month = index["month"]
+        self._payloads = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def read(self, key):
+        offset, length = self._entries[key]
+        start = self._data_start + offset
+        return self._map[start : start + length]
+
+    def covers(self, year, month):
+        return (int(year), int(month)) == (self.year, self.month)
+
+    def payload(self, state, basin_type, table):
+        # one decoded payload per snapshot so the summaries and station
+        # records derived from it stay cached by identity
+        key = payload_key(state, basin_type, table)
+        payload = self._payloads.get(key)
+        if payload is None and key in self._entries:
+            with self._lock:
+                payload = self._payloads.get(key)
+                if payload is None:
+                    payload = self._payloads[key] = lazy_json.loads(self.read(key))
+        return payload
+
+    def report_data(self, state, basin_type):
+        if payload_key(state, basin_type, "fcst") not in self._entries:
+            return None
+        return {t: self.payload(state, basin_type, t) for t in TABLES}
+
+    def hierarchy(self, state):
+        key = hierarchy_key(state)
+        if key not in self._entries:
+            return None
+        return json.loads(self.read(key))
+
+    def basin_tables(self, state, basin_type, basin):
+        key = tables_key(state, basin_type, basin)
+        if key not in self._entries:
+            return None
+        return json.loads(self.read(key))
+
+    def owns(self, report_data):
+        fcst = report_data.get("fcst")
+        return any(fcst is payload for payload in self._payloads.values())
+
+    def stats(self):
+        return dict(
+            self.meta,
+            path=self.path,
+            size=len(self._map),
+            entries=len(self._entries),
+            decoded=len(self._payloads),
+        )
+
+
+class SnapshotStore:
+    """
+    The snapshot named by CURRENT, reloaded when CURRENT changes.
+    """
+
+    def __init__(self, snapshot_dir=SNAPSHOT_DIR, interval=SNAPSHOT_CHECK_INTERVAL):
+        self.snapshot_dir = snapshot_dir
+        self.interval = interval
+        self._snapshot = None
+        self._name = None
+        self._checked = None
+        self._lock = threading.Lock()
+        self._reload()
+
+    def _current_name(self):
+        try:
+            with open(path.join(self.snapshot_dir, CURRENT_FILE)) as current:
+                return current.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def current(self):
+        checked = self._checked
+        if checked is not None and monotonic() - checked < self.interval:
+            return self._snapshot
+        with self._lock:
+            if self._checked == checked:
+                self._reload()
+        return self._snapshot
+
+    def _reload(self):
+        name = self._current_name()
+        if name != self._name:
+            snapshot = None
+            if name is not None:
+                try:
+                    snapshot = Snapshot(path.join(self.snapshot_dir, name))
+                except (OSError, ValueError) as error:
+                    print(f"Could not load snapshot {name} - {error}")
+                    name = self._name
+                    snapshot = self._snapshot
+            # a single assignment, readers see the old or the new snapshot
+            self._snapshot, self._name = snapshot, name
+        self._checked = monotonic()
+
+    def report_data(self, state, year, month, basin_type):
+        snapshot = self.current()
+        if snapshot is None or not snapshot.covers(year, month):
+            return None
+        report_data = snapshot.report_data(state, basin_type)
+        count_cache("snapshot", report_data is not None, endpoint="report_data")
+        return report_data
+
+    def hierarchy(self, state):
+        snapshot = self.current()
+        return None if snapshot is None else snapshot.hierarchy(state)
+
+    def version_of(self, report_data):
+        snapshot = self.current()
+        if snapshot is not None and snapshot.owns(report_data):
+            return snapshot.version
+        return None
+
+    def basin_tables(self, version, state, basin_type, basin):
+        snapshot = self.current()
+        if version is None or snapshot is None or snapshot.version != version:
+            return None
+        tables = snapshot.basin_tables(state, basin_type, basin)
+        count_cache("snapshot", tables is not None, endpoint="basin_tables")
+        return tables
+
+    def stats(self):
+        snapshot = self.current()
+        return None if snapshot is None else snapshot.stats()
+
+
+def write_snapshot(snapshot_dir, version, meta, entries):
+    makedirs(snapshot_dir, exist_ok=True)
+    index, offset = {}, 0
+    for key, blob in entries.items():
+        index[key] = (offset, len(blob))
+        offset += len(blob)
+    header = json.dumps(dict(meta, version=version, entries=index)).encode("utf-8")
+    name = f"wsor_{version}.snap"
+    # write then rename so a worker never maps a partial snapshot
+    with tempfile.NamedTemporaryFile(dir=snapshot_dir, delete=False) as tmp:
+        tmp.write(MAGIC)
+        tmp.write(HEADER.pack(len(header)))
+        tmp.write(header)
+        for blob in entries.values():
+            tmp.write(blob)
+    replace(tmp.name, path.join(snapshot_dir, name))
+    return name
+
+
+def activate(snapshot_dir, name, keep=SNAPSHOT_KEEP):
+    with tempfile.NamedTemporaryFile(
+        "w", dir=snapshot_dir, delete=False, suffix=".tmp"
+    ) as tmp:
+        tmp.write(name)
+    replace(tmp.name, path.join(snapshot_dir, CURRENT_FILE))
+    # old versions may still be mapped by a worker, removing them fails on
+    # windows and they are tried again after the next publication
+    older = [
+        path.join(snapshot_dir, i)
+        for i in listdir(snapshot_dir)
+        if i.endswith(".snap") and i != name
+    ]
+    older.sort(key=path.getmtime)
+    for old in older[: max(len(older) + 1 - keep, 0)]:
+        try:
+            remove(old)
+        except OSError:
+            pass
+
+
+def publish(year, month, states, basin_types, snapshot_dir=SNAPSHOT_DIR):
+    # the client and table builders import pandas and the api client, only
+    # the publish command needs them
+    from api_client import get_report_data, get_hierarchy
+    from utils import basin_report_tables
+
+    entries = {}
+    for state in states:
+        hierarchy = None
+        for basin_type in basin_types:
+            print(f"  {state} {basin_type}...")
+            report_data = get_report_data(
+                state=state,
+                year=year,
+                month=month,
+                basin_type=basin_type,
+                snapshot=False,
+            )
+            if not report_data["fcst"]:
+                # left to the live path rather than published empty
+                print(f"    No data for {state} {basin_type}, skipped")
+                continue
+            if basin_type == "minor" and hierarchy is None:
+                hierarchy = get_hierarchy(state=state, snapshot=False)
+            for table in TABLES:
+                entries[payload_key(state, basin_type, table)] = lazy_json.dumps(
+                    report_data[table]
+                )
+            for basin in report_data["fcst"]:
+                tables = basin_report_tables(basin, *(report_data[t] for t in TABLES))
+                entries[tables_key(state, basin_type, basin)] = json.dumps(
+                    tables, separators=(",", ":")
+                ).encode("utf-8")
+        if hierarchy is not None:
+            entries[hierarchy_key(state)] = json.dumps(hierarchy).encode("utf-8")
+    created = datetime.now()
+    version = f"{year}-{month:02d}_{created:%Y%m%dT%H%M%S}"
+    meta = dict(
+        year=year,
+        month=month,
+        created=created.isoformat(timespec="seconds"),
+        states=list(states),
+        basin_types=list(basin_types),
+    )
+    name = write_snapshot(snapshot_dir, version, meta, entries)
+    activate(snapshot_dir, name)
+    return path.join(snapshot_dir, name)
+
+
+snapshot_store = SnapshotStore()
+disk_budget.track_dir("snapshots", SNAPSHOT_DIR)
+
+
+if __name__ == "__main__":
+
+    print("This module publishes and serves prebuilt publication snapshots")
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""
+Compact per basin station records decoded from wsor payloads.
+
+A basin's site_meta and station series are turned once into aligned arrays,
+one row per station triplet in sorted order, and memoized by a digest of the
+basin's json so every table built from the same data shares the decoding,
+whichever copy of the payload it comes from. Payloads decoded in full have
+no json to digest and are not cached. The station cache counts against the
+shared memory budget, see cache_budget.
+"""
+
+from os import getenv
+from time import perf_counter
+from hashlib import blake2b
+from collections import OrderedDict
+
+import numpy as np
+
+from payloads import unwrap
+from lazy_json import raw_value
+from cache_budget import memory_budget
+from executor import native_lock
+
+STATION_CACHE_SIZE = int(getenv("STATION_CACHE_SIZE", 256))
+
+
+def _float_array(values):
+    return np.array([np.nan if v is None else v for v in values], dtype=np.float64)
+
+
+class BasinSites:
+    __slots__ = ("triplets", "names", "networks", "elevations", "series")
+
+    def __init__(self, triplets, names, networks, elevations, series):
+        self.triplets = triplets
+        self.names = names
+        self.networks = networks
+        self.elevations = elevations
+        self.series = series
+
+    @classmethod
+    def from_payload(cls, basin_data, metrics=()):
+        site_meta = basin_data["site_meta"]
+        columns = {metric: basin_data[metric] or {} for metric in metrics}
+        triplets = sorted(set(site_meta).union(*columns.values()))
+        meta = [site_meta.get(triplet) or {} for triplet in triplets]
+        return cls(
+            triplets=triplets,
+            names=[m.get("name") for m in meta],
+            networks=[
+                m["stationTriplet"].split(":")[-1] if "stationTriplet" in m else None
+                for m in meta
+            ],
+            elevations=_float_array(m.get("elevation") for m in meta),
+            series={
+                metric: _float_array(column.get(t) for t in triplets)
+                for metric, column in columns.items()
+            },
+        )
+
+    def __len__(self):
+        return len(self.triplets)
+
+    def labels(self, with_network=False):
+        if not with_network:
+            return list(self.names)
+        return [
+            None if name is None else f"{name} ({network})"
+            for name, network in zip(self.names, self.networks)
+        ]
+
+    def elevation_labels(self):
+        return [
+            np.nan if np.isnan(elevation) else f"{elevation:.0f}'"
+            for elevation in self.elevations
+        ]
+
+    @property
+    def nbytes(self):
+        return self.elevations.nbytes + sum(a.nbytes for a in self.series.values())
+
+    def approx_size(self):
+        # the arrays plus the triplet, name and network strings
+        return self.nbytes + 3 * 64 * len(self.triplets)
+
+
+class StationCache:
+    def __init__(self, maxsize=STATION_CACHE_SIZE, budget=memory_budget):
+        self.maxsize = maxsize
+        self.budget = budget
+        # key -> [sites, size, cost, priority]
+        self._entries = OrderedDict()
+        self._nbytes = 0
+        self._lock = native_lock()
+        if budget is not None:
+            budget.register("stations", self)
+
+    def _priority(self, cost, size):
+        return 0.0 if self.budget is None else self.budget.priority(cost, size)
+
+    def get(self, key, build):
+        # build() makes the BasinSites on a miss
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                entry[3] = self._priority(entry[2], entry[1])
+                return entry[0]
+        start = perf_counter()
+        sites = build()
+        cost = perf_counter() - start
+        size = sites.approx_size()
+        entry = [sites, size, cost, self._priority(cost, size)]
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = entry
+            self._nbytes += size
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+        if self.budget is not None:
+            self.budget.enforce()
+        return sites
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self._nbytes -= entry[1]
+        return True
+
+    def evict(self, key):
+        with self._lock:
+            return self._remove(key)
+
+    def budget_entries(self):
+        with self._lock:
+            return [(k, e[1], e[2], e[3]) for k, e in self._entries.items()]
+
+    @property
+    def nbytes(self):
+        return self._nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+
+station_cache = StationCache()
+
+
+def basin_sites(wsor_json, basin, metrics=()):
+    payload = unwrap(wsor_json)
+    raw = raw_value(payload, basin)
+    if raw is None:
+        return BasinSites.from_payload(payload[basin], metrics)
+    key = (blake2b(raw, digest_size=16).digest(), tuple(metrics))
+    return station_cache.get(
+        key, lambda: BasinSites.from_payload(payload[basin], metrics)
+    )
+
+
+if __name__ == "__main__":
+
+    print("This module decodes basin station records from wsor payloads")
@@ -114,7 +114,7 @@ def style_fcst(bfcst, basin_name):
     s.set_properties(subset=slice_, **{"text-align": "center"})
 
     s.set_table_styles(headers)
-    s.hide_index()
+    s.hide(axis="index")
 
     return s
 
@@ -198,7 +198,7 @@ def style_res(bres, basin_name):
     ]
     s.set_properties(subset=slice_, **{"text-align": "center"})
 
-    s.hide_index()
+    s.hide(axis="index")
     return s
 
 
@@ -324,7 +324,7 @@ def style_snow(bsnow, basin_name):
     ]
     s.set_properties(subset=slice_, **{"text-align": "center"})
 
-    s.hide_index()
+    s.hide(axis="index")
 
     return s
 
@@ -375,7 +375,7 @@ def style_snowpack(snowpack):
     slice_ = idx[:, ["# of Sites", "% Median", "Last Yr % Median"]]
     s.set_properties(subset=slice_, **{"text-align": "center"})
 
-    s.hide_index()
+    s.hide(axis="index")
 
     return s
 
@@ -0,0 +1,51 @@
+import sys
+import tempfile
+import threading
+from types import SimpleNamespace
+from os import environ, path
+
+import pytest
+
+ROOT = path.dirname(path.dirname(path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+# the caches, queues and indexes the modules open at import go to a scratch
+# directory, never to the ones under the repo
+SCRATCH = tempfile.mkdtemp(prefix="wsor_tests_")
+environ.update(
+    SHARED_CACHE_PATH=path.join(SCRATCH, "shared_cache.db"),
+    CACHE_PATH=path.join(SCRATCH, "cache.db"),
+    UPSTREAM_DB_PATH=path.join(SCRATCH, "upstream.db"),
+    SEARCH_INDEX_PATH=path.join(SCRATCH, "search_index.json.gz"),
+    SNAPSHOT_DIR=path.join(SCRATCH, "snapshots"),
+    SESSION_FILE_DIR=path.join(SCRATCH, "flask_session"),
+    PROFILE_DIR=path.join(SCRATCH, "profiles"),
+    FIXTURE_DIR=path.join(SCRATCH, "fixtures"),
+)
+
+
+@pytest.fixture(scope="session")
+def fake_api():
+    """
+    benchmarks.fake_api served from a thread, with its url and the
+    (path, status) of every response it sent
+    """
+    from werkzeug.serving import make_server
+    from benchmarks.fake_api import app
+
+    statuses = []
+
+    def recorded(environ, start_response):
+        def start(status, headers, *args):
+            statuses.append((environ["PATH_INFO"], int(status[:3])))
+            return start_response(status, headers, *args)
+
+        return app(environ, start)
+
+    server = make_server("127.0.0.1", 0, recorded, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield SimpleNamespace(
+        url=f"http://127.0.0.1:{server.server_port}", app=app, statuses=statuses
+    )
+    server.shutdown()
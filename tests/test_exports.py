@@ -0,0 +1,85 @@
+import io
+import csv
+
+import pytest
+import pandas as pd
+import pyarrow.parquet as pq
+
+from serializers import TABLE_BUILDERS
+from exports import (
+    TABLE_COLUMNS,
+    CsvSink,
+    ParquetSink,
+    csv_header,
+    csv_text,
+    export_columns,
+    report_tables,
+    write_tables,
+)
+from benchmarks.synthetic import report_payloads
+
+
+@pytest.fixture
+def report():
+    # the second basin forecasts other exceedances than the first
+    report = report_payloads(state="OR", n_basins=2, n_sites=2, n_periods=2)
+    first, second = report["fcst"]
+    for forecast in report["fcst"][second]["fcst_curr"].values():
+        for period, values in forecast.items():
+            forecast[period] = {"10": values["5"], "50": values["50"], "90": 1.5}
+    return report, first, second
+
+
+def fcst_tables(report):
+    return report_tables("OR", 2022, 4, "major", report, ["fcst"])
+
+
+def test_basins_with_other_exceedances_keep_their_columns(report):
+    report, first, second = report
+    text = csv_header("fcst") + csv_text(fcst_tables(report))
+
+    rows = list(csv.DictReader(io.StringIO(text)))
+    assert list(rows[0]) == export_columns("fcst")
+    first_rows = [r for r in rows if r["basin"] == first]
+    second_rows = [r for r in rows if r["basin"] == second]
+    assert first_rows and second_rows
+    assert all(r["30%"] != "" and r["70%"] != "" for r in first_rows)
+    assert all(r["30%"] == "" and r["70%"] == "" for r in second_rows)
+    assert all(float(r["90%"]) == 1.5 for r in second_rows)
+
+
+def test_parquet_schema_covers_every_basin(report, tmp_path):
+    report, _, second = report
+    sink = ParquetSink(str(tmp_path / "fcst.parquet"), "fcst")
+    write_tables(sink, fcst_tables(report))
+    sink.close()
+
+    df = pq.read_table(str(tmp_path / "fcst.parquet")).to_pandas()
+    assert list(df.columns) == export_columns("fcst")
+    assert df["90%"].dtype == "float64"
+    assert (df.loc[df["basin"] == second, "90%"] == 1.5).all()
+    assert df.loc[df["basin"] == second, "30%"].isna().all()
+
+
+def test_columns_outside_the_export_are_reported(report, tmp_path, capsys):
+    report, first, _ = report
+    for forecast in report["fcst"][first]["fcst_curr"].values():
+        for values in forecast.values():
+            values["25"] = 1.0
+    sink = CsvSink(str(tmp_path / "fcst.csv"), "fcst")
+    write_tables(sink, fcst_tables(report))
+    sink.close()
+
+    assert f"Columns 25% of the fcst table of {first}" in capsys.readouterr().out
+    with open(tmp_path / "fcst.csv", newline="") as csv_file:
+        assert next(csv.reader(csv_file)) == export_columns("fcst")
+
+
+@pytest.mark.parametrize("table", list(TABLE_COLUMNS))
+def test_export_columns_follow_the_builders(table):
+    report = report_payloads(state="OR", n_basins=2, n_sites=3, n_periods=1)
+    for basin in report["fcst"]:
+        df = TABLE_BUILDERS[table](basin, report[table])
+        if isinstance(df.index, pd.MultiIndex):
+            df = df.reset_index(names=TABLE_COLUMNS[table][:2])
+        assert list(df.columns) == TABLE_COLUMNS[table]
@@ -0,0 +1,29 @@
+import re
+
+import pytest
+
+from app import app
+from generate_static import export_html
+
+BASIN_LINK = re.compile(r"<a href='([^']*)'>")
+SESSIONS = dict(
+    flat=dict(basins=["boise", "upper snake"], hierarchy=None),
+    hierarchy=dict(
+        basins=["boise", "upper snake"],
+        hierarchy={"snake": ["boise", "upper snake"]},
+    ),
+)
+
+
+@pytest.mark.parametrize("form", list(SESSIONS))
+def test_exported_index_links_the_basin_pages(form):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session.update(SESSIONS[form], state="ID")
+    response = client.get("/basins", headers={"X-Static-Export": "1"})
+    assert response.status_code == 200
+
+    links = BASIN_LINK.findall(export_html(response.get_data(as_text=True)))
+
+    assert {"./boise.html", "./upper snake.html", "./summary.html"} <= set(links)
+    assert all(link.endswith(".html") for link in links), links
@@ -0,0 +1,91 @@
+from time import sleep
+
+import pytest
+
+from jobs import JobQueue, task_group, format_status
+
+MONTH = (2022, 3, "OR", "major")
+TASKS = [(*MONTH, ""), (*MONTH, "basin 0"), (*MONTH, "basin 1")]
+
+
+@pytest.fixture
+def queue(tmp_path):
+    jobs = JobQueue(str(tmp_path), lease=0.2, max_attempts=2, retry_delay=0.1)
+    jobs.enqueue(TASKS)
+    return jobs
+
+
+def test_enqueue_keeps_known_tasks(queue):
+    assert queue.enqueue(TASKS) == 0
+    assert queue.enqueue(TASKS + [(2022, 4, "OR", "major", "")]) == 1
+    assert queue.remaining() == 4
+
+
+def test_claimed_tasks_are_handed_out_once(queue):
+    claimed = [queue.claim("a") for _ in TASKS]
+    assert sorted(t["basin"] for t in claimed) == ["", "basin 0", "basin 1"]
+    assert queue.claim("b") is None
+    for task in claimed:
+        assert queue.complete(task)
+    assert queue.remaining() == 0
+    assert queue.status()["counts"] == {"done": 3}
+
+
+def test_claim_prefers_the_workers_page_group(queue):
+    queue.enqueue([(2021, 1, "OR", "major", "")])
+    first = queue.claim("a")
+    assert (first["year"], first["month"]) == (2021, 1)
+    assert task_group(queue.claim("a", prefer=MONTH)) == MONTH
+
+
+def test_expired_lease_is_claimed_again(queue):
+    dead = queue.claim("dead")
+    sleep(0.25)
+    others = [queue.claim("alive") for _ in TASKS]
+    again = next(t for t in others if t["id"] == dead["id"])
+    assert again["worker"] == "alive"
+    assert again["attempts"] == 2
+    # the worker that lost the lease can not finish or fail the task
+    assert not queue.complete(dead)
+    assert queue.fail(dead, "late") is None
+    assert queue.complete(again)
+
+
+def test_failed_task_is_retried_after_a_delay_then_given_up(queue):
+    # tasks are claimed in key order, the index page first
+    task = queue.claim("a")
+    assert queue.fail(task, "boom") == "pending"
+    assert queue.claim("a")["id"] != task["id"]
+    sleep(0.15)
+    retried = queue.claim("a")
+    assert retried["id"] == task["id"]
+    assert retried["attempts"] == 2
+    assert queue.fail(retried, "boom again") == "failed"
+    assert queue.failures() == [
+        dict(key=retried["key"], attempts=2, error="boom again")
+    ]
+
+
+def test_retry_failed_resets_the_attempts(queue):
+    task = queue.claim("a")
+    queue.fail(task, "boom")
+    sleep(0.15)
+    queue.fail(queue.claim("a"), "boom")
+    assert queue.remaining() == 2
+    assert queue.retry_failed() == 1
+    again = queue.claim("a")
+    assert again["id"] == task["id"]
+    assert again["attempts"] == 1
+
+
+def test_status_reports_progress(queue):
+    queue.complete(queue.claim("a"))
+    queue.claim("b")
+    status = queue.status()
+    assert status["total"] == 3
+    assert status["remaining"] == 2
+    assert status["workers"] == {"b": 1}
+    assert status["rate"] > 0
+    text = format_status(status)
+    assert "1 done, 1 leased, 1 pending, 0 failed" in text
+    assert "b: 1 leased" in text
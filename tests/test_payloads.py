@@ -0,0 +1,72 @@
+import pytest
+
+import lazy_json
+from payloads import PayloadView, SequenceView, MemoryCache, readonly, unwrap
+
+
+@pytest.fixture
+def payload():
+    return {
+        "Basin": {
+            "site_meta": {"1:OR:SNTL": {"name": "Peak", "elevation": 5000}},
+            "snow_curr": {"1:OR:SNTL": 12.5},
+            "periods": ["APR-JUL", "APR-SEP"],
+        }
+    }
+
+
+def test_views_wrap_nested_values_without_copying(payload):
+    view = readonly(payload)
+    basin = view["Basin"]
+    assert isinstance(view, PayloadView)
+    assert isinstance(basin, PayloadView)
+    assert isinstance(basin["periods"], SequenceView)
+    assert basin["site_meta"]["1:OR:SNTL"]["name"] == "Peak"
+    assert list(basin["periods"]) == ["APR-JUL", "APR-SEP"]
+    assert unwrap(basin) is payload["Basin"]
+    assert unwrap(basin["periods"]) is payload["Basin"]["periods"]
+
+
+def test_views_can_not_change_the_payload(payload):
+    basin = readonly(payload)["Basin"]
+    with pytest.raises(TypeError):
+        basin["snow_curr"] = {}
+    with pytest.raises(TypeError):
+        basin["periods"][0] = "OCT-SEP"
+    with pytest.raises(AttributeError):
+        basin.update(snow_curr={})
+    with pytest.raises(AttributeError):
+        basin["periods"].append("OCT-SEP")
+    assert payload["Basin"]["snow_curr"] == {"1:OR:SNTL": 12.5}
+
+
+def test_views_work_like_the_payload(payload):
+    view = readonly(payload)
+    assert "Basin" in view and "Other" not in view
+    assert len(view) == 1 and list(view) == ["Basin"]
+    assert view.get("Other") is None
+    assert dict(view["Basin"]["snow_curr"]) == payload["Basin"]["snow_curr"]
+    assert readonly(12.5) == 12.5
+
+
+def test_lazy_payloads_are_viewed_one_basin_at_a_time(payload):
+    lazy = lazy_json.loads(lazy_json.dumps(payload))
+    view = readonly(lazy)
+    assert isinstance(view, PayloadView)
+    assert lazy.decoded == 0
+    assert view["Basin"]["snow_curr"]["1:OR:SNTL"] == 12.5
+    assert lazy.decoded == 1
+
+
+def test_memory_cache_hands_out_the_same_object_and_keeps_it_stale():
+    cache = MemoryCache(maxsize=2, budget=None)
+    value = {"a": 1}
+    cache.set("a", value)
+    assert cache.get("a") is value
+    cache.set("a", value, expire_after=-1)
+    assert cache.get("a") is None
+    assert cache.get("a", stale=True) is value
+    cache.set("b", {})
+    cache.set("c", {})
+    assert len(cache) == 2
+    assert cache.get("a", stale=True) is None
@@ -0,0 +1,76 @@
+from urllib.parse import urlencode
+
+import api_client
+from payloads import memory_cache
+from shared_cache import payload_cache
+from metrics import revalidations, revalidated_bytes
+
+ENDPOINT = "getSnowData"
+WSOR_PATH = f"/wsor/{ENDPOINT}"
+
+
+def fetch(domain, state):
+    return api_client.get_wsor_data(ENDPOINT, state, 2022, 1, "major", domain=domain)
+
+
+def payload_url(domain, state):
+    params = dict(state=state, pubMonth=1, pubYear=2022, basinType="major")
+    return f"{domain}/wsor/{ENDPOINT}?{urlencode(params)}"
+
+
+def expire(url):
+    # both payload caches, the http cache keeps its own copy
+    memory_cache.set(url, memory_cache.get(url), expire_after=-1)
+    payload_cache.touch(url, expire_after=-1)
+
+
+def count(state, result):
+    labels = dict(endpoint=ENDPOINT, state=state, basin_type="major")
+    return revalidations.value(result=result, **labels), revalidated_bytes.value(
+        **labels
+    )
+
+
+def test_expired_payload_is_revalidated_with_a_304(fake_api):
+    first = fetch(fake_api.url, "WA")
+    assert fake_api.statuses[-1] == (WSOR_PATH, 200)
+    expire(payload_url(fake_api.url, "WA"))
+    api_client.trim_http_cache(expired=False)
+    before, saved = count("WA", "not_modified")
+
+    second = fetch(fake_api.url, "WA")
+
+    assert fake_api.statuses[-1] == (WSOR_PATH, 304)
+    assert second is first
+    after, saved_after = count("WA", "not_modified")
+    assert after == before + 1
+    assert saved_after > saved
+
+
+def test_unchanged_body_reuses_the_payload_by_digest(fake_api, monkeypatch):
+    # no ETag or Last-Modified, the client compares bodies instead
+    monkeypatch.setitem(fake_api.app.config, "VALIDATORS", False)
+    first = fetch(fake_api.url, "ID")
+    expire(payload_url(fake_api.url, "ID"))
+    api_client.trim_http_cache(expired=False)
+    before, _ = count("ID", "unchanged")
+
+    second = fetch(fake_api.url, "ID")
+
+    assert fake_api.statuses[-1] == (WSOR_PATH, 200)
+    assert second is first
+    assert count("ID", "unchanged")[0] == before + 1
+
+
+def test_http_cache_hit_is_not_counted_as_a_revalidation(fake_api):
+    first = fetch(fake_api.url, "MT")
+    expire(payload_url(fake_api.url, "MT"))
+    sent = len(fake_api.statuses)
+    before = [count("MT", i)[0] for i in ("not_modified", "unchanged", "changed")]
+
+    second = fetch(fake_api.url, "MT")
+
+    assert len(fake_api.statuses) == sent
+    assert second is first
+    after = [count("MT", i)[0] for i in ("not_modified", "unchanged", "changed")]
+    assert after == before
@@ -0,0 +1,57 @@
+from functools import partial
+
+import pytest
+
+import search
+from search import StationIndex, file_lock
+from benchmarks.synthetic import report_payloads
+
+
+@pytest.fixture
+def report():
+    return report_payloads(state="OR", n_basins=2, n_sites=3, n_periods=1)
+
+
+@pytest.fixture
+def index(tmp_path):
+    return StationIndex(str(tmp_path / "station_index.json.gz"), delay=0)
+
+
+def test_updated_report_is_searchable_from_the_file(index, report):
+    assert index.update("OR", "major", 2022, 4, report)
+    assert not index.update("OR", "major", 2022, 4, report)
+    fresh = StationIndex(index.index_path)
+    assert len(fresh) == len(index) > 0
+    assert fresh.search("mountain lake")
+
+
+def test_page_path_updates_are_saved_in_the_background(tmp_path, report):
+    index = StationIndex(str(tmp_path / "station_index.json.gz"), delay=0.2)
+    index.update_later("OR", "major", 2022, 4, report)
+    saver = index._saver
+    index.update_later("OR", "major", 2022, 4, report)
+    assert index._saver is saver
+    assert len(StationIndex(index.index_path)) == 0
+    saver.join(5)
+    assert index._pending == {}
+    assert len(StationIndex(index.index_path)) > 0
+
+
+def test_busy_lock_skips_the_update_until_the_next_fetch(
+    index, report, monkeypatch, capsys
+):
+    monkeypatch.setattr(search, "file_lock", partial(file_lock, timeout=0.05))
+    with file_lock(f"{index.index_path}.lock"):
+        assert not index.update("OR", "major", 2022, 4, report)
+    assert "Could not update the station index" in capsys.readouterr().out
+    assert len(index) == 0
+    # not remembered as indexed, the same payloads are indexed once saved
+    assert index.update("OR", "major", 2022, 4, report)
+    assert len(index) > 0
+
+
+def test_unwritable_index_does_not_fail_the_report(tmp_path, report):
+    (tmp_path / "dbs").write_text("a file where the directory should be")
+    index = StationIndex(str(tmp_path / "dbs" / "station_index.json.gz"))
+    assert not index.update("OR", "major", 2022, 4, report)
+    assert index.flush() == []
@@ -0,0 +1,67 @@
+from os import path
+from multiprocessing import get_context
+
+import pytest
+
+from lazy_json import LazyPayload
+from shared_cache import SharedCache, _stress_worker
+
+VALIDATORS = dict(etag='"abc"', last_modified=None, digest="d1", size=10)
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return SharedCache(db_path=str(tmp_path / "shared.db"), expire_after=60)
+
+
+def test_values_round_trip(cache):
+    value = {"Basin": {"site_meta": {}, "snow_curr": {"1:OR:SNTL": 1.5}}}
+    cache.set("url", value)
+    assert cache.get("url") == value
+    lazy = cache.get("url", lazy=True)
+    assert isinstance(lazy, LazyPayload)
+    assert dict(lazy) == value
+    assert "url" in cache
+    assert cache.get("missing", default=0) == 0
+
+
+def test_expired_entries_stay_readable_when_stale(cache):
+    cache.set("url", {"a": 1}, expire_after=-1, validators=VALIDATORS)
+    assert cache.get("url") is None
+    assert "url" not in cache
+    assert cache.get("url", stale=True) == {"a": 1}
+    assert cache.validators("url") == VALIDATORS
+    assert cache.touch("url") == 1
+    assert cache.get("url") == {"a": 1}
+
+
+def test_purge_drops_expired_entries_and_their_validators(cache):
+    cache.set("old", {"a": 1}, expire_after=-1, validators=VALIDATORS, cost=1.0)
+    cache.set("new", {"b": 2}, validators=VALIDATORS)
+    assert cache.purge_expired() == 1
+    assert cache.get("old", stale=True) is None
+    assert cache.validators("old") is None
+    assert cache.validators("new") == VALIDATORS
+
+
+def test_shrink_drops_expired_then_the_cheapest_per_byte(cache):
+    blob = list(range(2000))
+    cache.set("expired", {"v": blob}, expire_after=-1, cost=100.0)
+    cache.set("cheap", {"v": blob}, cost=0.01)
+    cache.set("dear", {"v": blob}, cost=10.0)
+    sizes = {e["key"]: e["size"] for e in cache.largest()}
+    assert cache.shrink(sizes["expired"] + 1) == 2
+    assert cache.get("cheap") is None
+    assert cache.get("dear") == {"v": blob}
+    assert cache.shrink(0) == 0
+
+
+def test_concurrent_processes_never_read_a_torn_value(tmp_path):
+    db_path = str(tmp_path / "stress.db")
+    jobs = [(db_path, i, 300, 10) for i in range(4)]
+    with get_context("spawn").Pool(4) as pool:
+        results = pool.map(_stress_worker, jobs)
+    assert sum(r["writes"] for r in results) > 0
+    assert sum(r["hits"] for r in results) > 0
+    assert sum(r["errors"] for r in results) == 0
+    assert path.isfile(db_path)
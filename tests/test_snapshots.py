@@ -0,0 +1,145 @@
+import json
+from os import listdir, path, utime
+
+import pytest
+
+import utils
+import api_client
+from snapshots import (
+    CURRENT_FILE,
+    TABLES,
+    Snapshot,
+    SnapshotStore,
+    activate,
+    publish,
+    write_snapshot,
+)
+from benchmarks.synthetic import report_payloads
+
+HIERARCHY = {"OR": {"KLAMATH": ["UPPER KLAMATH", "LOWER KLAMATH"]}}
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    # publish() fetches through the api client, served synthetic payloads here
+    calls = []
+
+    def get_report_data(state, year, month, basin_type, snapshot=True, **kwargs):
+        calls.append((state, year, month, basin_type, snapshot))
+        if basin_type == "misc":
+            return {t: {} for t in TABLES}
+        return report_payloads(
+            state=state,
+            basin_type=basin_type,
+            n_basins=3,
+            n_sites=4,
+            n_periods=2,
+            year=year,
+            month=month,
+        )
+
+    monkeypatch.setattr(api_client, "get_report_data", get_report_data)
+    monkeypatch.setattr(api_client, "get_hierarchy", lambda state, **kw: HIERARCHY)
+    return calls
+
+
+def test_written_snapshot_reads_back(tmp_path):
+    entries = {"a": b'{"x":1}', "b": b"", "c": b"[1,2,3]"}
+    name = write_snapshot(str(tmp_path), "v1", dict(year=2022, month=4), entries)
+    snapshot = Snapshot(str(tmp_path / name))
+    assert snapshot.version == "v1"
+    assert snapshot.covers("2022", "04") and not snapshot.covers(2022, 5)
+    for key, blob in entries.items():
+        assert snapshot.read(key) == blob
+    assert "d" not in snapshot
+    assert not [i for i in listdir(tmp_path) if not i.endswith(".snap")]
+
+
+def test_not_a_snapshot_is_rejected(tmp_path):
+    bogus = tmp_path / "wsor_bogus.snap"
+    bogus.write_bytes(b"not a snapshot at all")
+    with pytest.raises(ValueError):
+        Snapshot(str(bogus))
+
+
+def test_published_month_is_served(tmp_path, upstream):
+    publish(2022, 4, ["OR"], ["major", "minor", "misc"], snapshot_dir=str(tmp_path))
+    # published from the api, never from an older snapshot
+    assert {call[-1] for call in upstream} == {False}
+    store = SnapshotStore(str(tmp_path), interval=0)
+
+    expected = report_payloads(
+        state="OR", basin_type="major", n_basins=3, n_sites=4, n_periods=2
+    )
+    report_data = store.report_data("OR", 2022, 4, "major")
+    assert {t: dict(report_data[t]) for t in TABLES} == expected
+    # one decoded payload per snapshot
+    assert store.report_data("OR", 2022, 4, "major")["fcst"] is report_data["fcst"]
+    assert store.report_data("OR", 2022, 5, "major") is None
+    assert store.report_data("OR", 2022, 4, "misc") is None
+    assert store.hierarchy("OR") == HIERARCHY
+
+    version = store.version_of(report_data)
+    assert version is not None
+    assert store.version_of(expected) is None
+    for basin in expected["fcst"]:
+        tables = utils.basin_report_tables(basin, *(expected[t] for t in TABLES))
+        # round tripped through json like the live path's cache
+        tables = json.loads(json.dumps(tables))
+        assert store.basin_tables(version, "OR", "major", basin) == tables
+        assert store.basin_tables("other", "OR", "major", basin) is None
+
+
+def test_activation_swaps_the_snapshot_under_running_readers(tmp_path):
+    snapshot_dir = str(tmp_path)
+    store = SnapshotStore(snapshot_dir, interval=0)
+    assert store.current() is None
+
+    first = write_snapshot(snapshot_dir, "v1", dict(year=2022, month=3), {"k": b"1"})
+    activate(snapshot_dir, first)
+    held = store.current()
+    assert held.version == "v1"
+
+    second = write_snapshot(snapshot_dir, "v2", dict(year=2022, month=4), {"k": b"2"})
+    activate(snapshot_dir, second)
+    assert store.current().version == "v2"
+    # a request still holding the old snapshot finishes with it
+    assert held.read("k") == b"1"
+
+
+def test_store_rechecks_current_after_its_interval(tmp_path):
+    snapshot_dir = str(tmp_path)
+    activate(
+        snapshot_dir, write_snapshot(snapshot_dir, "v1", dict(year=2022, month=3), {})
+    )
+    store = SnapshotStore(snapshot_dir, interval=3600)
+    activate(
+        snapshot_dir, write_snapshot(snapshot_dir, "v2", dict(year=2022, month=4), {})
+    )
+    assert store.current().version == "v1"
+    store.interval = 0
+    assert store.current().version == "v2"
+
+
+def test_broken_snapshot_keeps_the_current_one(tmp_path):
+    snapshot_dir = str(tmp_path)
+    activate(
+        snapshot_dir, write_snapshot(snapshot_dir, "v1", dict(year=2022, month=3), {})
+    )
+    store = SnapshotStore(snapshot_dir, interval=0)
+    (tmp_path / CURRENT_FILE).write_text("wsor_missing.snap")
+    assert store.current().version == "v1"
+
+
+def test_activation_keeps_the_newest_versions(tmp_path):
+    snapshot_dir = str(tmp_path)
+    names = []
+    for i in range(5):
+        name = write_snapshot(snapshot_dir, f"v{i}", dict(year=2022, month=4), {})
+        # distinct mtimes, the oldest are pruned first
+        snapshot_path = path.join(snapshot_dir, name)
+        utime(snapshot_path, (1000 + i, 1000 + i))
+        names.append(name)
+        activate(snapshot_dir, name, keep=2)
+    assert sorted(i for i in listdir(snapshot_dir) if i.endswith(".snap")) == names[-2:]
+    assert (tmp_path / CURRENT_FILE).read_text() == names[-1]
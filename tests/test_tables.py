@@ -0,0 +1,86 @@
+"""
+The table builders against the tables the pandas builders of the first
+release rendered for the same synthetic payloads, kept in
+data/basin_tables.json.gz, whichever form the payloads are handed in.
+"""
+
+import gzip
+import json
+import copy
+from os import path
+
+import pytest
+
+import utils
+import lazy_json
+import serializers
+from payloads import readonly
+from stations import station_cache
+from benchmarks.synthetic import report_payloads
+
+TABLES = ("fcst", "snow", "prec", "res")
+EXPECTED_PATH = path.join(path.dirname(__file__), "data", "basin_tables.json.gz")
+
+
+@pytest.fixture(scope="module")
+def expected():
+    with gzip.open(EXPECTED_PATH, "rt", encoding="utf-8") as expected_file:
+        return json.load(expected_file)
+
+
+def payloads(basin_type):
+    return report_payloads(
+        state="OR", basin_type=basin_type, n_basins=3, n_sites=6, n_periods=2
+    )
+
+
+def as_lazy(payload):
+    return lazy_json.loads(lazy_json.dumps(payload))
+
+
+FORMS = dict(
+    plain=lambda payload: payload,
+    view=readonly,
+    lazy=as_lazy,
+)
+
+
+@pytest.mark.parametrize("basin_type", ["major", "misc"])
+@pytest.mark.parametrize("form", list(FORMS))
+def test_basin_report_tables_match_the_first_release(expected, basin_type, form):
+    report = payloads(basin_type)
+    data = {t: FORMS[form](report[t]) for t in TABLES}
+    for basin in report["fcst"]:
+        tables = utils.basin_report_tables(basin, *(data[t] for t in TABLES))
+        assert tables == expected[f"{basin_type}/{basin}"], basin
+
+
+def test_station_cache_hits_build_the_same_tables(expected):
+    report = payloads("major")
+    station_cache.clear()
+    for _ in range(2):
+        # a new copy of the payloads each time, as a session decodes them
+        data = {t: as_lazy(report[t]) for t in TABLES}
+        for basin in report["fcst"]:
+            tables = utils.basin_report_tables(basin, *(data[t] for t in TABLES))
+            assert tables == expected[f"major/{basin}"], basin
+        entries = len(station_cache)
+    assert entries > 0
+    assert len(station_cache) == entries
+
+
+def test_builders_leave_the_payloads_unchanged():
+    report = payloads("major")
+    before = copy.deepcopy(report)
+    for basin in report["fcst"]:
+        utils.basin_report_tables(basin, *(report[t] for t in TABLES))
+        serializers.basin_tables(basin, report)
+    assert report == before
+
+
+def test_api_tables_do_not_depend_on_the_payload_form():
+    report = payloads("misc")
+    lazy = {t: as_lazy(report[t]) for t in TABLES}
+    assert serializers.dumps(serializers.state_tables(lazy)) == serializers.dumps(
+        serializers.state_tables(report)
+    )
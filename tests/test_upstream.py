@@ -0,0 +1,158 @@
+import threading
+from time import sleep
+from types import SimpleNamespace
+
+import pytest
+
+from upstream import (
+    CircuitBreaker,
+    CircuitOpen,
+    TokenBucket,
+    UpstreamBusy,
+    UpstreamError,
+    UpstreamScheduler,
+    UpstreamTimeout,
+    budget,
+)
+
+URL = "http://upstream.test/wsor/getSnowData"
+HOST = "upstream.test"
+
+
+def ok(timeout):
+    return SimpleNamespace(status_code=200)
+
+
+def refused(timeout):
+    raise ConnectionError("refused")
+
+
+@pytest.fixture
+def scheduler(tmp_path):
+    bucket = TokenBucket(str(tmp_path / "upstream.db"), rate=0)
+    scheduler = UpstreamScheduler(concurrency=1, queue_timeout=0.5, bucket=bucket)
+    scheduler.hedging = False
+    return scheduler
+
+
+def open_breaker(scheduler, failures=5):
+    for _ in range(failures):
+        with pytest.raises(UpstreamError):
+            scheduler.request(URL, refused, "getSnowData")
+    breaker = scheduler._breaker(HOST)
+    assert breaker.state == "open"
+    return breaker
+
+
+def test_breaker_opens_after_repeated_failures_and_probes_once():
+    breaker = CircuitBreaker(failures=2, cooldown=0.1)
+    assert breaker.state == "closed"
+    breaker.record(False)
+    assert breaker.allow() and breaker.state == "closed"
+    breaker.record(False)
+    assert breaker.state == "open"
+    assert not breaker.allow()
+    sleep(0.12)
+    assert breaker.state == "half_open"
+    assert breaker.allow()
+    # one probe at a time while half open
+    assert not breaker.allow()
+    breaker.record(False)
+    assert breaker.state == "open"
+    sleep(0.12)
+    assert breaker.allow()
+    breaker.record(True)
+    assert breaker.state == "closed"
+    assert breaker.allow() and breaker.allow()
+
+
+def test_cancelled_probe_lets_the_next_one_through():
+    breaker = CircuitBreaker(failures=1, cooldown=0.05)
+    breaker.record(False)
+    sleep(0.06)
+    assert breaker.allow()
+    breaker.cancel()
+    assert breaker.allow()
+
+
+def test_open_circuit_fails_fast(scheduler):
+    open_breaker(scheduler)
+    calls = []
+    with pytest.raises(CircuitOpen):
+        scheduler.request(URL, lambda timeout: calls.append(timeout), "getSnowData")
+    assert calls == []
+
+
+def test_probe_is_released_on_any_exception(scheduler):
+    breaker = open_breaker(scheduler)
+    breaker.cooldown = 0
+
+    def broken(timeout):
+        raise ValueError("not a network error")
+
+    with pytest.raises(ValueError):
+        scheduler.request(URL, broken, "getSnowData")
+    assert scheduler.request(URL, ok, "getSnowData").status_code == 200
+    assert breaker.state == "closed"
+
+
+def test_waiting_for_admission_is_not_a_host_failure(scheduler):
+    release = scheduler.admit(URL)
+    try:
+        for _ in range(6):
+            with pytest.raises(UpstreamBusy):
+                scheduler.request(URL, ok, "getSnowData")
+    finally:
+        release()
+    assert scheduler._breaker(HOST).state == "closed"
+
+
+def test_timeout_starts_once_the_call_is_admitted(scheduler, monkeypatch):
+    monkeypatch.setenv("UPSTREAM_TIMEOUT_GETSNOWDATA", "0.2")
+    release = scheduler.admit(URL)
+    threading.Timer(0.3, release).start()
+    sent = []
+
+    def slow(timeout):
+        sent.append(timeout)
+        sleep(0.05)
+        return SimpleNamespace(status_code=200)
+
+    # queued for longer than the endpoint timeout, then answered in time
+    assert scheduler.request(URL, slow, "getSnowData").status_code == 200
+    assert 0 < sent[0] <= 0.2
+
+
+def test_slow_host_times_out_and_counts_as_a_failure(scheduler, monkeypatch):
+    monkeypatch.setenv("UPSTREAM_TIMEOUT_GETSNOWDATA", "0.05")
+
+    def hung(timeout):
+        sleep(0.2)
+        return SimpleNamespace(status_code=200)
+
+    with pytest.raises(UpstreamTimeout):
+        scheduler.request(URL, hung, "getSnowData")
+    assert scheduler._breaker(HOST)._failed == 1
+
+
+def test_spent_budget_skips_the_call(scheduler):
+    calls = []
+    with budget(0):
+        with pytest.raises(UpstreamTimeout):
+            scheduler.request(URL, lambda t: calls.append(t), "getSnowData")
+    assert calls == []
+    assert scheduler._breaker(HOST).state == "closed"
+
+
+def test_waiting_for_a_token_holds_no_host_slot(tmp_path):
+    bucket = TokenBucket(str(tmp_path / "upstream.db"), rate=10, burst=2)
+    scheduler = UpstreamScheduler(concurrency=1, queue_timeout=2, bucket=bucket)
+    scheduler.admit(URL, "batch")()
+    # the batch reserve is left, the next batch call waits for a token
+    batch = threading.Thread(target=lambda: scheduler.admit(URL, "batch")())
+    batch.start()
+    sleep(0.02)
+    release = scheduler.admit(URL, "interactive", timeout=0.01)
+    release()
+    batch.join(2)
+    assert scheduler.stats()["lanes"][f"{HOST}/batch"]["admitted"] == 2
@@ -0,0 +1,581 @@
+# -*- coding: utf-8 -*-
+"""
+Admission control for requests to API_SERVER.
+
+Every upstream request takes a concurrency slot for its host and a token
+from the host's token bucket. The buckets live in a small sqlite database so
+gunicorn workers and export runs on the same machine share one request
+rate. Requests run in a lane, batch traffic (backfills and exports) leaves a
+reserve of tokens to interactive requests and only gets a free slot when no
+interactive request is waiting for one in the same process.
+
+Calls are bounded by a per endpoint timeout and by the budget of the page
+they are made for. An interactive call still running past its endpoint's
+recent p95 latency is hedged with a duplicate and the first response wins,
+and a host that keeps failing trips a circuit breaker so callers fall back
+to cached data at once instead of waiting on it.
+"""
+
+import queue
+import sqlite3
+import threading
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from time import time, sleep, perf_counter, monotonic
+from functools import partial
+from urllib.parse import urlsplit
+from os import getenv, getpid, path, makedirs
+
+from metrics import registry
+
+THIS_DIR = path.dirname(path.realpath(__file__))
+UPSTREAM_DB_PATH = getenv("UPSTREAM_DB_PATH", path.join(THIS_DIR, "dbs", "upstream.db"))
+UPSTREAM_CONCURRENCY = int(getenv("UPSTREAM_CONCURRENCY", 8))
+UPSTREAM_BATCH_CONCURRENCY = int(getenv("UPSTREAM_BATCH_CONCURRENCY", 4))
+UPSTREAM_RATE = float(getenv("UPSTREAM_RATE", 10))
+UPSTREAM_BURST = float(getenv("UPSTREAM_BURST", 20))
+UPSTREAM_BATCH_RESERVE = float(getenv("UPSTREAM_BATCH_RESERVE", 5))
+UPSTREAM_QUEUE_TIMEOUT = float(getenv("UPSTREAM_QUEUE_TIMEOUT", 60))
+UPSTREAM_TIMEOUT = float(getenv("UPSTREAM_TIMEOUT", 20))
+# the budget for every upstream call made while building one page, well
+# under gunicorn's 120s worker timeout
+UPSTREAM_BUDGET = float(getenv("UPSTREAM_BUDGET", 45))
+UPSTREAM_HEDGE = getenv("UPSTREAM_HEDGE", "true").lower() in ("1", "true")
+UPSTREAM_HEDGE_QUANTILE = float(getenv("UPSTREAM_HEDGE_QUANTILE", 0.95))
+UPSTREAM_HEDGE_MIN = float(getenv("UPSTREAM_HEDGE_MIN", 0.5))
+UPSTREAM_HEDGE_DEFAULT = float(getenv("UPSTREAM_HEDGE_DEFAULT", 5))
+UPSTREAM_LATENCY_WINDOW = int(getenv("UPSTREAM_LATENCY_WINDOW", 200))
+UPSTREAM_BREAKER_FAILURES = int(getenv("UPSTREAM_BREAKER_FAILURES", 5))
+UPSTREAM_BREAKER_COOLDOWN = float(getenv("UPSTREAM_BREAKER_COOLDOWN", 30))
+BUCKET_LOCK_TIMEOUT = 30
+
+# seconds, overridden with i.e. UPSTREAM_TIMEOUT_GETFCSTDATA=40
+ENDPOINT_TIMEOUTS = dict(
+    getFcstData=30,
+    getSnowData=20,
+    getPrecData=20,
+    getResData=20,
+    getParents=10,
+    getBasins=10,
+)
+
+LANES = ("interactive", "batch")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS buckets (
+    host TEXT PRIMARY KEY,
+    tokens REAL NOT NULL,
+    updated REAL NOT NULL
+)
+"""
+
+_lane = ContextVar("upstream_lane", default="interactive")
+_deadline = ContextVar("upstream_deadline", default=None)
+
+queue_depth = registry.gauge(
+    "wsor_upstream_queue_depth", "Requests waiting for an upstream slot by lane"
+)
+queue_wait = registry.histogram(
+    "wsor_upstream_wait_seconds", "Time spent waiting for upstream admission by lane"
+)
+rejected = registry.counter(
+    "wsor_upstream_rejected_total", "Requests that timed out waiting for admission"
+)
+hedges = registry.counter(
+    "wsor_upstream_hedges_total", "Hedged upstream requests by endpoint and winner"
+)
+failures = registry.counter(
+    "wsor_upstream_failures_total", "Failed upstream calls by endpoint and reason"
+)
+circuit_open = registry.gauge(
+    "wsor_upstream_circuit_open", "1 while the circuit breaker for a host is open"
+)
+
+
+class UpstreamError(Exception):
+    pass
+
+
+class UpstreamBusy(UpstreamError):
+    pass
+
+
+class UpstreamTimeout(UpstreamError):
+    pass
+
+
+class CircuitOpen(UpstreamError):
+    pass
+
+
+def set_lane(lane):
+    if lane not in LANES:
+        raise ValueError(f"lane must be one of {LANES}")
+    return _lane.set(lane)
+
+
+def current_lane():
+    return _lane.get()
+
+
+@contextmanager
+def budget(seconds=UPSTREAM_BUDGET):
+    # nested budgets never extend the one they run in
+    deadline = perf_counter() + seconds
+    outer = _deadline.get()
+    token = _deadline.set(deadline if outer is None else min(outer, deadline))
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def endpoint_timeout(endpoint):
+    default = ENDPOINT_TIMEOUTS.get(endpoint, UPSTREAM_TIMEOUT)
+    return float(getenv(f"UPSTREAM_TIMEOUT_{endpoint.upper()}", default))
+
+
+class TokenBucket:
+    def __init__(
+        self,
+        db_path=UPSTREAM_DB_PATH,
+        rate=UPSTREAM_RATE,
+        burst=UPSTREAM_BURST,
+        batch_reserve=UPSTREAM_BATCH_RESERVE,
+    ):
+        self.db_path = db_path
+        self.rate = rate
+        self.burst = burst
+        self.batch_reserve = min(batch_reserve, burst - 1)
+        self._local = threading.local()
+
+    def _connect(self):
+        # same rules as the shared cache, a connection per thread and process
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and self._local.pid == getpid():
+            return conn
+        makedirs(path.dirname(self.db_path) or ".", exist_ok=True)
+        conn = sqlite3.connect(
+            self.db_path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        conn.execute("PRAGMA busy_timeout=30000")
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(SCHEMA)
+        # sqlite's busy handler sleeps in C and would stall every greenlet of
+        # a gevent worker, the write lock is polled in _begin instead
+        conn.execute("PRAGMA busy_timeout=0")
+        self._local.conn = conn
+        self._local.pid = getpid()
+        return conn
+
+    def _begin(self, conn):
+        deadline = monotonic() + BUCKET_LOCK_TIMEOUT
+        delay = 0.001
+        while True:
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                return
+            except sqlite3.OperationalError as error:
+                if "locked" not in str(error) or monotonic() > deadline:
+                    raise
+            # a patched sleep, other greenlets run meanwhile
+            sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+    def take(self, host, lane):
+        # takes a token and returns 0, or returns how long to wait for one
+        if self.rate <= 0:
+            return 0.0
+        floor = self.batch_reserve if lane == "batch" else 0.0
+        conn = self._connect()
+        self._begin(conn)
+        try:
+            now = time()
+            row = conn.execute(
+                "SELECT tokens, updated FROM buckets WHERE host = ?", (host,)
+            ).fetchone()
+            tokens = self.burst
+            if row is not None:
+                tokens = min(self.burst, row[0] + (now - row[1]) * self.rate)
+            wait = 0.0
+            if tokens - 1 >= floor:
+                tokens -= 1
+            else:
+                wait = (floor + 1 - tokens) / self.rate
+            conn.execute(
+                "INSERT OR REPLACE INTO buckets (host, tokens, updated) "
+                "VALUES (?, ?, ?)",
+                (host, tokens, now),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+
+class HostSlots:
+    def __init__(self, limit, batch_limit):
+        self.limit = limit
+        self.batch_limit = min(batch_limit, limit)
+        self.active = dict(interactive=0, batch=0)
+        self.waiting = dict(interactive=deque(), batch=deque())
+        self._cond = threading.Condition()
+
+    def _admissible(self, lane, ticket):
+        if self.waiting[lane][0] is not ticket:
+            return False
+        if sum(self.active.values()) >= self.limit:
+            return False
+        if lane == "batch":
+            return not self.waiting["interactive"] and (
+                self.active["batch"] < self.batch_limit
+            )
+        return True
+
+    def acquire(self, lane, timeout):
+        ticket = object()
+        with self._cond:
+            self.waiting[lane].append(ticket)
+            try:
+                admitted = self._cond.wait_for(
+                    lambda: self._admissible(lane, ticket), timeout
+                )
+            finally:
+                self.waiting[lane].remove(ticket)
+                # the next request in line may be admissible now
+                self._cond.notify_all()
+            if admitted:
+                self.active[lane] += 1
+            return admitted
+
+    def release(self, lane):
+        with self._cond:
+            self.active[lane] -= 1
+            self._cond.notify_all()
+
+
+class LatencyTracker:
+    def __init__(
+        self,
+        window=UPSTREAM_LATENCY_WINDOW,
+        quantile=UPSTREAM_HEDGE_QUANTILE,
+        minimum=UPSTREAM_HEDGE_MIN,
+        default=UPSTREAM_HEDGE_DEFAULT,
+    ):
+        self.window = window
+        self.quantile = quantile
+        self.minimum = minimum
+        self.default = default
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def observe(self, endpoint, seconds):
+        with self._lock:
+            samples = self._samples.get(endpoint)
+            if samples is None:
+                samples = self._samples[endpoint] = deque(maxlen=self.window)
+            samples.append(seconds)
+
+    def hedge_after(self, endpoint):
+        # the default until there are enough samples for a stable quantile
+        with self._lock:
+            samples = sorted(self._samples.get(endpoint, ()))
+        if len(samples) < 20:
+            return self.default
+        return max(self.minimum, samples[int(self.quantile * (len(samples) - 1))])
+
+
+class CircuitBreaker:
+    def __init__(
+        self, failures=UPSTREAM_BREAKER_FAILURES, cooldown=UPSTREAM_BREAKER_COOLDOWN
+    ):
+        self.failures = failures
+        self.cooldown = cooldown
+        self._failed = 0
+        self._opened = None
+        self._probing = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self._opened is None:
+            return "closed"
+        if monotonic() - self._opened < self.cooldown:
+            return "open"
+        return "half_open"
+
+    def allow(self):
+        # once the cooldown is over a single probe call goes through
+        with self._lock:
+            if self._opened is None:
+                return True
+            if self._probing or monotonic() - self._opened < self.cooldown:
+                return False
+            self._probing = True
+            return True
+
+    def cancel(self):
+        # the call that was let through never reached the host
+        with self._lock:
+            self._probing = False
+
+    def record(self, ok):
+        with self._lock:
+            self._probing = False
+            if ok:
+                self._failed = 0
+                self._opened = None
+                return
+            self._failed += 1
+            if self._opened is not None or self._failed >= self.failures:
+                self._opened = monotonic()
+
+
+def _attempt(n, call, results):
+    try:
+        results.put((n, call(), None))
+    except Exception as error:
+        results.put((n, None, error))
+
+
+class UpstreamScheduler:
+    def __init__(
+        self,
+        concurrency=UPSTREAM_CONCURRENCY,
+        batch_concurrency=UPSTREAM_BATCH_CONCURRENCY,
+        queue_timeout=UPSTREAM_QUEUE_TIMEOUT,
+        bucket=None,
+    ):
+        self.concurrency = concurrency
+        self.batch_concurrency = batch_concurrency
+        self.queue_timeout = queue_timeout
+        self.bucket = bucket or TokenBucket()
+        self.hedging = UPSTREAM_HEDGE
+        self.latency = LatencyTracker()
+        # host slots are created on first use, after gevent has patched
+        # threading in the gunicorn worker
+        self._hosts = {}
+        self._breakers = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _slots(self, host):
+        slots = self._hosts.get(host)
+        if slots is None:
+            slots = self._hosts.setdefault(
+                host, HostSlots(self.concurrency, self.batch_concurrency)
+            )
+        return slots
+
+    def _breaker(self, host):
+        breaker = self._breakers.get(host)
+        if breaker is None:
+            breaker = self._breakers.setdefault(host, CircuitBreaker())
+        return breaker
+
+    def _record(self, host, lane, **changes):
+        with self._lock:
+            stats = self._stats.setdefault(
+                (host, lane),
+                dict(admitted=0, rejected=0, wait_total=0.0, wait_max=0.0),
+            )
+            for key, value in changes.items():
+                if key.endswith("_max"):
+                    stats[key] = max(stats[key], value)
+                else:
+                    stats[key] += value
+
+    def admit(self, url, lane=None, timeout=None):
+        """
+        waits for a token and then a slot for the host of url and returns the
+        function that releases the slot
+        """
+        host = urlsplit(url).netloc
+        lane = lane or current_lane()
+        timeout = self.queue_timeout if timeout is None else timeout
+        slots = self._slots(host)
+        start = perf_counter()
+        deadline = start + timeout
+        # the token first, a caller waiting on the rate limit holds no host
+        # slot that another lane could use meanwhile
+        wait = self.bucket.take(host, lane)
+        while wait > 0:
+            if perf_counter() + wait > deadline:
+                self._reject(host, lane, timeout)
+            sleep(wait)
+            wait = self.bucket.take(host, lane)
+        queue_depth.inc(host=host, lane=lane)
+        try:
+            admitted = slots.acquire(lane, max(deadline - perf_counter(), 0))
+        finally:
+            queue_depth.inc(-1, host=host, lane=lane)
+        if not admitted:
+            self._reject(host, lane, timeout)
+        waited = perf_counter() - start
+        queue_wait.observe(waited, host=host, lane=lane)
+        self._record(host, lane, admitted=1, wait_total=waited, wait_max=waited)
+        return partial(slots.release, lane)
+
+    @contextmanager
+    def slot(self, url, lane=None):
+        release = self.admit(url, lane)
+        try:
+            yield
+        finally:
+            release()
+
+    def _reject(self, host, lane, timeout):
+        rejected.inc(host=host, lane=lane)
+        self._record(host, lane, rejected=1)
+        raise UpstreamBusy(f"no upstream slot for {host} ({lane}) within {timeout}s")
+
+    def _timed_send(self, url, endpoint, send, deadline, release=None):
+        # the first attempt is admitted by the caller, a hedge waits for its
+        # own slot and gives up when the call's deadline passes
+        if release is None:
+            release = self.admit(url, timeout=max(deadline - perf_counter(), 0))
+        try:
+            start = perf_counter()
+            response = send(max(deadline - start, 0.001))
+        finally:
+            release()
+        if not getattr(response, "from_cache", False):
+            self.latency.observe(endpoint, perf_counter() - start)
+        return response
+
+    def _hedged(self, attempt, endpoint, deadline, hedge_after=None):
+        # threads are greenlets under gevent, each runs in a copy of the
+        # caller's context so it keeps the lane and the metric labels.
+        # attempt(n) makes the n-th call, the first one was already admitted
+        results = queue.Queue()
+        hedge_at = None if hedge_after is None else perf_counter() + hedge_after
+        started = finished = 0
+        first_error = None
+        while True:
+            hedge = started == 1 and hedge_at is not None
+            if started == 0 or hedge and perf_counter() >= hedge_at:
+                threading.Thread(
+                    target=copy_context().run,
+                    args=(_attempt, started, partial(attempt, started), results),
+                    daemon=True,
+                ).start()
+                started += 1
+            wait = deadline - perf_counter()
+            if started == 1 and hedge_at is not None:
+                wait = min(wait, hedge_at - perf_counter())
+            try:
+                n, response, error = results.get(timeout=max(wait, 0))
+            except queue.Empty:
+                if perf_counter() >= deadline:
+                    raise UpstreamTimeout("no response before the deadline")
+                continue
+            finished += 1
+            if error is None:
+                if started > 1:
+                    hedges.inc(endpoint=endpoint, winner="hedge" if n else "first")
+                return response
+            if n == 0:
+                first_error = error
+            if finished == started:
+                # a hedge that found no free slot never reached the host
+                raise first_error or error
+
+    def request(self, url, send, endpoint):
+        """
+        send(timeout) under admission control, the endpoint timeout and the
+        current budget, hedged for interactive calls. The timeout and hedge
+        clocks start once the call is admitted
+        """
+        host = urlsplit(url).netloc
+        breaker = self._breaker(host)
+        if not breaker.allow():
+            failures.inc(endpoint=endpoint, reason="circuit_open")
+            raise CircuitOpen(f"circuit open for {host}, retrying upstream later")
+        try:
+            return self._request(url, send, endpoint, host, breaker)
+        except BaseException:
+            # a probe that did not record an outcome lets the next one through
+            breaker.cancel()
+            raise
+
+    def _request(self, url, send, endpoint, host, breaker):
+        budget_deadline = _deadline.get()
+        if budget_deadline is not None and budget_deadline <= perf_counter():
+            failures.inc(endpoint=endpoint, reason="budget")
+            raise UpstreamTimeout(f"request budget spent before {endpoint}")
+        wait = self.queue_timeout
+        if budget_deadline is not None:
+            wait = min(wait, budget_deadline - perf_counter())
+        # busy is raised here, waiting for admission is not a host failure
+        release = self.admit(url, timeout=wait)
+        timeout = endpoint_timeout(endpoint)
+        if budget_deadline is not None:
+            timeout = min(timeout, budget_deadline - perf_counter())
+        if timeout <= 0:
+            release()
+            failures.inc(endpoint=endpoint, reason="budget")
+            raise UpstreamTimeout(f"request budget spent before {endpoint}")
+        deadline = perf_counter() + timeout
+        hedge_after = None
+        if self.hedging and current_lane() == "interactive":
+            hedge_after = self.latency.hedge_after(endpoint)
+
+        def attempt(n):
+            return self._timed_send(
+                url, endpoint, send, deadline, release if n == 0 else None
+            )
+
+        try:
+            response = self._hedged(attempt, endpoint, deadline, hedge_after)
+        except (UpstreamTimeout, OSError) as error:
+            # requests' exceptions are OSErrors, it is not imported here
+            self._failed(host, breaker, endpoint, type(error).__name__)
+            if isinstance(error, UpstreamTimeout):
+                raise UpstreamTimeout(
+                    f"{endpoint} gave no response within {timeout:.1f}s"
+                ) from None
+            raise UpstreamError(f"{endpoint} failed: {error}") from error
+        if response.status_code >= 500:
+            self._failed(host, breaker, endpoint, str(response.status_code))
+        else:
+            breaker.record(True)
+            circuit_open.set(0, host=host)
+        return response
+
+    def _failed(self, host, breaker, endpoint, reason):
+        failures.inc(endpoint=endpoint, reason=reason)
+        breaker.record(False)
+        circuit_open.set(int(breaker.state != "closed"), host=host)
+
+    def stats(self):
+        with self._lock:
+            stats = {f"{h}/{lane}": dict(s) for (h, lane), s in self._stats.items()}
+        for host, slots in list(self._hosts.items()):
+            for lane in LANES:
+                entry = stats.setdefault(
+                    f"{host}/{lane}",
+                    dict(admitted=0, rejected=0, wait_total=0.0, wait_max=0.0),
+                )
+                entry.update(
+                    active=slots.active[lane], waiting=len(slots.waiting[lane])
+                )
+        for entry in stats.values():
+            entry["wait_avg"] = entry["wait_total"] / (entry["admitted"] or 1)
+        return dict(
+            lanes=stats,
+            circuits={h: b.state for h, b in list(self._breakers.items())},
+            hedge_after={
+                e: self.latency.hedge_after(e) for e in list(self.latency._samples)
+            },
+        )
+
+
+upstream = UpstreamScheduler()
+
+
+if __name__ == "__main__":
+
+    print("This module schedules requests to the upstream api")
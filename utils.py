@@ -5,25 +5,14 @@ Created on Wed Apr  6 11:38:41 2022
 @author: Nick.Steele
 """
 
-from functools import reduce
-from datetime import timedelta
-from os import getenv, path, makedirs
+from time import perf_counter
 
 import numpy as np
 import pandas as pd
-from requests_cache import CachedSession
-
-API_DOMAIN = getenv("API_SERVER", "https://api.snowdata.info")
-THIS_DIR = path.dirname(path.realpath(__file__))
-DB_DIR = path.join(THIS_DIR, "dbs")
-makedirs(DB_DIR, exist_ok=True)
-CACHE_PATH = getenv("CACHE_PATH", path.join(DB_DIR, "cache.db"))
-CACHE_REFRESH = timedelta(hours=24)
-CACHE_ARGS = {
-    "cache_name": CACHE_PATH,
-    "backend": "sqlite",
-    "expire_after": CACHE_REFRESH,
-}
+from metrics import timed, timed_stage
+from payloads import readonly, memory_cache
+from cache_budget import approx_size
+from stations import basin_sites
 
 
 def safe_percent(row, top_col, bottom_col):
@@ -37,53 +26,17 @@ def safe_percent(row, top_col, bottom_col):
     return percent
 
 
-def get_wsor_data(
-    endpoint,
-    state,
-    year,
-    month,
-    basin_type,
-    domain=API_DOMAIN,
-    cache_args=CACHE_ARGS,
-    force_refresh=False,
-):
-
-    endpoint = f"/wsor/{endpoint}"
-    args = f"?state={state}&pubMonth={month}&pubYear={year}&basinType={basin_type}"
-    url = f"{domain}{endpoint}{args}"
-    print(url)
-    if force_refresh:
-        cache_args["expire_after"] = 0
-    with CachedSession(**cache_args) as sesh:
-        req = sesh.get(url)
-        if req.ok:
-            wsor_json = req.json()
-        else:
-            print("An error occurred while attempting to retrieve data from the API.")
-            wsor_json = {}
-
-    return wsor_json
-
-
-def get_hierarchy(state, domain=API_DOMAIN, cache_args=CACHE_ARGS, force_refresh=False):
-
-    endpoint = "/basin/getParents"
-    args = f"?state={state}&format=json"
-    url = f"{domain}{endpoint}{args}"
-    print(url)
-    if force_refresh:
-        cache_args["expire_after"] = 0
-    with CachedSession(**cache_args) as sesh:
-        req = sesh.get(url)
-        if req.ok:
-            basin_hierarchy_json = req.json()
-        else:
-            print("An error occurred while attempting to retrieve data from the API.")
-            basin_hierarchy_json = {}
-
-    return basin_hierarchy_json
+def safe_percents(top, bottom):
+    # vectorized safe_percent for two aligned columns
+    top = np.asarray(top, dtype=np.float64)
+    bottom = np.asarray(bottom, dtype=np.float64)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        percents = np.round(100 * top / bottom, 0)
+    valid = (top != 0) & (bottom != 0) & np.isfinite(percents)
+    return [f"{p:.0f}%" if ok else "-" for p, ok in zip(percents, valid)]
 
 
+@timed_stage("footer")
 def add_fcst_footer(fcst_html):
     table_title = "Streamflow Forecasts (kaf)"
     find_str = """<tr style="text-align: match-parent;">
@@ -103,41 +56,30 @@ def add_fcst_footer(fcst_html):
     return fcst_html.replace("</table>", f"{fcst_caption}</table>")
 
 
+@timed_stage("forecasts")
 def forecasts(basin, wsor_json):
     def add_footnotes():
         # TODO: add footnotes, somehow...
         return
 
-    def modify_exceedances(name, forecasts):
-        for period, value_dict in forecasts.items():
-            if "5" in value_dict.keys():
-                forecasts[period]["10"] = value_dict["5"]
-                forecasts[period]["90"] = value_dict["95"]
-                del forecasts[period]["5"]
-                del forecasts[period]["95"]
-        return (name, forecasts)
+    # 95% and 5% exceedances are shown in the 90% and 10% columns
+    exceedance_cols = {"5": "10", "95": "90"}
 
-    basin_data = wsor_json[basin]
+    basin_data = readonly(wsor_json)[basin]
     site_meta = basin_data["site_meta"]
     if not site_meta:
         return pd.DataFrame()
-    names = {i: site_meta[i]["name"] for i in site_meta.keys()}
-    medians = {
-        i: wsor_json[basin]["fcst_med"][i] for i in wsor_json[basin]["fcst_med"].keys()
-    }
-    forecasts = {
-        i: wsor_json[basin]["fcst_curr"][i]
-        for i in wsor_json[basin]["fcst_curr"].keys()
-    }
-    for trip, forecast in forecasts.items():
-        for period in forecast.keys():
-            forecasts[trip][period]["30 yr. Median"] = medians[trip].get(period, np.nan)
-            forecasts[trip][period]["% Median"] = safe_percent(
-                forecasts[trip][period], "50", "30 yr. Median"
-            )
-    forecasts = dict(
-        modify_exceedances(names[key], value) for (key, value) in forecasts.items()
-    )
+    sites = basin_sites(wsor_json, basin)
+    names = dict(zip(sites.triplets, sites.names))
+    medians = basin_data["fcst_med"]
+    forecasts = {}
+    for trip, forecast in basin_data["fcst_curr"].items():
+        periods = forecasts.setdefault(names[trip], {})
+        for period, values in forecast.items():
+            row = {exceedance_cols.get(k, k): v for k, v in values.items()}
+            row["30 yr. Median"] = medians[trip].get(period, np.nan)
+            row["% Median"] = safe_percent(row, "50", "30 yr. Median")
+            periods[period] = row
     reformat_forecasts = {
         (outerKey, innerKey): values
         for outerKey, innerDict in forecasts.items()
@@ -157,6 +99,7 @@ def forecasts(basin, wsor_json):
     return forecasts[col_sort].round(1)
 
 
+@timed_stage("footer")
 def add_prec_footer(basin_index, prec_html):
     if not basin_index:
         return prec_html
@@ -184,40 +127,31 @@ def add_prec_footer(basin_index, prec_html):
     return prec_html.replace("</table>", footer)
 
 
+@timed_stage("precipitation")
 def precipitation(basin, wsor_json):
     table_title = "Precipitation (in.)"
-    basin_data = wsor_json[basin]
-    site_meta = basin_data["site_meta"]
-    if not site_meta:
+    basin_data = readonly(wsor_json)[basin]
+    if not basin_data["site_meta"]:
         return pd.DataFrame()
-    elevations = {i: f"{site_meta[i]['elevation']:.0f}'" for i in site_meta.keys()}
-    elevations = pd.DataFrame(elevations, index=["elevation"]).T
-    names = {
-        i: f'{site_meta[i]["name"]} ({site_meta[i]["stationTriplet"].split(":")[-1]})'
-        for i in site_meta.keys()
-    }
-    names = pd.DataFrame(names, index=[table_title]).T
+    sites = basin_sites(
+        wsor_json,
+        basin,
+        [
+            "prec_mnth_curr",
+            "prec_mnth_ly",
+            "prec_mnth_med",
+            "prec_ytd_curr",
+            "prec_ytd_ly",
+            "prec_ytd_med",
+        ],
+    )
     prec = pd.DataFrame(
         {
-            key: wsor_json[basin][key]
-            for key in [
-                "prec_mnth_curr",
-                "prec_mnth_ly",
-                "prec_mnth_med",
-                "prec_ytd_curr",
-                "prec_ytd_ly",
-                "prec_ytd_med",
-            ]
+            table_title: sites.labels(with_network=True),
+            "elevation": sites.elevation_labels(),
+            **sites.series,
         }
     )
-    prec = reduce(
-        lambda left, right: pd.merge(
-            left, right, left_index=True, right_index=True, how="outer"
-        ),
-        [i for i in [names, elevations, prec]],
-    )
-    prec.set_index(table_title, inplace=True)
-    prec.reset_index(inplace=True)
     prec.dropna(
         inplace=True,
         how="all",
@@ -232,22 +166,14 @@ def precipitation(basin, wsor_json):
     )
     if prec.empty:
         return pd.DataFrame()
-    prec["Monthly % Median"] = prec.apply(
-        lambda c: safe_percent(c, "prec_mnth_curr", "prec_mnth_med"),
-        axis=1,
-    )
-    prec["LY Monthly % Median"] = prec.apply(
-        lambda c: safe_percent(c, "prec_mnth_ly", "prec_mnth_med"),
-        axis=1,
-    )
-    prec["YTD % Median"] = prec.apply(
-        lambda c: safe_percent(c, "prec_ytd_curr", "prec_ytd_med"),
-        axis=1,
+    prec["Monthly % Median"] = safe_percents(
+        prec["prec_mnth_curr"], prec["prec_mnth_med"]
     )
-    prec["LY YTD % Median"] = prec.apply(
-        lambda c: safe_percent(c, "prec_ytd_ly", "prec_ytd_med"),
-        axis=1,
+    prec["LY Monthly % Median"] = safe_percents(
+        prec["prec_mnth_ly"], prec["prec_mnth_med"]
     )
+    prec["YTD % Median"] = safe_percents(prec["prec_ytd_curr"], prec["prec_ytd_med"])
+    prec["LY YTD % Median"] = safe_percents(prec["prec_ytd_ly"], prec["prec_ytd_med"])
     prec = prec.rename(
         columns={
             "elevation": "Elevation",
@@ -263,6 +189,7 @@ def precipitation(basin, wsor_json):
     return prec
 
 
+@timed_stage("footer")
 def add_snow_footer(basin_index, snow_html):
     if not basin_index:
         return snow_html
@@ -286,42 +213,28 @@ def add_snow_footer(basin_index, snow_html):
     return snow_html.replace("</table>", footer)
 
 
+@timed_stage("snowpack_sites")
 def snowpack_sites(basin, wsor_json):
     table_title = "Snowpack (in.)"
-    basin_data = wsor_json[basin]
-    site_meta = basin_data["site_meta"]
-    if not site_meta:
+    basin_data = readonly(wsor_json)[basin]
+    if not basin_data["site_meta"]:
         return pd.DataFrame()
-    elevations = {i: f"{site_meta[i]['elevation']:.0f}'" for i in site_meta.keys()}
-    elevations = pd.DataFrame(elevations, index=["elevation"]).T
-    names = {
-        i: f'{site_meta[i]["name"]} ({site_meta[i]["stationTriplet"].split(":")[-1]})'
-        for i in site_meta.keys()
-    }
-    names = pd.DataFrame(names, index=[table_title]).T
-    snow = {
-        key: wsor_json[basin][key]
-        for key in ["wteq_curr", "snwd_curr", "wteq_ly", "wteq_med"]
-    }
-    snow = pd.DataFrame(snow)
-    snow = reduce(
-        lambda left, right: pd.merge(
-            left, right, left_index=True, right_index=True, how="outer"
-        ),
-        [i for i in [names, elevations, snow]],
+    sites = basin_sites(
+        wsor_json, basin, ["wteq_curr", "snwd_curr", "wteq_ly", "wteq_med"]
+    )
+    snow = pd.DataFrame(
+        {
+            table_title: sites.labels(with_network=True),
+            "elevation": sites.elevation_labels(),
+            **sites.series,
+        }
     )
     snow.set_index(table_title, inplace=True)
     snow.dropna(inplace=True, how="all", subset=["wteq_curr", "snwd_curr", "wteq_ly"])
     if snow.empty:
         return pd.DataFrame()
-    snow["% Median"] = snow.apply(
-        lambda c: safe_percent(c, "wteq_curr", "wteq_med"),
-        axis=1,
-    )
-    snow["LY % Median"] = snow.apply(
-        lambda c: safe_percent(c, "wteq_ly", "wteq_med"),
-        axis=1,
-    )
+    snow["% Median"] = safe_percents(snow["wteq_curr"], snow["wteq_med"])
+    snow["LY % Median"] = safe_percents(snow["wteq_ly"], snow["wteq_med"])
     snow = snow.rename(
         columns={
             "elevation": "Elevation",
@@ -336,6 +249,7 @@ def snowpack_sites(basin, wsor_json):
     return snow
 
 
+@timed_stage("footer")
 def add_res_footer(basin_index, res_html):
     if not basin_index:
         return res_html
@@ -361,50 +275,24 @@ def add_res_footer(basin_index, res_html):
     return res_html.replace("</table>", footer)
 
 
+@timed_stage("reservoirs")
 def reservoirs(basin, wsor_json):
     table_title = "Reservoir Storage (kaf)"
-    basin_data = wsor_json[basin]
-    site_meta = basin_data["site_meta"]
-    if not site_meta:
+    basin_data = readonly(wsor_json)[basin]
+    if not basin_data["site_meta"]:
         return pd.DataFrame()
-    names = {i: site_meta[i]["name"] for i in site_meta.keys()}
-    names = pd.DataFrame(names, index=[table_title]).T
-    res = {
-        key: wsor_json[basin][key]
-        for key in ["res_curr", "res_ly", "res_med", "res_cap"]
-    }
-    res = pd.DataFrame(res)
-    res = reduce(
-        lambda left, right: pd.merge(
-            left, right, left_index=True, right_index=True, how="outer"
-        ),
-        [i for i in [names, res]],
-    )
+    sites = basin_sites(wsor_json, basin, ["res_curr", "res_ly", "res_med", "res_cap"])
+    res = pd.DataFrame({table_title: sites.labels(), **sites.series})
     res.set_index(table_title, inplace=True)
     res.dropna(inplace=True, how="all", subset=["res_curr", "res_ly"])
     res = res.round(1)
     if res.empty:
         return pd.DataFrame()
-    res["% Capacity"] = res.apply(
-        lambda c: safe_percent(c, "res_curr", "res_cap"),
-        axis=1,
-    )
-    res["LY % Capacity"] = res.apply(
-        lambda c: safe_percent(c, "res_ly", "res_cap"),
-        axis=1,
-    )
-    res["Median % Capacity"] = res.apply(
-        lambda c: safe_percent(c, "res_med", "res_cap"),
-        axis=1,
-    )
-    res["% Median"] = res.apply(
-        lambda c: safe_percent(c, "res_curr", "res_med"),
-        axis=1,
-    )
-    res["LY % Median"] = res.apply(
-        lambda c: safe_percent(c, "res_ly", "res_med"),
-        axis=1,
-    )
+    res["% Capacity"] = safe_percents(res["res_curr"], res["res_cap"])
+    res["LY % Capacity"] = safe_percents(res["res_ly"], res["res_cap"])
+    res["Median % Capacity"] = safe_percents(res["res_med"], res["res_cap"])
+    res["% Median"] = safe_percents(res["res_curr"], res["res_med"])
+    res["LY % Median"] = safe_percents(res["res_ly"], res["res_med"])
     res = res.rename(
         columns={
             "res_curr": "Current",
@@ -418,5 +306,242 @@ def reservoirs(basin, wsor_json):
     return res
 
 
+SUMMARY_FIELDS = dict(
+    snow={
+        "wteq_curr_per_med": "SWE % Median",
+        "wteq_ly_per_med": "Last Yr SWE % Median",
+    },
+    prec={
+        "prec_mnth_curr_per_med": "Monthly Precip % Median",
+        "prec_mnth_ly_per_med": "Last Yr Monthly Precip % Median",
+        "prec_ytd_curr_per_med": "YTD Precip % Median",
+        "prec_ytd_ly_per_med": "Last Yr YTD Precip % Median",
+    },
+    res={
+        "res_curr_per_cap": "Reservoir % Capacity",
+        "res_curr_per_med": "Reservoir % Median",
+    },
+)
+
+
+@timed_stage("state_summary")
+def state_summary(fcst_json, snow_json, prec_json, res_json):
+    payloads = dict(
+        fcst=readonly(fcst_json),
+        snow=readonly(snow_json),
+        prec=readonly(prec_json),
+        res=readonly(res_json),
+    )
+    basins = list(dict.fromkeys(b for p in payloads.values() for b in p.keys()))
+    if not basins:
+        return pd.DataFrame()
+    snow_sites = [
+        len((payloads["snow"].get(b) or {}).get("site_meta") or {}) for b in basins
+    ]
+    columns = {"Basin": basins, "Snow Sites": np.array(snow_sites, dtype=np.int64)}
+    for table, fields in SUMMARY_FIELDS.items():
+        indexes = [
+            (payloads[table].get(b) or {}).get("basin_index") or {} for b in basins
+        ]
+        for key, label in fields.items():
+            columns[label] = np.array(
+                [np.nan if i.get(key) is None else i[key] for i in indexes],
+                dtype=np.float64,
+            )
+    return pd.DataFrame(columns)
+
+
+def cached_state_summary(state, year, month, basin_type, report_data):
+    # kept next to the payloads in the memory cache and rebuilt when any of
+    # them is refetched
+    key = f"state_summary/{state}/{year}/{month}/{basin_type}"
+    payloads = tuple(report_data[t] for t in ("fcst", "snow", "prec", "res"))
+    cached = memory_cache.get(key)
+    if cached is not None and all(a is b for a, b in zip(cached[0], payloads)):
+        return cached[1]
+    start = perf_counter()
+    summary = state_summary(*payloads)
+    memory_cache.set(
+        key,
+        (payloads, summary),
+        cost=perf_counter() - start,
+        size=approx_size(summary),
+    )
+    return summary
+
+
+def summary_deltas(summary, prior_summary):
+    if prior_summary.empty:
+        prior_summary = pd.DataFrame(columns=summary.columns)
+    prior = prior_summary.set_index("Basin").reindex(summary["Basin"])
+    deltas = summary.copy()
+    for col in summary.columns[2:]:
+        position = deltas.columns.get_loc(col) + 1
+        change = summary[col].to_numpy() - prior[col].to_numpy(dtype=np.float64)
+        deltas.insert(position, f"{col} Change", change)
+    return deltas
+
+
+def summary_rows(summary):
+    changes = [str(col).endswith(" Change") for col in summary.columns[2:]]
+    rows = []
+    for record in summary.itertuples(index=False):
+        basin, sites, *values = record
+        cells = [
+            ("-", "") if v != v else (f"{v:+.0f}" if change else f"{v:.0f}%", v)
+            for v, change in zip(values, changes)
+        ]
+        rows.append([(basin, basin.lower()), (f"{sites}", sites), *cells])
+    return rows
+
+
+def prior_month(year, month):
+    return (year, month - 1) if month > 1 else (year - 1, 12)
+
+
+DELTA_METRICS = dict(
+    snow={"wteq_curr": "SWE", "snwd_curr": "Snow Depth"},
+    prec={"prec_ytd_curr": "YTD Precip"},
+    res={"res_curr": "Storage"},
+)
+DELTA_TITLES = dict(
+    fcst="Streamflow Forecasts (kaf)",
+    snow="Snowpack (in.)",
+    prec="Precipitation (in.)",
+    res="Reservoir Storage (kaf)",
+)
+
+
+def _forecast_series(wsor_json, basin, exceedance):
+    keys, values = [], []
+    basin_data = readonly(wsor_json).get(basin) or {}
+    for trip, periods in (basin_data.get("fcst_curr") or {}).items():
+        for period, forecast in periods.items():
+            keys.append((trip, period))
+            values.append(forecast.get(exceedance))
+    index = pd.MultiIndex.from_tuples(keys, names=["triplet", "period"])
+    if not keys:
+        index = pd.MultiIndex.from_arrays([[], []], names=["triplet", "period"])
+    return pd.Series(
+        np.array([np.nan if v is None else v for v in values], dtype=np.float64),
+        index=index,
+    )
+
+
+@timed_stage("forecast_deltas")
+def forecast_deltas(basin, fcst_json, prior_fcst_json, exceedance="50"):
+    basin_data = readonly(fcst_json).get(basin)
+    if not basin_data or not basin_data["site_meta"]:
+        return pd.DataFrame()
+    current = _forecast_series(fcst_json, basin, exceedance)
+    prior = _forecast_series(prior_fcst_json, basin, exceedance).reindex(current.index)
+    if current.empty:
+        return pd.DataFrame()
+    sites = basin_sites(fcst_json, basin)
+    names = dict(zip(sites.triplets, sites.names))
+    change = current.to_numpy() - prior.to_numpy()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        pct_change = np.round(100 * change / prior.to_numpy(), 0)
+    pct_change[~np.isfinite(pct_change)] = np.nan
+    deltas = pd.DataFrame(
+        {
+            f"{exceedance}%": current.to_numpy(),
+            f"Prior {exceedance}%": prior.to_numpy(),
+            "Change": change,
+            "% Change": pct_change,
+        },
+        index=pd.MultiIndex.from_arrays(
+            [
+                [names.get(t) for t in current.index.get_level_values("triplet")],
+                current.index.get_level_values("period"),
+            ]
+        ),
+    )
+    return deltas.round(1)
+
+
+@timed_stage("site_deltas")
+def site_deltas(basin, table, wsor_json, prior_json):
+    basin_data = readonly(wsor_json).get(basin)
+    if not basin_data or not basin_data["site_meta"]:
+        return pd.DataFrame()
+    metrics = DELTA_METRICS[table]
+    current = basin_sites(wsor_json, basin, list(metrics))
+    if basin in prior_json:
+        prior = basin_sites(prior_json, basin, list(metrics))
+        position = pd.Index(prior.triplets).get_indexer(current.triplets)
+    else:
+        prior, position = None, np.full(len(current), -1)
+    found = position >= 0
+    deltas = {DELTA_TITLES[table]: current.labels(with_network=table != "res")}
+    for metric, label in metrics.items():
+        values = current.series[metric]
+        prior_values = np.full(len(current), np.nan)
+        if prior is not None:
+            prior_values[found] = prior.series[metric][position[found]]
+        deltas[label] = values
+        deltas[f"Prior {label}"] = prior_values
+        deltas[f"{label} Change"] = values - prior_values
+    deltas = pd.DataFrame(deltas)
+    deltas = deltas.dropna(how="all", subset=list(metrics.values()))
+    return deltas.round(1)
+
+
+def basin_delta_tables(basin, current, prior):
+    tables = dict(fcst=forecast_deltas(basin, current["fcst"], prior["fcst"]))
+    for table in DELTA_METRICS:
+        tables[table] = site_deltas(basin, table, current[table], prior[table])
+    html = {}
+    for table, df in tables.items():
+        if df.empty:
+            html[table] = None
+        else:
+            html[table] = table_html(df, table, index=table == "fcst", bold_rows=False)
+    return html
+
+
+def table_html(df, table_id, **kwargs):
+    with timed("to_html", table=table_id):
+        return df.to_html(
+            table_id=table_id,
+            classes="table table-sm table-hover",
+            justify="match-parent",
+            na_rep="-",
+            border=0,
+            **kwargs,
+        )
+
+
+def basin_report_tables(basin, fcst_json, snow_json, prec_json, res_json):
+    fcst = forecasts(basin, fcst_json)
+    snow = snowpack_sites(basin, snow_json)
+    prec = precipitation(basin, prec_json)
+    res = reservoirs(basin, res_json)
+    return dict(
+        fcst=None
+        if fcst.empty
+        else add_fcst_footer(table_html(fcst, "fcst", bold_rows=False)),
+        res=None
+        if res.empty
+        else add_res_footer(
+            res_json[basin].get("basin_index", None),
+            table_html(res, "res", index=False),
+        ),
+        snow=None
+        if snow.empty
+        else add_snow_footer(
+            snow_json[basin].get("basin_index", None),
+            table_html(snow, "snow", index=False),
+        ),
+        prec=None
+        if prec.empty
+        else add_prec_footer(
+            prec_json[basin].get("basin_index", None),
+            table_html(prec, "prec", index=False),
+        ),
+    )
+
+
 if __name__ == "__main__":
-    print("no tests written")
+
+    print("This module builds the basin report tables")